@@ -26,6 +26,10 @@ import subprocess
 import sys
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import common
+
 # Based on Cloverly, Water Tank under lawn.
 # 
 TANK_DEPTH_CM = 248.5  # From bottom of sensor
@@ -42,6 +46,10 @@ NODE_HANDLERS = {
     100: 'ProcessTankLevel',
 }
 
+# Aggregation of the metrics before they are written (see common.Policy). The
+# sensor reports more often than the RRD step, keep the last level in each.
+DEFAULT_POLICIES = ['tank_litres=last:60']
+
 
 def FormatHour(hour):
   return '%s-%s-%s %s:00' % (hour[:4], hour[4:6], hour[6:8], hour[8:])
@@ -59,6 +67,15 @@ class NodeState(object):
     # Water sensor attribute
     self.last_litres = 0
     self.hour_litres = 0	
+    # The last tank_litres written, which tank_change is reported against.
+    self.reported_litres = None
+    # Metrics with a policy, the bucket of values in their current step.
+    self.pending = {}
+
+  def __setstate__(self, state):
+    self.reported_litres = None
+    self.pending = {}
+    self.__dict__.update(state)
 
 class Report(object):
 
@@ -95,14 +112,21 @@ class RRDUpdaterHistory(object):
     self.current_hour = None
     self.current_file = None
     self.current_file_lineno = None
+    # Byte offset after the last processed line, and the identity (inode,
+    # size, mtime) and trailing bytes of the file up to that offset.
+    self.current_file_offset = None
+    self.current_file_id = None
+    self.current_file_tail = None
 
 
 class RRDUpdater(object):
   """Updates RRDs based on a directory of logfiles."""
 
-  def __init__(self, rrd_dir, history_file, dry_run, debug=False):
+  def __init__(self, rrd_dir, history_file, dry_run, debug=False,
+               policies=None):
     # self.history must be defined first to avoid infinite loop in setattr.
     self.rrd_dir = rrd_dir
+    self.policies = policies or {}
     self.rrds = []
     self.dry_run = dry_run
     self.debug = debug
@@ -112,6 +136,9 @@ class RRDUpdater(object):
     self.history_file = history_file
     if history_file and os.path.exists(history_file):
       self.history = pickle.load(file(history_file, 'rb'))
+      for name, value in RRDUpdaterHistory().__dict__.iteritems():
+        if not hasattr(self.history, name):
+          setattr(self.history, name, value)
       print 'Loaded history from %s. Current Hour: %s. Processing %s@%s' % (
           history_file, self.current_hour, self.current_file,
           self.current_file_lineno)
@@ -143,11 +170,18 @@ class RRDUpdater(object):
       self.rrds.append(rrd)
     
   def CreateRRD(self, ds):
-    if ds.endswith('bat') or ds.endswith('temp'):
+    # Series derived by a policy (eg tank_litres_min) are of their metric's
+    # type.
+    metric = ds
+    for kind in common.Policy.KINDS:
+      if metric.endswith('_' + kind):
+        metric = metric[:-len(kind) - 1]
+        break
+    if metric.endswith('bat') or metric.endswith('temp'):
       ds_type = 'GAUGE:3600:-50:255'
-    elif ds.endswith('litres'):
+    elif metric.endswith('litres'):
       ds_type = 'GAUGE:3600:0:20000'
-    elif ds.endswith('change'):
+    elif metric.endswith('change'):
       ds_type = 'ABSOLUTE:60:U:U'
     else:
       ds_type = 'COUNTER:300:U:U'
@@ -277,30 +311,29 @@ class RRDUpdater(object):
 
   def ProcessFiles(self, files):
     hist_file = self.current_file
-    hist_lineno = self.current_file_lineno
-    last_ts = 0
     for filename in files:
-      basename = os.path.basename(filename)
+      basename = common.LogName(filename)
       if hist_file and basename < hist_file:
         #print 'Skipping %s, already processed' % basename
         continue
+      opened = common.OpenResumed(filename, self.history)
+      if not opened:
+        continue
+      fp, lineno, offset = opened
       self.current_file = basename
-      for lineno, line in enumerate(open(filename, 'r')):
-        if hist_file == self.current_file:
-          if lineno <= hist_lineno:
-            #print 'Skipping line %d in %s, already processed' % (lineno, basename)
-            continue
+      self.current_file_lineno = lineno - 1
+      self.current_file_offset = offset
+      for lineno, line in enumerate(fp, lineno):
+        if not line.endswith('\n'):
+          # Still being written, leave it for next time.
+          break
+        offset += len(line)
         self.current_file_lineno = lineno
+        self.current_file_offset = offset
         self.current_line = line
         report = Report(line, self.debug)
         if not report.valid:
           continue
-        if last_ts == 0:
-          last_ts = report.ts
-        else:
-          elapsed = report.ts - last_ts
-          if elapsed > 0 and elapsed < 58:
-            continue
         if self.current_hour and report.hour != self.current_hour:
           self.PrintHourlyReport()
         self.current_hour = report.hour
@@ -310,6 +343,10 @@ class RRDUpdater(object):
         handler(report)
         # Keep stats about node report reliability every hour.
         self.UpdateNodeReport(report)
+      self.current_file_id = common.FileIdentity(filename)
+      self.current_file_tail = common.ReadTail(fp, offset)
+      fp.close()
+    self.ClosePolicies()
     # Make sure the last report gets flushed.
     self.FlushUpdateQueue()
     # Print an update.
@@ -343,19 +380,46 @@ class RRDUpdater(object):
     water_level = TANK_DEPTH_CM - level
     litres = (math.pi * (TANK_RADIUS_CM * TANK_RADIUS_CM) * water_level) / 1000.0
     state = self.GetOrCreateNodeState(report.node_id)
-    usage = 0
-    if state.last_litres != 0:
-      change = litres - state.last_litres
-      state.last_litres = litres
-    else:
-      state.last_litres = litres
+    if state.last_litres == 0:
       state.hour_litres = litres
-      change = 0
-    data = {
-        'tank_litres': litres,
-        'tank_change': change
-    }
-    self.UpdateRRD(report.ts, data)
+    state.last_litres = litres
+    self.AddMetric(report.node_id, 'tank_litres', report.ts, litres)
+
+  def AddMetric(self, node_id, metric, ts, value):
+    """Writes a metric, or adds it to its bucket if it has a policy."""
+    policy = self.PolicyFor(metric)
+    if policy is None:
+      self.ReportMetrics(node_id, ts, [(metric, value)])
+      return
+    state = self.GetOrCreateNodeState(node_id)
+    bucket = common.AddToBucket(state.pending, metric, policy, ts, value)
+    if bucket:
+      self.ReportMetrics(node_id, bucket[1], policy.Values(metric, bucket))
+
+  def PolicyFor(self, metric):
+    return self.policies.get(metric, None) or self.policies.get('*', None)
+
+  def ClosePolicies(self):
+    """Writes the buckets of steps ending before the latest report."""
+    for node_id, state in self.node_state.items():
+      for metric, bucket in state.pending.items():
+        # Write the last value as is if there is no longer a policy.
+        policy = self.PolicyFor(metric) or common.Policy(['last'], 1)
+        if bucket[0] + policy.step <= state.last_ts:
+          self.ReportMetrics(node_id, bucket[1], policy.Values(metric, bucket))
+          del state.pending[metric]
+
+  def ReportMetrics(self, node_id, ts, values):
+    """Writes (metric, value) pairs, with the tank_change since the last."""
+    data = dict(values)
+    if 'tank_litres' in data:
+      state = self.GetOrCreateNodeState(node_id)
+      if state.reported_litres is None:
+        data['tank_change'] = 0
+      else:
+        data['tank_change'] = data['tank_litres'] - state.reported_litres
+      state.reported_litres = data['tank_litres']
+    self.UpdateRRD(ts, data)
 
 
 def main():
@@ -363,14 +427,23 @@ def main():
   parser.add_option('--dry_run', action='store_true', dest='dry_run')
   parser.add_option('--debug', action='store_true', dest='debug')
   parser.add_option('--history_file', action='store', dest='history_file')
+  parser.add_option('--policy', action='append', dest='policies', default=[],
+                    help='Aggregate a metric before writing it, as '
+                    'metric=kinds:step (see common.Policy), eg '
+                    'tank_litres=mean+min+max:300. Defaults to %s.' %
+                    ' '.join(DEFAULT_POLICIES))
   options, args = parser.parse_args()
   if len(args) < 2:
     sys.stderr.write('Usage: %s [--dry_run] [--debug] [--history_file foo] '
         'rrd_dir logfile1 [logfile2, ...]\n' % sys.argv[0])
     sys.exit(1)
 
+  try:
+    policies = common.LoadPolicies(DEFAULT_POLICIES + options.policies)
+  except ValueError, e:
+    parser.error(str(e))
   updater = RRDUpdater(args[0], options.history_file, options.dry_run,
-      options.debug)
+      options.debug, policies)
   updater.ProcessFiles(args[1:])
 
 if __name__ == "__main__":
@@ -0,0 +1,773 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# The base of the updaters, which update a data store from the log files.
+import common
+import functools
+import history_store
+import os
+import rollup_store
+import signal
+import stream_stats
+import threading
+import time
+
+# numpy is only needed by the batch decoder (apt-get install python-numpy).
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Seconds, and number of reports, between saving history while processing.
+CHECKPOINT_INTERVAL = 300
+CHECKPOINT_REPORTS = 100000
+
+
+class Updater(object):
+  """Base functionality for updating a data store from the log files."""
+
+  def __init__(self, state_dir, history_file, dry_run, debug=False):
+    # self.history must be defined first to avoid infinite loop in setattr.
+    self.state_dir = state_dir
+    self.nodes = common.LoadConfig(os.path.join(state_dir, 'config'))
+    self.schemas = common.LoadSchemas(os.path.join(state_dir, common.SCHEMAS))
+    self.handlers = self.BuildHandlers()
+    self.batch_handlers = self.BuildBatchHandlers()
+    self.policies = dict((node_id, node['policies'])
+                         for node_id, node in self.nodes.iteritems()
+                         if node['policies'])
+    self.dry_run = dry_run
+    self.debug = debug
+    self.batch = False
+    self.current_line = None
+    self.checkpoint_interval = CHECKPOINT_INTERVAL
+    self.checkpoint_reports = CHECKPOINT_REPORTS
+    self.last_checkpoint = time.time()
+    self.unsaved_reports = 0
+    self.dirty_nodes = set()
+    self.current_path = None
+    self.store = None
+    self.rollup_store = None
+    self.metrics_server = None
+    self.instrumentation = None
+    self.history_file = history_file and os.path.join(state_dir, history_file)
+    history = None
+    if self.history_file:
+      # Histories used to be pickled whole, which is imported once.
+      legacy_file = '%s.pickle' % os.path.splitext(self.history_file)[0]
+      if os.path.exists(self.history_file):
+        self.store = history_store.HistoryStore(self.history_file)
+        history = self.store.Load()
+      elif os.path.exists(legacy_file):
+        if dry_run:
+          history = history_store.LoadPickleHistory(legacy_file)
+        else:
+          self.store = history_store.ImportPickleHistory(legacy_file,
+                                                         self.history_file)
+          history = self.store.Load()
+      elif not dry_run:
+        self.store = history_store.HistoryStore(self.history_file)
+    if history:
+      self.history = history
+      print 'Loaded history from %s. Current Hour: %s. Processing %s@%s' % (
+          self.history_file, self.current_hour, self.current_file,
+          self.current_file_lineno)
+    else:
+      self.history = common.UpdaterHistory()
+
+  def ReportMetric(self, node_id, metric, ts, value):
+    """Override in subclasses for updater specific logic to store metric."""
+    raise RuntimeError('Unimplemented')
+
+  def AddMetric(self, node_id, metric, ts, value):
+    """Reports a metric, or adds it to its bucket if it has a Policy.
+
+    Buckets (see AddToBucket) are reported once a value for a later step
+    arrives, or by ClosePolicies. Open buckets are kept in the node state,
+    so carry on across runs.
+    """
+    policy = self.PolicyFor(node_id, metric)
+    if policy is None:
+      self.ReportMetric(node_id, metric, ts, value)
+      return
+    state = self.GetOrCreateNodeState(node_id)
+    bucket = common.AddToBucket(state.pending, metric, policy, ts, value)
+    if bucket:
+      self.ReportBucket(node_id, metric, policy, bucket)
+
+  def MetricKind(self, node_id, metric):
+    """Returns whether a metric (or a Policy kind of it) is a gauge or counter.
+
+    Metrics declared in the node type's schema are of the kind declared, of
+    the others (ie revs) only bat and temp are gauges.
+    """
+    node_type = self.nodes.get(node_id, {}).get('type', None)
+    declared = node_type in self.schemas and self.schemas[node_type].kinds or {}
+    if metric not in declared:
+      for kind in common.Policy.KINDS:
+        if metric.endswith('_' + kind):
+          metric = metric[:-len(kind) - 1]
+          break
+    if metric in declared:
+      return declared[metric]
+    if metric in (common.BATTERY, common.TEMPERATURE):
+      return 'gauge'
+    return 'counter'
+
+  def PolicyFor(self, node_id, metric):
+    policies = self.policies.get(node_id, None)
+    if not policies:
+      return None
+    return policies.get(metric, None) or policies.get('*', None)
+
+  def ReportBucket(self, node_id, metric, policy, bucket):
+    for name, value in policy.Values(metric, bucket):
+      self.ReportMetric(node_id, name, bucket[1], value)
+
+  def ClosePolicies(self):
+    """Reports the buckets of steps ending before the latest report.
+
+    Logs are processed in order, so no more values will arrive for them.
+    """
+    horizon = max([state.last_ts for state in self.node_state.itervalues()] or
+                  [0])
+    for node_id, state in self.node_state.items():
+      for metric, bucket in state.pending.items():
+        # Report the last value as is if the config no longer has a policy.
+        policy = self.PolicyFor(node_id, metric) or common.Policy(['last'], 1)
+        if bucket[0] + policy.step <= horizon:
+          self.ReportBucket(node_id, metric, policy, bucket)
+          del self.GetOrCreateNodeState(node_id).pending[metric]
+
+  def BuildHandlers(self):
+    """Returns the function handling the reports of each node, by node_id.
+
+    Node types with a Process<type> method are handled by it, others by
+    ProcessSchema with their schema.
+    """
+    handlers = {}
+    for node_id, node in self.nodes.iteritems():
+      handler = getattr(self, 'Process%s' % node['type'], None)
+      if handler is None and node['type'] in self.schemas:
+        handler = functools.partial(self.ProcessSchema,
+                                    self.schemas[node['type']])
+      if handler is None:
+        print 'No handler or schema for %s (node %d), ignoring its reports' % (
+            node['type'], node_id)
+        continue
+      handlers[node_id] = handler
+    return handlers
+
+  def BuildBatchHandlers(self):
+    """Returns the vectorized equivalent of each node's handler, by node_id.
+
+    Each takes the node_id, the node's DecodeLines records and the ping_id
+    preceding each, updating the node state as the handler would for each
+    record. It returns whether the handler would accept each record, the
+    metrics it would report, and a list of their values for each accepted
+    record. Nodes whose handler (eg one overridden in a subclass) or schema
+    has no equivalent are handled a report at a time by ProcessRecords.
+    """
+    handlers = {}
+    for node_id, handler in self.handlers.iteritems():
+      schema = self.schemas.get(self.nodes[node_id]['type'], None)
+      if schema is None or schema.dtype is None:
+        continue
+      func = getattr(getattr(handler, 'func', handler), '__func__', None)
+      if func is Updater.ProcessSchema.__func__:
+        handlers[node_id] = functools.partial(self.BatchSchema, schema)
+      elif func is Updater.ProcessTempSensor.__func__:
+        handlers[node_id] = functools.partial(self.BatchTempSensor, schema)
+      elif (func is Updater.ProcessMeterReader.__func__ and
+            schema.dtype[schema.index['counter']].kind in 'iu'):
+        handlers[node_id] = functools.partial(self.BatchMeterReader, schema)
+    return handlers
+
+  def __getattr__(self, name):
+    """Delegate to the history object for any attributes it defines."""
+    history = self.__dict__.get('history', None)
+    if not hasattr(history, name):
+      raise AttributeError('%s is not a history attribute' % name)
+    return getattr(history, name)
+
+  def __setattr__(self, name, value):
+    """Save to the history object for any attributes it defines."""
+    history = self.__dict__.get('history', None)
+    if hasattr(history, name):
+      setattr(history, name, value)
+    else:
+      self.__dict__[name] = value
+
+  def ServeMetrics(self, port, bind='127.0.0.1'):
+    """Serves the node state for Prometheus from a background thread."""
+    import metrics_server
+    self.metrics_server = metrics_server.MetricsServer(port, self, bind)
+    thread = threading.Thread(target=self.metrics_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def InstrumentedCalls(self):
+    """Returns (object, name, stage, items) for each call timed by --stats.
+
+    Override in subclasses to add the calls to their data store.
+    """
+    return [
+        (self, 'ProcessFile', 'read and parse', None),
+        (common, 'DecodeLines', 'batch decode', None),
+        (self, 'ProcessReport', 'dispatch', None),
+        (self, 'ProcessRecords', 'dispatch', lambda records: len(records)),
+        (self, 'ReportMetric', 'output', None),
+        (self, 'FlushOutput', 'flush', None),
+        (self, 'SaveHistory', 'history save', None),
+    ]
+
+  def Instrument(self, profile=False):
+    """Times each stage of processing until FinishInstrumentation."""
+    import instrument
+    self.instrumentation = instrument.Instrumentation(self.state_dir, profile)
+    for obj, name, stage, items in self.InstrumentedCalls():
+      self.instrumentation.Wrap(obj, name, stage, items)
+    self.instrumentation.Start()
+
+  def FinishInstrumentation(self):
+    if self.instrumentation:
+      self.instrumentation.Stop()
+      self.instrumentation = None
+
+  def SaveHistory(self, announce=True):
+    if self.dry_run or not self.store:
+      return True
+    self.store.Save(self.history, self.dirty_nodes)
+    self.dirty_nodes = set()
+    self.unsaved_reports = 0
+    self.last_checkpoint = time.time()
+    if announce:
+      print 'History saved to %s' % self.history_file
+
+  def MaybeCheckpoint(self, reports=1):
+    """Saves history every checkpoint_reports reports or _interval seconds."""
+    self.unsaved_reports += reports
+    if (self.unsaved_reports >= self.checkpoint_reports or
+        time.time() - self.last_checkpoint >= self.checkpoint_interval):
+      self.Checkpoint()
+
+  def Checkpoint(self):
+    """Saves history part way through processing, so it can resume there."""
+    if self.dry_run or not self.store:
+      return
+    if self.current_path:
+      self.MarkCurrentFile(self.current_path)
+    self.SaveHistory(self.debug)
+
+  def GetOrCreateNodeState(self, node_id):
+    self.dirty_nodes.add(node_id)
+    if node_id not in self.node_state:
+      self.node_state[node_id] = common.NodeState()
+    return self.node_state[node_id]
+
+  def UpdateNodeReport(self, report):
+    state = self.GetOrCreateNodeState(report.node_id)
+    if state.last_ts > 0:
+      if (int(state.last_ts/3600)*3600) == (int(report.ts/3600)*3600):
+        state.gaps.Add(report.ts - state.last_ts)
+      if report.ping_id > (state.last_ping_id + 1):
+        state.num_reports += report.ping_id - state.last_ping_id
+    state.num_reports += 1
+    state.received_reports += 1
+    # Store state for future.
+    state.last_ping_id = report.ping_id
+    state.last_ts = report.ts
+
+  def UpdateNodeReports(self, state, ts, ping_id, last_ts, last_ping):
+    """UpdateNodeReport for arrays of a node's reports, and those before."""
+    seen = last_ts > 0
+    gaps = seen & (numpy.trunc(last_ts / 3600) == numpy.trunc(ts / 3600))
+    state.gaps.AddArray((ts - last_ts)[gaps])
+    missed = seen & (ping_id > last_ping + 1)
+    state.num_reports += int((ping_id - last_ping)[missed].sum()) + len(ts)
+    state.received_reports += len(ts)
+    state.last_ping_id = int(ping_id[-1])
+    state.last_ts = float(ts[-1])
+
+  def CalcHourlyAverage(self, node_id, state, just, reset):
+    a = '% 2d: ' % node_id
+    if self.nodes[node_id]['type'] == 'MeterReader':
+      usage = state.realcounter - state.hour_counter
+      a += '%.02fkWh' % (usage*common.WH_PER_REV/1000.0)
+    elif state.temps.count > 0:
+      a += '%.02f°C' % state.temps.Average()
+      just += 1  # degree confuses ljust... sigh.
+    if reset:
+      state.ResetHour()
+    return a.ljust(just)
+
+  def CalcHourlySpread(self, node_id, state, just):
+    """Describes the p50/p95 gaps between reports, and temperature range."""
+    a = '% 2d: ' % node_id
+    if state.gaps.count > 0:
+      a += '%d/%ds' % (state.gaps.Quantile(0.5), state.gaps.Quantile(0.95))
+    if state.temps.count > 0:
+      a += ' %.01f-%.01f°C' % (state.temps.min, state.temps.max)
+      just += 1  # degree confuses ljust... sigh.
+    return a.ljust(just)
+
+  def HourlyRollup(self, node_id, state):
+    """Returns the columns of a node's RollupStore row for the hour."""
+    row = {'received': state.received_reports, 'expected': state.num_reports}
+    if state.gaps.count > 0:
+      row.update(gap_mean=state.gaps.Average(),
+                 gap_p50=state.gaps.Quantile(0.5),
+                 gap_p95=state.gaps.Quantile(0.95), gap_count=state.gaps.count)
+    if self.nodes[node_id]['type'] == 'MeterReader':
+      row['kwh'] = (
+          (state.realcounter - state.hour_counter) * common.WH_PER_REV / 1000.0)
+    if state.temps.count > 0:
+      row.update(temp_mean=state.temps.Average(), temp_min=state.temps.min,
+                 temp_max=state.temps.max, temp_count=state.temps.count)
+    return row
+
+  def SaveRollups(self, rows):
+    """Saves the current hour's rollups, alongside the history."""
+    if self.dry_run or not self.store or not self.current_hour or not rows:
+      return
+    if not self.rollup_store:
+      self.rollup_store = rollup_store.RollupStore(
+          os.path.join(self.state_dir, rollup_store.ROLLUP_DB))
+    self.rollup_store.SaveHour(common.HourStart(self.current_hour), rows)
+
+  def PrintHourlyReport(self, reset=False):
+    reliability = []
+    spreads = []
+    averages = []
+    rollups = []
+    for node_id in sorted(self.nodes.keys()):
+      state = self.GetOrCreateNodeState(node_id)
+      if state.num_reports > 0:
+        rollups.append((node_id, self.HourlyRollup(node_id, state)))
+      health = freq = '   NaN'
+      if state.num_reports > 0:
+        health = '% 5d%%' % int(
+            float(state.received_reports) / float(state.num_reports) * 100.0)
+        if state.gaps.count > 0:
+          freq = '% 5ds' % state.gaps.Average()
+      debug = ''
+      if self.debug:
+        debug = ' (% 3d/% 3d)' % (state.received_reports, state.num_reports)
+      t = '% 2d:%s @%s%s' % (node_id, health, freq, debug)
+      reliability.append(t)
+      spreads.append(self.CalcHourlySpread(node_id, state, len(t)))
+      averages.append(self.CalcHourlyAverage(node_id, state, len(t), reset))
+    self.SaveRollups(rollups)
+    hour = common.FormatHour(self.current_hour)
+    print '%s: Reports : %s' % (hour, ' '.join(reliability))
+    print '%s: Averages: %s' % (hour, ' '.join(averages))
+    print '%s: Spread  : %s' % (hour, ' '.join(spreads))
+
+  def PrintMeterSummary(self):
+    for node_id, node in self.nodes.iteritems():
+      if node['type'] != 'MeterReader':
+        continue
+      state = self.GetOrCreateNodeState(node_id)
+      usage = state.realcounter - state.first_count
+      print '%s: Kwh from %s til %s: %.02fkWh' % (
+          node['desc'],
+          time.ctime(state.first_ts), time.ctime(state.last_ts),
+          usage*common.WH_PER_REV/1000.0)
+
+  def ProcessFiles(self, files):
+    for filename in common.FilesFrom(common.UniqueLogs(files),
+                                     self.current_file):
+      self.ProcessFile(filename)
+    self.ClosePolicies()
+    self.FinishedProcessing()
+
+  def OpenResumed(self, filename):
+    return common.OpenResumed(filename, self.history)
+
+  def ProcessFile(self, filename):
+    opened = self.OpenResumed(filename)
+    if not opened:
+      return
+    fp, lineno, offset = opened
+    self.current_path = filename
+    self.current_file = common.LogName(filename)
+    self.current_file_lineno = lineno - 1
+    self.current_file_offset = offset
+    with fp:
+      if self.batch:
+        self.ProcessFileBatch(fp, lineno, offset)
+      else:
+        for lineno, line in enumerate(fp, lineno):
+          if not line.endswith('\n'):
+            # Still being written, leave it for next time.
+            break
+          offset += len(line)
+          self.current_file_lineno = lineno
+          self.current_file_offset = offset
+          self.current_line = line
+          self.ProcessReport(common.Report(line, self.debug))
+    self.MarkCurrentFile(filename)
+    self.current_path = None
+
+  def MarkCurrentFile(self, filename):
+    """Records the identity of the current file for the next resume."""
+    self.current_file_id = common.FileIdentity(filename)
+    if common.IsCompressed(filename):
+      # Only needed to check the file hasn't been rewritten, which compressed
+      # logs aren't, and slow to read back.
+      self.current_file_tail = None
+      return
+    with open(filename, 'r') as fp:
+      self.current_file_tail = common.ReadTail(fp, self.current_file_offset)
+
+  def ProcessFileBatch(self, fp, lineno, offset):
+    """Processes a file via the vectorized decoder rather than per line."""
+    for records, lineno, offset in common.DecodeFile(fp, lineno, self.debug,
+                                                     offset):
+      hours = records['hour']
+      ends = numpy.flatnonzero(hours[1:] != hours[:-1]) + 1
+      for start, end in zip([0] + ends.tolist(), ends.tolist() + [None]):
+        if len(records[start:end]):
+          self.ProcessRecords(records[start:end])
+      self.current_file_lineno = lineno - 1
+      self.current_file_offset = offset
+
+  def ProcessRecords(self, records):
+    """Processes DecodeLines records from the same hour, as ProcessReport.
+
+    Each node's records are handled by its batch handler, then the metrics
+    reported in line order. Records the handler rejects, and those of nodes
+    without a batch handler, are handled a report at a time (in line order
+    too), so the same metrics and messages come out as from ProcessReport.
+    """
+    hour = common.HourForTs(int(records['hour'][0]) * 3600)
+    if self.current_hour and hour != self.current_hour:
+      self.PrintHourlyReport(True)
+    self.current_hour = hour
+    self.current_line = None
+    node_ids = records['node_id']
+    # For each record, the values of the metrics to report, or the function
+    # to handle it as a Report.
+    actions = [None] * len(records)
+    metrics = {}
+    for node_id in numpy.unique(node_ids).tolist():
+      rows = numpy.flatnonzero(node_ids == node_id)
+      handler = self.handlers.get(node_id, None)
+      batch_handler = self.batch_handlers.get(node_id, None)
+      if handler and not batch_handler:
+        process = functools.partial(self.ProcessRecordReport, handler)
+        for i in rows.tolist():
+          actions[i] = process
+        continue
+      mine = records[rows]
+      state = self.GetOrCreateNodeState(node_id)
+      ts = mine['ts']
+      ping_id = mine['ping_id'].astype(numpy.int64)
+      last_ts = numpy.concatenate(([state.last_ts], ts[:-1]))
+      last_ping = numpy.concatenate(([state.last_ping_id], ping_id[:-1]))
+      if batch_handler:
+        valid, metrics[node_id], columns = batch_handler(node_id, mine,
+                                                         last_ping)
+        for i, values in zip(rows[valid].tolist(), zip(*columns)):
+          actions[i] = values
+        for i in rows[~valid].tolist():
+          # Only to report why, the handler changes nothing for these.
+          actions[i] = handler
+      self.UpdateNodeReports(state, ts, ping_id, last_ts, last_ping)
+    node_ids = node_ids.tolist()
+    ts = records['ts'].tolist()
+    for i, action in enumerate(actions):
+      if action is None:
+        continue
+      if callable(action):
+        action(common.Report.FromRecord(records[i], hour))
+        continue
+      node_id = node_ids[i]
+      for metric, value in zip(metrics[node_id], action):
+        self.AddMetric(node_id, metric, ts[i], value)
+    self.current_file_lineno = int(records['lineno'][-1])
+    self.current_file_offset = int(records['offset'][-1])
+    self.MaybeCheckpoint(len(records))
+
+  def ProcessRecordReport(self, handler, report):
+    """Handles a report for ProcessRecords, as ProcessReport does."""
+    self.current_line = report
+    handler(report)
+    self.UpdateNodeReport(report)
+
+  def ProcessReport(self, report):
+    if not report.valid:
+      return
+    if self.current_hour and report.hour != self.current_hour:
+      self.PrintHourlyReport(True)
+    self.current_hour = report.hour
+    # Handle the line depending on the node type.
+    handler = self.handlers.get(report.node_id, None)
+    if handler:
+      handler(report)
+    # Keep stats about node report reliability every hour.
+    self.UpdateNodeReport(report)
+    self.MaybeCheckpoint()
+
+  def Follow(self, log_dir):
+    """Processes the logs in log_dir as they are written, until signalled.
+
+    History is saved every checkpoint_interval seconds, and on exit.
+    """
+    self.stopping = False
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      signal.signal(signum, self.StopFollowing)
+    import logwatcher
+    watcher = logwatcher.LogWatcher(log_dir)
+    files = common.ListLogs(log_dir)
+    while not self.stopping:
+      for filename in common.FilesFrom(files, self.current_file):
+        self.ProcessFile(filename)
+      self.ClosePolicies()
+      self.FlushOutput()
+      self.MaybeCheckpoint(0)
+      changed = watcher.Wait(1)
+      if changed is None:
+        files = common.ListLogs(log_dir)
+      else:
+        # A compressed log is still being written while the original exists.
+        files = [os.path.join(log_dir, name) for name in sorted(changed)
+                 if common.IsLogName(name) and not (
+                     common.IsCompressed(name) and os.path.exists(
+                         os.path.join(log_dir, common.LogName(name))))]
+    self.FinishedProcessing()
+
+  def StopFollowing(self, signum, frame):
+    self.stopping = True
+
+  def FlushOutput(self):
+    """Override in subclasses to write out any metrics still buffered."""
+    pass
+
+  def CloseOutput(self):
+    """Override in subclasses to finish writing, once given every metric."""
+    self.FlushOutput()
+
+  def FinishedProcessing(self):
+    # Print an update.
+    self.PrintHourlyReport(False)
+    # Save history
+    self.SaveHistory()
+
+  def ProcessSchema(self, schema, report):
+    """Reports the value of each field of a node type without a handler."""
+    try:
+      values = schema.Decode(report.parts)
+    except ValueError, e:
+      print 'Ignoring bad %s report ' % schema.node_type, report, e
+      return
+    state = self.GetOrCreateNodeState(report.node_id)
+    for i, metric in schema.metrics:
+      value = values[i]
+      if metric == common.BATTERY:
+        state.last_bat = int(value)
+      elif metric == common.TEMPERATURE:
+        state.temps.Add(value)
+        state.last_temp = value
+      self.AddMetric(report.node_id, metric, report.ts, value)
+
+  def BatchSchema(self, schema, node_id, records, last_ping):
+    """ProcessSchema for a node's records (see BuildBatchHandlers)."""
+    values, valid = schema.DecodeArray(records)
+    state = self.GetOrCreateNodeState(node_id)
+    metrics = []
+    columns = []
+    for i, metric in schema.metrics:
+      column = values[i][valid]
+      if len(column) and metric == common.BATTERY:
+        state.last_bat = int(column[-1])
+      elif len(column) and metric == common.TEMPERATURE:
+        state.temps.AddArray(column.astype(numpy.float64))
+        state.last_temp = column[-1].item()
+      metrics.append(metric)
+      columns.append(column.tolist())
+    return valid, metrics, columns
+
+  def ProcessTempSensor(self, report):
+    try:
+      temp, bat = self.ParseTempSensorReport(report)
+      if not stream_stats.IsFinite(temp):
+        raise ValueError('temp %r is not finite' % temp)
+    except Exception, e:
+      print 'Ignoring bad temp report ', report, e
+      return
+    state = self.GetOrCreateNodeState(report.node_id)
+    state.temps.Add(temp)
+    state.last_temp = temp
+    state.last_bat = int(bat)
+    self.AddMetric(report.node_id, common.TEMPERATURE, report.ts, temp)
+    self.AddMetric(report.node_id, common.BATTERY, report.ts, bat)
+
+  def ParseTempSensorReport(self, report):
+    schema = self.schemas['TempSensor']
+    # Short payloads are zero padded by DecodeLines, so decode (and reject)
+    # them as the per line path does.
+    if (report.decoded is not None and schema.batch_decoded and
+        len(report.parts) >= schema.struct.size):
+      values = (report.parts[0], float(report.decoded['temp']))
+      schema.Check(values)
+      return values[1], values[0]
+    return self.ParseTempSensorLine(report.parts)
+
+  def ParseTempSensorLine(self, parts):
+    schema = self.schemas['TempSensor']
+    values = schema.Decode(parts)
+    return (values[schema.index[common.TEMPERATURE]],
+            values[schema.index[common.BATTERY]])
+
+  def BatchTempSensor(self, schema, node_id, records, last_ping):
+    """ProcessTempSensor for a node's records (see BuildBatchHandlers)."""
+    # DecodeArray rejects temperatures which aren't finite, as Check does.
+    values, valid = schema.DecodeArray(records)
+    temp = values[schema.index[common.TEMPERATURE]][valid]
+    bat = values[schema.index[common.BATTERY]][valid]
+    state = self.GetOrCreateNodeState(node_id)
+    if len(temp):
+      state.temps.AddArray(temp.astype(numpy.float64))
+      state.last_temp = temp[-1].item()
+      state.last_bat = int(bat[-1])
+    return (valid, (common.TEMPERATURE, common.BATTERY),
+            (temp.tolist(), bat.tolist()))
+
+  def ProcessMeterReader(self, report):
+    try:
+      counter, bat = self.ParseMeterReport(report)
+    except Exception, e:
+      print 'Ignoring bad meter report ', report, e
+      return
+    state = self.GetOrCreateNodeState(report.node_id)
+    if state.lastline:
+      last_counter, last_bat = self.ParseMeterLine(state.lastline)
+      state.realcounter += self.CalculateStep(report.ping_id, counter,
+          last_counter, state.last_ping_id, len(report.parts))
+    else:
+      state.realcounter = counter
+      state.first_count = counter
+      state.first_ts = report.ts
+      state.hour_counter = counter
+    state.lastline = report.parts
+    state.last_bat = int(bat)
+    self.AddMetric(report.node_id, common.REVS, report.ts, state.realcounter)
+    self.AddMetric(report.node_id, common.BATTERY, report.ts, bat)
+
+  def ParseMeterReport(self, report):
+    schema = self.schemas['MeterReader']
+    if (report.decoded is not None and schema.batch_decoded and
+        len(report.parts) >= schema.struct.size):
+      values = (report.parts[0], int(report.decoded['counter']))
+      schema.Check(values)
+      return values[1], values[0]
+    return self.ParseMeterLine(report.parts)
+
+  def ParseMeterLine(self, parts):
+    if len(parts) == 2:
+      # Old format, single byte counter.
+      return int(parts[1]), int(parts[0])
+    # New format, long counter.
+    schema = self.schemas['MeterReader']
+    values = schema.Decode(parts)
+    return values[schema.index['counter']], values[schema.index[common.BATTERY]]
+
+  def BatchMeterReader(self, schema, node_id, records, last_ping):
+    """ProcessMeterReader for a node's records (see BuildBatchHandlers)."""
+    values, valid = schema.DecodeArray(records)
+    nparts = records['nparts'].astype(numpy.int64)
+    # Old format, single byte counter.
+    old = nparts == 2
+    valid |= old
+    payload = records['payload']
+    counter = numpy.where(old, payload[:, 1], values[schema.index['counter']])
+    counter = counter[valid].astype(numpy.int64)
+    bat = numpy.where(old, payload[:, 0],
+                      values[schema.index[common.BATTERY]])[valid]
+    rows = numpy.flatnonzero(valid)
+    if not len(rows):
+      return valid, (common.REVS, common.BATTERY), ([], [])
+    state = self.GetOrCreateNodeState(node_id)
+    first = not state.lastline
+    if first:
+      last_counter = counter[0]
+    else:
+      last_counter = self.ParseMeterLine(state.lastline)[0]
+    steps = self.CalculateSteps(
+        records['ping_id'][rows].astype(numpy.int64), counter,
+        numpy.concatenate(([last_counter], counter[:-1])), last_ping[rows],
+        nparts[rows])
+    if first:
+      steps[0] = 0
+      state.realcounter = int(counter[0])
+      state.first_count = int(counter[0])
+      state.first_ts = float(records['ts'][rows[0]])
+      state.hour_counter = int(counter[0])
+    realcounter = state.realcounter + numpy.cumsum(steps)
+    state.realcounter = int(realcounter[-1])
+    state.lastline = payload[rows[-1], :nparts[rows[-1]]].tolist()
+    state.last_bat = int(bat[-1])
+    return (valid, (common.REVS, common.BATTERY),
+            (realcounter.tolist(), bat.tolist()))
+
+  def CalculateStep(self, ping_id, counter, last_counter, last_ping, len_parts):
+    if ping_id == 1 or counter < last_counter:
+      # Reboot
+      return 1
+
+    if ping_id - 1 != last_ping:
+      if counter >= last_counter:
+        # Easy, just subtract.
+        return counter - last_counter
+
+      # Harder, use ping_id to judge missing reports.
+      missing = ping_id - last_ping
+      if len_parts < 13:
+        return (10 * missing) - 4   # 10 counts per report, minus 4 for wrap.
+
+      # Unlikely!
+      return missing
+
+    # Might be a wrap... Check if last counter value was high.
+    if counter == 0:
+      # Handle wrap with old-style byte counter.
+      if len_parts < 5:
+        if last_counter > ((2*8)*0.9):
+          return 6
+
+      # Handle wrap with new-style long counter.
+      if last_counter > ((2**32)*0.9):
+        return 2**32 - last_counter
+
+      # No wrap, just reset.
+      return 0
+
+    # Simple case last. Just trust the report.
+    return counter - last_counter
+
+  def CalculateSteps(self, ping_id, counter, last_counter, last_ping,
+                     len_parts):
+    """CalculateStep over arrays of reports, in a single vectorized pass."""
+    skipped = ping_id - 1 != last_ping
+    wrapped = counter == 0
+    return numpy.select(
+        [(ping_id == 1) | (counter < last_counter),
+         skipped & (counter >= last_counter),
+         skipped & (len_parts < 13),
+         skipped,
+         wrapped & (len_parts < 5) & (last_counter > ((2*8)*0.9)),
+         wrapped & (last_counter > ((2**32)*0.9)),
+         wrapped],
+        [1, counter - last_counter, (10 * (ping_id - last_ping)) - 4,
+         ping_id - last_ping, 6, 2**32 - last_counter, 0],
+        counter - last_counter)
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Benchmarks the updaters over a directory of logs (eg written by
+# synth-logs.py), reporting lines/sec and peak memory for each of:
+#   ingest  Updater.ProcessFiles, with metrics thrown away.
+#   rrd     update-rrd.py, writing RRDs into a temporary state_dir.
+#   sd      update-sd.py, posting to an in process fake-sd.py server.
+#   store   update-store.py, writing a SeriesStore into a temporary state_dir.
+#
+# Each benchmark runs in its own process, from a fresh state_dir holding just
+# the config from log_dir, so none resume from another.
+import base_updater
+import common
+import multiprocessing
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = ('ingest', 'rrd', 'sd', 'store')
+
+
+class NullUpdater(base_updater.Updater):
+  """Processes reports, without storing the metrics from them anywhere."""
+
+  def __init__(self, state_dir, debug=False):
+    super(NullUpdater, self).__init__(state_dir, None, True, debug)
+
+  def ReportMetric(self, node_id, metric, ts, value):
+    pass
+
+
+def CountLines(files):
+  lines = 0
+  for filename in files:
+    with common.OpenLog(filename) as fp:
+      for line in fp:
+        lines += 1
+  return lines
+
+
+def MakeUpdater(name, state_dir, options):
+  """Returns the updater for a benchmark, and a function to clean it up."""
+  if name == 'ingest':
+    return NullUpdater(state_dir), lambda: None
+  if name == 'rrd':
+    update_rrd = common.LoadScript('update-rrd.py')
+    updater = update_rrd.RRDUpdater(state_dir, False)
+    updater.update_batch = options.update_batch
+    return updater, lambda: None
+  if name == 'store':
+    update_store = common.LoadScript('update-store.py')
+    return update_store.StoreUpdater(state_dir, False), lambda: None
+  fake_sd = common.LoadScript('fake-sd.py')
+  update_sd = common.LoadScript('update-sd.py')
+  server = fake_sd.FakeSDServer(0, options.latency)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  updater = update_sd.SDUpdater('benchmark', 'benchmark', state_dir, False,
+      endpoint='http://127.0.0.1:%d/v3' % server.server_address[1],
+      concurrency=options.concurrency)
+  def Done():
+    server.shutdown()
+    server.PrintStats()
+  return updater, Done
+
+
+def Run(name, files, config, options, results):
+  """Runs one benchmark, putting (seconds, peak KB) or an error in results."""
+  state_dir = tempfile.mkdtemp(prefix='benchmark-%s-' % name)
+  stdout = sys.stdout
+  # The updaters are chatty, and their reports are the same each run.
+  devnull = open(os.devnull, 'w')
+  try:
+    shutil.copy(config, os.path.join(state_dir, 'config'))
+    schemas = os.path.join(os.path.dirname(config), common.SCHEMAS)
+    if os.path.exists(schemas):
+      shutil.copy(schemas, state_dir)
+    try:
+      updater, done = MakeUpdater(name, state_dir, options)
+    except ImportError, e:
+      results.put('skipped, %s' % e)
+      return
+    updater.batch = options.batch
+    if options.stats:
+      updater.Instrument()
+    sys.stdout = devnull
+    start = time.time()
+    updater.ProcessFiles(files)
+    elapsed = time.time() - start
+    sys.stdout = stdout
+    updater.FinishInstrumentation()
+    done()
+    # ru_maxrss is in KB on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, peak))
+  finally:
+    sys.stdout = stdout
+    devnull.close()
+    shutil.rmtree(state_dir, True)
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] log_dir')
+  parser.add_option('--benchmarks', action='store', dest='benchmarks',
+      default=','.join(BENCHMARKS),
+      help='Comma separated benchmarks to run, of %s' % ', '.join(BENCHMARKS))
+  parser.add_option('--runs', action='store', dest='runs', type='int',
+      default=1, help='Times to run each benchmark, reporting the fastest')
+  parser.add_option('--batch', action='store_true', dest='batch',
+      help='Decode logs with the vectorized batch decoder (needs numpy)')
+  parser.add_option('--update_batch', action='store', dest='update_batch',
+      type='int', default=0,
+      help='Write up to this many timestamps per rrdtool update call')
+  parser.add_option('--concurrency', action='store', dest='concurrency',
+      type='int', default=4,
+      help='Number of requests to the fake SD to have in flight at once')
+  parser.add_option('--latency', action='store', dest='latency', type='int',
+      default=0, help='Milliseconds the fake SD delays each response by')
+  parser.add_option('--stats', action='store_true', dest='stats',
+      help='Also print the time spent in each stage of processing')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    sys.stderr.write('Usage: %s [options] log_dir\n' % sys.argv[0])
+    sys.exit(1)
+  names = options.benchmarks.split(',')
+  for name in names:
+    if name not in BENCHMARKS:
+      parser.error('Unknown benchmark %s' % name)
+
+  log_dir = args[0]
+  files = common.ListLogs(log_dir)
+  config = os.path.join(log_dir, 'config')
+  if not files or not os.path.exists(config):
+    parser.error('%s has no logs and config to benchmark' % log_dir)
+  lines = CountLines(common.UniqueLogs(files))
+  print 'Benchmarking %d lines in %d logs' % (lines, len(files))
+  print '%-8s %10s %12s %10s' % ('name', 'seconds', 'lines/s', 'peak MB')
+  for name in names:
+    best = None
+    for run in xrange(options.runs):
+      results = multiprocessing.Queue()
+      process = multiprocessing.Process(
+          target=Run, args=(name, files, config, options, results))
+      process.start()
+      process.join()
+      if process.exitcode:
+        print '%-8s failed (exit code %d)' % (name, process.exitcode)
+        break
+      result = results.get()
+      if isinstance(result, str):
+        print '%-8s %s' % (name, result)
+        break
+      elapsed, peak = result
+      if best is None or elapsed < best[0]:
+        best = (elapsed, peak)
+    if best:
+      elapsed, peak = best
+      print '%-8s %10.2f %12.0f %10.1f' % (name, elapsed,
+                                           lines / max(elapsed, 1e-9),
+                                           peak / 1024.0)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -6,15 +6,88 @@
 # All rights reserved.
 #
 # Common code.
+import bisect
+import calendar
+import fnmatch
+import glob
+import gzip
+import imp
+import itertools
 import os
-import cPickle as pickle
+import re
+import stream_stats
 import struct
 import time
 
+# numpy is only needed by the batch decoder (apt-get install python-numpy).
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
 # Metric type constants
 TEMPERATURE = 'temp'
 BATTERY = 'bat'
 REVS = 'revs'
+# Energy metered by each revolution counted by a MeterReader.
+WH_PER_REV = 6
+
+# Number of payload bytes (after the header byte) kept per report by the batch
+# decoder. Longer payloads are truncated, but their true length is retained.
+PAYLOAD_WIDTH = 16
+# Number of lines handed to the batch decoder at once.
+BATCH_LINES = 65536
+# Number of bytes before the resume offset kept to verify it on resume.
+TAIL_BYTES = 128
+
+# Pattern matching the hourly (YYYYMMDDHH.log) log file names.
+LOG_GLOB = '[0-9]' * 10 + '.log'
+# Suffixes of compressed hourly logs, which are read as if uncompressed.
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+LOG_GLOBS = (LOG_GLOB,) + tuple(LOG_GLOB + suffix
+                                for suffix in COMPRESSED_SUFFIXES)
+
+
+# Name of the file in a state_dir which catalogs the RRDs in it.
+RRD_CATALOG = 'rrd-catalog'
+# Name of the file in a log directory which indexes the logs in it, and the
+# number of bytes between the timestamp -> offset checkpoints it keeps.
+LOG_INDEX = 'log-index'
+INDEX_CHECKPOINT_BYTES = 16384
+# Name of the file in a state_dir declaring the payload layout of node types
+# (see Schema), and the built in layouts which it may override. The built in
+# types must keep the fields their handlers use, and the batch decoder only
+# precomputes values for these layouts.
+SCHEMAS = 'schemas'
+BUILTIN_SCHEMAS = (
+    'MeterReader <BI bat counter',
+    'TempSensor <Bf bat temp::40',
+)
+REQUIRED_FIELDS = {
+    'MeterReader': (BATTERY, 'counter'),
+    'TempSensor': (BATTERY, TEMPERATURE),
+}
+# numpy types of the (little endian) struct format codes Schema.DecodeArray
+# can unpack.
+STRUCT_TYPES = {
+    'b': '<i1', 'B': '<u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4',
+    'l': '<i4', 'L': '<u4', 'q': '<i8', 'Q': '<u8', 'f': '<f4', 'd': '<f8',
+}
+
+# Layout of the structured arrays returned by DecodeLines.
+REPORT_DTYPE = [
+    ('lineno', '<i4'),
+    ('offset', '<i8'),     # Byte offset of the end of the line.
+    ('ts', '<f8'),
+    ('node_id', '<i4'),
+    ('ping_id', '<u4'),
+    ('hour', '<i4'),       # Hour bucket, ts // 3600.
+    ('nparts', '<u1'),     # Payload length, as len(Report.parts).
+    ('payload', '<u1', (PAYLOAD_WIDTH,)),
+    ('counter', '<u4'),    # MeterReader counter (old or new format).
+    ('temp', '<f4'),       # TempSensor temperature.
+]
 
 
 def LoadConfig(config_file):
@@ -24,13 +97,258 @@ def LoadConfig(config_file):
       line = fp.readline()
       if not line:
         break
-      node_id, node_type, description = line.strip().split(' ')
-      d = {'type':node_type, 'desc':description}
+      tokens = line.strip().split(' ')
+      node_id, node_type, description = tokens[:3]
+      d = {'type':node_type, 'desc':description,
+           'policies':LoadPolicies(tokens[3:])}
       nodes[int(node_id)] = d
       
   return nodes
 
 
+class Policy(object):
+  """How the values of a metric are aggregated before they are reported.
+
+  Declared after a node's description in the config as metric=kinds:step,
+  or *=kinds:step for every metric of the node without its own, eg:
+    2 TempSensor Lounge temp=mean+min+max:60 bat=last:300
+  The values in each step are reported once, at the time of the last of
+  them, as the first kind under the metric's own name, and the others as
+  metric_kind (eg temp_min).
+  """
+
+  KINDS = ('mean', 'min', 'max', 'last')
+
+  def __init__(self, kinds, step):
+    for kind in kinds:
+      if kind not in self.KINDS:
+        raise ValueError('Unknown policy %s, expected one of %s' % (
+            kind, ', '.join(self.KINDS)))
+    if step <= 0:
+      raise ValueError('Policy step must be positive')
+    self.kinds = kinds
+    self.step = step
+
+  @classmethod
+  def FromSpec(cls, spec):
+    kinds, _, step = spec.partition(':')
+    return cls(kinds.split('+'), int(step))
+
+  def Values(self, metric, bucket):
+    """Yields (metric, value) to report for a bucket (see AddToBucket)."""
+    start, ts, count, total, low, high, last = bucket
+    values = {'mean': total / float(count), 'min': low, 'max': high,
+              'last': last}
+    for i, kind in enumerate(self.kinds):
+      if i == 0:
+        yield metric, values[kind]
+      else:
+        yield '%s_%s' % (metric, kind), values[kind]
+
+
+def LoadPolicies(specs):
+  """Returns a Policy by metric (or *) from metric=kinds:step specs."""
+  policies = {}
+  for spec in specs:
+    metric, _, policy = spec.partition('=')
+    try:
+      policies[metric] = Policy.FromSpec(policy)
+    except ValueError, e:
+      raise ValueError('Bad policy %s: %s' % (spec, e))
+  return policies
+
+
+def AddToBucket(pending, metric, policy, ts, value):
+  """Adds a value to the bucket of its step in pending, by metric.
+
+  A bucket is [step start, ts, count, sum, min, max, last value]. Returns the
+  bucket of an earlier step the value replaces, which is then complete.
+  """
+  start = ts - ts % policy.step
+  bucket = pending.get(metric, None)
+  if not bucket or bucket[0] != start:
+    pending[metric] = [start, ts, 1, value, value, value, value]
+    return bucket
+  bucket[1] = ts
+  bucket[2] += 1
+  bucket[3] += value
+  bucket[4] = min(bucket[4], value)
+  bucket[5] = max(bucket[5], value)
+  bucket[6] = value
+  return None
+
+
+def LoadScript(name):
+  """Imports one of the (not importable by name) scripts next to this one."""
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+  return imp.load_source(name.replace('-', '_')[:-len('.py')], path)
+
+
+class Schema(object):
+  """The layout of the payload of a node type, and the metrics in it.
+
+  Declared as a line of the schemas file, eg:
+    WaterFlowMeter <BI bat litres:0:
+  ie the node type, a struct format for the payload bytes (after the header
+  byte), then a name for each value unpacked, as reported. Values named - are
+  not reported. name:min:max bounds a value, with either left empty for no
+  bound, and a report with any value out of bounds (or any NaN or infinite
+  float) is ignored as corrupt. A value is a gauge unless declared a counter
+  (eg litres:counter or litres:0::counter), which the updaters store as such.
+  """
+
+  KINDS = ('gauge', 'counter')
+
+  def __init__(self, node_type, layout, fields):
+    self.node_type = node_type
+    self.layout = layout
+    self.struct = struct.Struct(layout)
+    self.names = []
+    self.checks = []
+    self.kinds = {}
+    for i, field in enumerate(fields):
+      tokens = field.split(':')
+      if len(tokens) in (2, 4):
+        kind = tokens.pop()
+        if kind not in self.KINDS:
+          raise ValueError('Bad field %s, kind must be one of %s' % (
+              field, ', '.join(self.KINDS)))
+      elif len(tokens) in (1, 3):
+        kind = 'gauge'
+      else:
+        raise ValueError(
+            'Bad field %s, expected name[:min:max][:kind]' % field)
+      self.names.append(tokens[0])
+      self.kinds[tokens[0]] = kind
+      if len(tokens) == 3 and (tokens[1] or tokens[2]):
+        bounds = [float(token) if token else None for token in tokens[1:]]
+        self.checks.append((i, tokens[0], bounds[0], bounds[1]))
+    values = self.struct.unpack('\0' * self.struct.size)
+    if len(values) != len(self.names):
+      raise ValueError('%s unpacks %d values, but %d fields are named' % (
+          layout, len(values), len(self.names)))
+    # Indexes of the float values, which must be finite.
+    self.floats = [i for i, value in enumerate(values)
+                   if isinstance(value, float)]
+    self.index = dict((name, i) for i, name in enumerate(self.names))
+    # Whether DecodeLines precomputes the values (of a built in layout).
+    self.batch_decoded = False
+    # (index, name) of each value reported.
+    self.metrics = [(i, name) for i, name in enumerate(self.names)
+                    if name != '-']
+    self.dtype = LayoutDtype(layout)
+    if self.dtype is not None and (self.dtype.itemsize != self.struct.size or
+                                   self.struct.size > PAYLOAD_WIDTH):
+      self.dtype = None
+
+  @classmethod
+  def FromLine(cls, line):
+    tokens = line.split()
+    if len(tokens) < 2:
+      raise ValueError('Expected a node type, layout and fields')
+    return cls(tokens[0], tokens[1], tokens[2:])
+
+  def Decode(self, parts):
+    """Returns the values in the payload bytes (as strs or ints) of a report.
+
+    Raises ValueError if the payload is too short or a value is out of bounds.
+    """
+    try:
+      values = self.struct.unpack_from(
+          str(bytearray(map(int, parts[:self.struct.size]))))
+    except struct.error, e:
+      raise ValueError(str(e))
+    self.Check(values)
+    return values
+
+  def Check(self, values):
+    for i in self.floats:
+      if not stream_stats.IsFinite(values[i]):
+        raise ValueError('%s %r is not finite' % (self.names[i], values[i]))
+    for i, name, low, high in self.checks:
+      if low is not None and values[i] < low:
+        raise ValueError('%s %r is below %r' % (name, values[i], low))
+      if high is not None and values[i] > high:
+        raise ValueError('%s %r is above %r' % (name, values[i], high))
+
+  def DecodeArray(self, records):
+    """Decodes the payloads of DecodeLines records, as Decode does each.
+
+    Needs a dtype, ie a layout LayoutDtype can unpack. Returns a column of
+    values for each name, and whether Decode would accept each record.
+    """
+    size = self.struct.size
+    data = numpy.ascontiguousarray(records['payload'][:, :size])
+    data = data.view(self.dtype)[:, 0]
+    values = [data[name] for name in self.dtype.names]
+    valid = records['nparts'] >= size
+    for i in self.floats:
+      valid &= numpy.isfinite(values[i])
+    # NaNs compare false, so pass the bounds as in Check, failing above.
+    with numpy.errstate(invalid='ignore'):
+      for i, name, low, high in self.checks:
+        if low is not None:
+          valid &= ~(values[i] < low)
+        if high is not None:
+          valid &= ~(values[i] > high)
+    return values, valid
+
+
+def LayoutDtype(layout):
+  """Returns a numpy dtype unpacking a struct layout, or None if it can't.
+
+  Only little endian layouts of the STRUCT_TYPES codes (and x padding) can be
+  unpacked.
+  """
+  if numpy is None or not layout.startswith('<'):
+    return None
+  names, formats, offsets = [], [], []
+  offset = 0
+  for count, code in re.findall(r'(\d*)(.)', layout[1:]):
+    count = int(count or 1)
+    if code == 'x':
+      offset += count
+      continue
+    if code not in STRUCT_TYPES:
+      return None
+    for _ in xrange(count):
+      names.append('f%d' % len(names))
+      formats.append(STRUCT_TYPES[code])
+      offsets.append(offset)
+      offset += numpy.dtype(STRUCT_TYPES[code]).itemsize
+  if not names:
+    return None
+  return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                      'itemsize': offset})
+
+
+def LoadSchemas(schemas_file):
+  """Returns the built in schemas, with those declared in schemas_file."""
+  builtins = dict((schema.node_type, schema) for schema in
+                  map(Schema.FromLine, BUILTIN_SCHEMAS))
+  schemas = dict(builtins)
+  if os.path.exists(schemas_file):
+    with open(schemas_file, 'r') as fp:
+      for lineno, line in enumerate(fp, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+          continue
+        try:
+          schema = Schema.FromLine(line)
+          for name in REQUIRED_FIELDS.get(schema.node_type, ()):
+            if name not in schema.index:
+              raise ValueError('%s needs a %s field' % (
+                  schema.node_type, name))
+        except (ValueError, struct.error), e:
+          raise ValueError('%s:%d: %s' % (schemas_file, lineno, e))
+        schemas[schema.node_type] = schema
+  for node_type, builtin in builtins.iteritems():
+    schema = schemas[node_type]
+    schema.batch_decoded = (schema.layout == builtin.layout and
+                            schema.names == builtin.names)
+  return schemas
+
+
 def ParseLong(parts, offset):
   val = 0
   for byte in xrange(0, 4):
@@ -38,11 +356,215 @@ def ParseLong(parts, offset):
   return val
 
 
-def ParseFloat(parts, offset):
-  d = ''
-  for byte in xrange(0, 4):
-    d += chr(int(parts[offset+byte]))
-  return struct.unpack('<f', d)[0]
+def HourForTs(ts):
+  t = time.gmtime(ts)
+  return '%04d%02d%02d%02d' % (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour)
+
+
+def _NumericRow(row):
+  try:
+    float(row[0])
+    for token in row[1:]:
+      int(token)
+  except ValueError:
+    return False
+  return True
+
+
+def DecodeLines(lines, start_lineno=0, debug=False, start_offset=0):
+  """Decodes logger lines into a REPORT_DTYPE structured array.
+
+  Only the tokenising is done per line, the byte fields of every report are
+  converted and unpacked in a single vectorized pass.
+  """
+  if numpy is None:
+    raise RuntimeError('The batch decoder requires numpy')
+  width = PAYLOAD_WIDTH + 6
+  pad = ['0'] * PAYLOAD_WIDTH
+  linenos = []
+  nparts = []
+  rows = []
+  for lineno, line in enumerate(lines, start_lineno):
+    parts = line.split()
+    if len(parts) < 8 or parts[1] != 'OK':
+      if debug:
+        print 'Skipping bad line: %s' % line.strip()
+      continue
+    linenos.append(lineno)
+    nparts.append(len(parts) - 8)
+    # ts, node_id, 4 ping_id bytes, then the payload (skipping the header).
+    rows.append((parts[0:1] + parts[2:7] + parts[8:] + pad)[:width])
+  records = numpy.zeros(len(rows), dtype=REPORT_DTYPE)
+  if not rows:
+    return records
+  tokens = numpy.array(rows)
+  try:
+    ts = tokens[:, 0].astype(numpy.float64)
+    fields = tokens[:, 1:].astype(numpy.int64)
+    valid = numpy.ones(len(rows), dtype=bool)
+  except ValueError:
+    # Rare, fall back to finding the garbage lines one by one.
+    valid = numpy.array([_NumericRow(row) for row in rows], dtype=bool)
+    ts = numpy.zeros(len(rows), dtype=numpy.float64)
+    fields = numpy.zeros((len(rows), width - 1), dtype=numpy.int64)
+    ts[valid] = tokens[valid, 0].astype(numpy.float64)
+    fields[valid] = tokens[valid, 1:].astype(numpy.int64)
+  valid &= ((fields[:, 1:] >= 0) & (fields[:, 1:] <= 255)).all(axis=1)
+  if debug and not valid.all():
+    for i in numpy.flatnonzero(~valid):
+      print 'Skipping invalid line %d: %s' % (linenos[i], ' '.join(rows[i]))
+  records = records[:int(valid.sum())]
+  offsets = numpy.cumsum([len(line) for line in lines]) + start_offset
+  records['offset'] = offsets[numpy.array(linenos)[valid] - start_lineno]
+  data = fields[valid, 1:].astype(numpy.uint8)
+  payload = data[:, 4:]
+  word = numpy.ascontiguousarray(payload[:, 1:5])
+  nparts = numpy.array(nparts)[valid]
+  records['lineno'] = numpy.array(linenos)[valid]
+  records['ts'] = ts[valid]
+  records['node_id'] = fields[valid, 0]
+  records['ping_id'] = numpy.ascontiguousarray(data[:, 0:4]).view('<u4')[:, 0]
+  records['hour'] = (records['ts'] // 3600).astype(numpy.int32)
+  records['nparts'] = numpy.minimum(nparts, 255)
+  records['payload'] = payload
+  records['counter'] = numpy.where(nparts == 2, payload[:, 1],
+      word.view('<u4')[:, 0])
+  records['temp'] = word.view('<f4')[:, 0]
+  return records
+
+
+def DecodeFile(fp, start_lineno=0, debug=False, start_offset=0):
+  """Decodes the remaining lines in fp a chunk at a time.
+
+  Yields (records, lineno, offset) tuples, where lineno and offset are those
+  of the line following the chunk.
+  """
+  lineno = start_lineno
+  offset = start_offset
+  while True:
+    lines = list(itertools.islice(fp, BATCH_LINES))
+    if lines and not lines[-1].endswith('\n'):
+      # Still being written, leave it for next time.
+      lines.pop()
+      if not lines:
+        break
+    elif not lines:
+      break
+    records = DecodeLines(lines, lineno, debug, offset)
+    lineno += len(lines)
+    offset += sum(len(line) for line in lines)
+    yield records, lineno, offset
+
+
+def FilesFrom(files, basename):
+  """Returns the files whose basename sorts at or after basename.
+
+  files must be sorted by basename, as a shell glob of a log directory is, so
+  that the earlier files can be skipped with a binary search.
+  """
+  if not basename:
+    return files
+  lo, hi = 0, len(files)
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if os.path.basename(files[mid]) < basename:
+      lo = mid + 1
+    else:
+      hi = mid
+  return files[lo:]
+
+
+def LogName(filename):
+  """Returns the basename of a log, without any compression suffix."""
+  name = os.path.basename(filename)
+  for suffix in COMPRESSED_SUFFIXES:
+    if name.endswith(suffix):
+      return name[:-len(suffix)]
+  return name
+
+
+def IsCompressed(filename):
+  return LogName(filename) != os.path.basename(filename)
+
+
+def IsLogName(name):
+  return any(fnmatch.fnmatch(name, pattern) for pattern in LOG_GLOBS)
+
+
+def UniqueLogs(files):
+  """Drops compressed logs which are also given uncompressed.
+
+  Both exist while a log is being compressed, when only the uncompressed one
+  is complete.
+  """
+  plain = set(LogName(f) for f in files if not IsCompressed(f))
+  return [f for f in files if not IsCompressed(f) or LogName(f) not in plain]
+
+
+def ListLogs(log_dir):
+  """Returns the hourly logs, compressed or not, in log_dir in time order."""
+  files = []
+  for pattern in LOG_GLOBS:
+    files.extend(glob.glob(os.path.join(log_dir, pattern)))
+  return UniqueLogs(sorted(files))
+
+
+def OpenLog(filename):
+  """Opens a log, decompressing it on the fly if it is compressed.
+
+  Offsets into compressed logs are offsets into the uncompressed stream.
+  """
+  if filename.endswith('.gz'):
+    return gzip.open(filename, 'rb')
+  if filename.endswith('.zst'):
+    import zstdlog
+    return zstdlog.ZstdLog(filename)
+  return open(filename, 'r')
+
+
+def FileIdentity(filename):
+  st = os.stat(filename)
+  return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def ReadTail(fp, offset):
+  """Returns the TAIL_BYTES of fp preceding offset."""
+  start = max(0, offset - TAIL_BYTES)
+  fp.seek(start)
+  return fp.read(offset - start)
+
+
+def OpenResumed(filename, history):
+  """Opens filename positioned after the lines already processed.
+
+  history holds the current_file* attributes of UpdaterHistory. Returns (fp,
+  lineno, offset) for the next unprocessed line, or None if the file has not
+  changed since it was last processed.
+  """
+  if LogName(filename) != history.current_file:
+    return OpenLog(filename), 0, 0
+  offset = history.current_file_offset
+  if offset is not None and history.current_file_id == FileIdentity(filename):
+    # Compressed logs are complete, so can't have grown since.
+    if offset == history.current_file_id[1] or IsCompressed(filename):
+      return None
+  fp = OpenLog(filename)
+  lineno = history.current_file_lineno + 1
+  if offset is not None and ReadTail(fp, offset) == history.current_file_tail:
+    fp.seek(offset)
+    return fp, lineno, offset
+  # No checkpoint from an older history, or the file was rewritten, so fall
+  # back to skipping the lines already processed.
+  fp.seek(0)
+  offset = 0
+  for line in itertools.islice(fp, lineno):
+    offset += len(line)
+  return fp, lineno, offset
+
+
+def HourStart(hour):
+  """Returns the time of the start of an hour from HourForTs."""
+  return calendar.timegm(time.strptime(hour, '%Y%m%d%H'))
 
 
 def FormatHour(hour):
@@ -61,7 +583,8 @@ class NodeState(object):
     self.last_ping_id = 0
     self.num_reports = 0
     self.received_reports = 0
-    self.gaps = []
+    self.gaps = stream_stats.GapStats()
+    self.last_bat = None
     # Meter Reader attributes.
     self.first_count = 0
     self.first_ts = 0
@@ -69,7 +592,28 @@ class NodeState(object):
     self.realcounter = 0
     self.lastline = None
     # Temp Sensor attributes.
-    self.temps = []
+    self.temps = stream_stats.TempStats()
+    self.last_temp = None
+    # Metrics with a Policy, the bucket of values in their current step.
+    self.pending = {}
+
+  def __setstate__(self, state):
+    self.last_bat = None
+    self.last_temp = None
+    self.pending = {}
+    self.__dict__.update(state)
+    # gaps and temps were lists of every value before StreamStats.
+    if isinstance(self.gaps, list):
+      self.gaps = stream_stats.GapStats(self.gaps)
+    if isinstance(self.temps, list):
+      self.temps = stream_stats.TempStats(self.temps)
+
+  def ResetHour(self):
+    self.hour_counter = self.realcounter
+    self.temps = stream_stats.TempStats()
+    self.num_reports = 0
+    self.received_reports = 0
+    self.gaps = stream_stats.GapStats()
 
 
 class Report(object):
@@ -94,18 +638,35 @@ class Report(object):
         print 'Skipping invalid line: %s' % line.strip(), e
       return
     self.parts = parts[8:]
-    t = time.gmtime(self.ts)
-    self.hour = '%04d%02d%02d%02d' % (t.tm_year, t.tm_mon, t.tm_mday,
-        t.tm_hour)
+    self.hour = HourForTs(self.ts)
+    self.decoded = None
     self.valid = True
 
+  @classmethod
+  def FromRecord(cls, record, hour):
+    """Builds a report from a DecodeLines record, without re-parsing."""
+    report = cls.__new__(cls)
+    report.ts = float(record['ts'])
+    report.node_id = int(record['node_id'])
+    report.ping_id = int(record['ping_id'])
+    # Payload bytes as ints, which the Parse* helpers accept as well as strs.
+    report.parts = record['payload'][:record['nparts']].tolist()
+    report.hour = hour
+    report.decoded = record
+    report.valid = True
+    return report
+
   def __str__(self):
     return '%d@%d (%d): %s' % (self.node_id, self.ts, self.ping_id,
-        ' '.join(self.parts))
+        ' '.join(map(str, self.parts)))
 
 
 class UpdaterHistory(object):
-  """Stores the history for what has been processed to date."""
+  """Stores the history for what has been processed to date.
+
+  Histories were once pickled whole (see history_store.LoadPickleHistory),
+  which refer to this class here.
+  """
 
   def __init__(self):
     self.latest_update = {}
@@ -113,241 +674,271 @@ class UpdaterHistory(object):
     self.current_hour = None
     self.current_file = None
     self.current_file_lineno = None
+    # Byte offset after the last processed line, and the identity (inode,
+    # size, mtime) and trailing bytes of the file up to that offset.
+    self.current_file_offset = None
+    self.current_file_id = None
+    self.current_file_tail = None
 
 
-class Updater(object):
-  """Base functionality for updating a data store from the log files."""
-
-  def __init__(self, state_dir, history_file, dry_run, debug=False):
-    # self.history must be defined first to avoid infinite loop in setattr.
-    self.state_dir = state_dir
-    self.nodes = LoadConfig(os.path.join(state_dir, 'config'))
-    self.dry_run = dry_run
-    self.debug = debug
-    self.current_line = None
-    self.history_file = os.path.join(state_dir, history_file)
-    if self.history_file and os.path.exists(self.history_file):
-      self.history = pickle.load(file(self.history_file, 'rb'))
-      print 'Loaded history from %s. Current Hour: %s. Processing %s@%s' % (
-          self.history_file, self.current_hour, self.current_file,
-          self.current_file_lineno)
-    else:
-      self.history = UpdaterHistory()
-
-  def ReportMetric(self, node_id, metric, ts, value):
-    """Override in subclasses for updater specific logic to store metric."""
-    raise RuntimeError('Unimplemented')
-
-  def __getattr__(self, name):
-    """Delegate to the history object for any attributes it defines."""
-    history = self.__dict__.get('history', None)
-    if not hasattr(history, name):
-      raise AttributeError('%s is not a history attribute' % name)
-    return getattr(history, name)
-
-  def __setattr__(self, name, value):
-    """Save to the history object for any attributes it defines."""
-    history = self.__dict__.get('history', None)
-    if hasattr(history, name):
-      setattr(history, name, value)
-    else:
-      self.__dict__[name] = value
-
-  def SaveHistory(self):
-    if self.dry_run or not self.history_file:
-      return True
-    fp = open('%s.tmp' % self.history_file, 'wb')
-    pickle.dump(self.history, fp, pickle.HIGHEST_PROTOCOL)
-    fp.close()
-    os.rename('%s.tmp' % self.history_file, self.history_file)
-    print 'History saved to %s' % self.history_file
-
-  def GetOrCreateNodeState(self, node_id):
-    if node_id not in self.node_state:
-      self.node_state[node_id] = NodeState()
-    return self.node_state[node_id]
-
-  def UpdateNodeReport(self, report):
-    state = self.GetOrCreateNodeState(report.node_id)
-    if state.last_ts > 0:
-      if (int(state.last_ts/3600)*3600) == (int(report.ts/3600)*3600):
-        state.gaps.append(report.ts - state.last_ts)
-      if report.ping_id > (state.last_ping_id + 1):
-        state.num_reports += report.ping_id - state.last_ping_id
-    state.num_reports += 1
-    state.received_reports += 1
-    # Store state for future.
-    state.last_ping_id = report.ping_id
-    state.last_ts = report.ts
-
-  def CalcHourlyAverage(self, node_id, state, just, reset):
-    a = '% 2d: ' % node_id
-    if self.nodes[node_id]['type'] == 'MeterReader':
-      usage = state.realcounter - state.hour_counter
-      a += '%.02fkWh' % (usage*6/1000.0)
-    elif self.nodes[node_id]['type'] == 'TempSensor':
-      if len(state.temps) > 0:
-        a += '%.02f°C' % (sum(state.temps) / len(state.temps))
-        just += 1  # degree confuses ljust... sigh.
-    if reset:
-      state.hour_counter = state.realcounter
-      state.temps = []
-      state.num_reports = 0
-      state.received_reports = 0
-      state.gaps = []
-    return a.ljust(just)
-
-  def PrintHourlyReport(self, reset=False):
-    reliability = []
-    averages = []
-    for node_id in sorted(self.nodes.keys()):
-      state = self.GetOrCreateNodeState(node_id)
-      health = freq = '   NaN'
-      if state.num_reports > 0:
-        health = '% 5d%%' % int(
-            float(state.received_reports) / float(state.num_reports) * 100.0)
-        if len(state.gaps) > 0:
-          freq = '% 5ds' % (sum(state.gaps) / float(len(state.gaps)))
-      debug = ''
-      if self.debug:
-        debug = ' (% 3d/% 3d)' % (state.received_reports, state.num_reports)
-      t = '% 2d:%s @%s%s' % (node_id, health, freq, debug)
-      reliability.append(t)
-      averages.append(self.CalcHourlyAverage(node_id, state, len(t), reset))
-    hour = FormatHour(self.current_hour)
-    print '%s: Reports : %s' % (hour, ' '.join(reliability))
-    print '%s: Averages: %s' % (hour, ' '.join(averages))
-
-  def PrintMeterSummary(self):
-    for node_id, node in self.nodes.iteritems():
-      if node['type'] != 'MeterReader':
-        continue
-      state = self.GetOrCreateNodeState(node_id)
-      usage = state.realcounter - state.first_count
-      print '%s: Kwh from %s til %s: %.02fkWh' % (
-          node['desc'],
-          time.ctime(state.first_ts), time.ctime(state.last_ts),
-          usage*6/1000.0)
-
-  def ProcessFiles(self, files):
-    hist_file = self.current_file
-    hist_lineno = self.current_file_lineno
-    for filename in files:
-      basename = os.path.basename(filename)
-      if hist_file and basename < hist_file:
-        #print 'Skipping %s, already processed' % basename
-        continue
-      self.current_file = basename
-      for lineno, line in enumerate(open(filename, 'r')):
-        if hist_file == self.current_file:
-          if lineno <= hist_lineno:
-            #print 'Skipping line %d in %s, already processed' % (lineno, basename)
-            continue
-        self.current_file_lineno = lineno
-        self.current_line = line
-        report = Report(line, self.debug)
-        if not report.valid:
-          continue
-        if self.current_hour and report.hour != self.current_hour:
-          self.PrintHourlyReport(True)
-        self.current_hour = report.hour
-        # Handle the line depending on the node type.
-        handler = self.nodes.get(report.node_id, {}).get('type', None)
-        if handler:
-          handler_func = getattr(self, 'Process%s' % handler)
-          handler_func(report)
-        # Keep stats about node report reliability every hour.
-        self.UpdateNodeReport(report)
-    self.FinishedProcessing()
-
-  def FinishedProcessing(self):
-    # Print an update.
-    self.PrintHourlyReport(False)
-    # Save history
-    self.SaveHistory()
-
-  def ProcessTempSensor(self, report):
-    try:
-      temp, bat = self.ParseTempSensorLine(report.parts)
-      if temp > 40.0:
-        raise RuntimeError('Temp too high to be believable!')
-    except Exception, e:
-      print 'Ignoring bad temp report ', report, e
-      return
-    state = self.GetOrCreateNodeState(report.node_id)
-    state.temps.append(temp)
-    self.ReportMetric(report.node_id, TEMPERATURE, report.ts, temp)
-    self.ReportMetric(report.node_id, BATTERY, report.ts, bat)
+class RRDInfo(object):
+  """The schema and last update time of a single RRD."""
 
-  def ParseTempSensorLine(self, parts):
-    bat = int(parts[0])
-    temp = ParseFloat(parts, 1)
-    return temp, bat
+  def __init__(self, ds, ds_type, step, rras, last):
+    self.ds = ds
+    self.ds_type = ds_type
+    self.step = int(step)
+    self.rras = tuple(rras)
+    self.last = int(last)
 
-  def ProcessMeterReader(self, report):
-    try:
-      counter, bat = self.ParseMeterLine(report.parts)
-    except Exception, e:
-      print 'Ignoring bad meter report ', report, e
+  def __str__(self):
+    return '%s %s %d %d %s' % (self.ds, self.ds_type, self.step, self.last,
+                               ','.join(self.rras))
+
+
+class RRDCatalog(object):
+  """Records the RRDs in a state_dir, so readers need not open each one.
+
+  The catalog is a text file with a line per RRD of the form:
+    <rrd filename> <ds> <ds type> <step> <last update> <rra,rra,...>
+  """
+
+  def __init__(self, state_dir):
+    self.filename = os.path.join(state_dir, RRD_CATALOG)
+    self.rrds = {}
+    self.dirty = False
+    if os.path.exists(self.filename):
+      with open(self.filename, 'r') as fp:
+        for line in fp:
+          name, ds, ds_type, step, last, rras = line.strip().split(' ')
+          self.rrds[name] = RRDInfo(ds, ds_type, step, rras.split(','), last)
+
+  def Get(self, rrd):
+    return self.rrds.get(os.path.basename(rrd), None)
+
+  def Add(self, rrd, info):
+    self.rrds[os.path.basename(rrd)] = info
+    self.dirty = True
+
+  def SetLast(self, rrd, last):
+    info = self.Get(rrd)
+    if info and last > info.last:
+      info.last = int(last)
+      self.dirty = True
+
+  def Save(self):
+    if not self.dirty:
       return
-    state = self.GetOrCreateNodeState(report.node_id)
-    if state.lastline:
-      last_counter, last_bat = self.ParseMeterLine(state.lastline)
-      state.realcounter += self.CalculateStep(report.ping_id, counter,
-          last_counter, state.last_ping_id, len(report.parts))
-    else:
-      state.realcounter = counter
-      state.first_count = counter
-      state.first_ts = report.ts
-      state.hour_counter = counter
-    state.lastline = report.parts
-    self.ReportMetric(report.node_id, REVS, report.ts, state.realcounter)
-    self.ReportMetric(report.node_id, BATTERY, report.ts, bat)
-
-  def ParseMeterLine(self, parts):
-    bat = int(parts[0])
-    if len(parts) == 2:
-      # Old format, single byte counter.
-      counter = int(parts[1])
-    elif len(parts) >= 5:
-      # New format, long counter.
-      counter = ParseLong(parts, 1)
-    return counter, bat
-
-  def CalculateStep(self, ping_id, counter, last_counter, last_ping, len_parts):
-    if ping_id == 1 or counter < last_counter:
-      # Reboot
-      return 1
-
-    if ping_id - 1 != last_ping:
-      if counter >= last_counter:
-        # Easy, just subtract.
-        return counter - last_counter
-
-      # Harder, use ping_id to judge missing reports.
-      missing = ping_id - last_ping
-      if len_parts < 13:
-        return (10 * missing) - 4   # 10 counts per report, minus 4 for wrap.
-
-      # Unlikely!
-      return missing
-
-    # Might be a wrap... Check if last counter value was high.
-    if counter == 0:
-      # Handle wrap with old-style byte counter.
-      if len_parts < 5:
-        if last_counter > ((2*8)*0.9):
-          return 6
-
-      # Handle wrap with new-style long counter.
-      if last_counter > ((2**32)*0.9):
-        return 2**32 - last_counter
-
-      # No wrap, just reset.
-      return 0
-
-    # Simple case last. Just trust the report.
-    return counter - last_counter
+    with open('%s.tmp' % self.filename, 'w') as fp:
+      for name in sorted(self.rrds.keys()):
+        fp.write('%s %s\n' % (name, self.rrds[name]))
+    os.rename('%s.tmp' % self.filename, self.filename)
+    self.dirty = False
+
+
+class LogFileInfo(object):
+  """The time bounds, per node report counts and offset checkpoints of a log.
+
+  Checkpoints are (ts, offset) pairs for the line starting at offset, at
+  least INDEX_CHECKPOINT_BYTES apart. indexed is the offset the file has been
+  indexed up to.
+  """
+
+  def __init__(self, ino, size, mtime, indexed=0, first=None, last=None,
+               counts=None, checkpoints=None):
+    self.ino = int(ino)
+    self.size = int(size)
+    self.mtime = float(mtime)
+    self.indexed = int(indexed)
+    self.first = first
+    self.last = last
+    self.counts = counts or {}
+    self.checkpoints = checkpoints or []
+
+  @classmethod
+  def FromString(cls, line):
+    ino, size, mtime, indexed, first, last, counts, checkpoints = line.split()
+    info = cls(ino, size, mtime, indexed)
+    if first != '-':
+      info.first = float(first)
+      info.last = float(last)
+    if counts != '-':
+      for count in counts.split(','):
+        node_id, n = count.split('=')
+        info.counts[int(node_id)] = int(n)
+    if checkpoints != '-':
+      for checkpoint in checkpoints.split(','):
+        ts, offset = checkpoint.split('@')
+        info.checkpoints.append((float(ts), int(offset)))
+    return info
+
+  def __str__(self):
+    counts = ','.join('%d=%d' % (node_id, self.counts[node_id])
+                      for node_id in sorted(self.counts.keys()))
+    checkpoints = ','.join('%r@%d' % checkpoint
+                           for checkpoint in self.checkpoints)
+    return '%d %d %r %d %s %s %s %s' % (self.ino, self.size, self.mtime,
+        self.indexed, self.first is None and '-' or repr(self.first),
+        self.last is None and '-' or repr(self.last), counts or '-',
+        checkpoints or '-')
+
+  def Overlaps(self, start=None, end=None, node_ids=None):
+    if self.first is None:
+      return False
+    if start is not None and self.last < start:
+      return False
+    if end is not None and self.first >= end:
+      return False
+    if node_ids is not None and not any(self.counts.get(node_id)
+                                        for node_id in node_ids):
+      return False
+    return True
+
+  def Range(self, start=None, end=None):
+    """Returns the (begin, end) offsets holding the lines in [start, end)."""
+    times = [ts for ts, _ in self.checkpoints]
+    begin = 0
+    if start is not None:
+      i = bisect.bisect_left(times, start)
+      if i:
+        begin = self.checkpoints[i - 1][1]
+    finish = self.indexed
+    if end is not None:
+      i = bisect.bisect_left(times, end)
+      if i < len(times):
+        finish = self.checkpoints[i][1]
+    return begin, finish
+
+
+class LogIndex(object):
+  """A sidecar index of the time bounds and contents of a log directory.
+
+  The index is a text file with a line per log of the form:
+    <log filename> <ino> <size> <mtime> <indexed offset> <first ts> <last ts>
+        <node_id=count,...> <ts@offset,...>
+  Logs which have grown since they were indexed are indexed from where the
+  index got up to, others only if they have been replaced.
+  """
+
+  def __init__(self, log_dir):
+    self.log_dir = log_dir
+    self.filename = os.path.join(log_dir, LOG_INDEX)
+    self.files = {}
+    self.dirty = False
+    if os.path.exists(self.filename):
+      with open(self.filename, 'r') as fp:
+        for line in fp:
+          name, rest = line.strip().split(' ', 1)
+          self.files[name] = LogFileInfo.FromString(rest)
+
+  def Update(self):
+    """Brings the index up to date with the logs, returning self."""
+    names = set()
+    for path in ListLogs(self.log_dir):
+      name = os.path.basename(path)
+      names.add(name)
+      ino, size, mtime = FileIdentity(path)
+      info = self.files.get(name, None)
+      if info and info.ino == ino and info.size == size:
+        continue
+      if not info or info.ino != ino or size < info.size:
+        info = LogFileInfo(ino, size, mtime)
+      self.IndexFile(path, info)
+      info.size = size
+      info.mtime = mtime
+      self.files[name] = info
+      self.dirty = True
+    for name in set(self.files.keys()) - names:
+      del self.files[name]
+      self.dirty = True
+    return self
+
+  def IndexFile(self, path, info):
+    offset = info.indexed
+    next_checkpoint = 0
+    if info.checkpoints:
+      next_checkpoint = info.checkpoints[-1][1] + INDEX_CHECKPOINT_BYTES
+    with OpenLog(path) as fp:
+      fp.seek(offset)
+      while True:
+        line = fp.readline()
+        if not line.endswith('\n'):
+          # Still being written (or the end), leave it for next time.
+          break
+        parts = line.split()
+        try:
+          ts = float(parts[0])
+        except (ValueError, IndexError):
+          offset += len(line)
+          continue
+        if offset >= next_checkpoint:
+          info.checkpoints.append((ts, offset))
+          next_checkpoint = offset + INDEX_CHECKPOINT_BYTES
+        if info.first is None or ts < info.first:
+          info.first = ts
+        if info.last is None or ts > info.last:
+          info.last = ts
+        if len(parts) >= 8 and parts[1] == 'OK':
+          try:
+            node_id = int(parts[2])
+            info.counts[node_id] = info.counts.get(node_id, 0) + 1
+          except ValueError:
+            pass
+        offset += len(line)
+    info.indexed = offset
+
+  def Save(self):
+    if not self.dirty:
+      return
+    with open('%s.tmp' % self.filename, 'w') as fp:
+      for name in sorted(self.files.keys()):
+        fp.write('%s %s\n' % (name, self.files[name]))
+    os.rename('%s.tmp' % self.filename, self.filename)
+    self.dirty = False
+
+  def Files(self, start=None, end=None, node_ids=None):
+    """Returns the logs holding reports in [start, end) from node_ids."""
+    return [os.path.join(self.log_dir, name)
+            for name in sorted(self.files.keys())
+            if self.files[name].Overlaps(start, end, node_ids)]
+
+  def Ranges(self, start=None, end=None, node_ids=None):
+    """Yields (log filename, begin, end) byte ranges to read for a query."""
+    for name in sorted(self.files.keys()):
+      info = self.files[name]
+      if info.Overlaps(start, end, node_ids):
+        begin, finish = info.Range(start, end)
+        yield os.path.join(self.log_dir, name), begin, finish
+
+  def Lines(self, start=None, end=None, node_ids=None):
+    """Yields the log lines of reports in [start, end) from node_ids."""
+    for filename, begin, finish in self.Ranges(start, end, node_ids):
+      with OpenLog(filename) as fp:
+        fp.seek(begin)
+        offset = begin
+        while offset < finish:
+          line = fp.readline()
+          if not line:
+            break
+          offset += len(line)
+          parts = line.split(' ', 3)
+          try:
+            ts = float(parts[0])
+          except ValueError:
+            continue
+          if start is not None and ts < start:
+            continue
+          if end is not None and ts >= end:
+            break
+          if node_ids is not None:
+            if len(parts) < 3 or parts[1] != 'OK':
+              continue
+            try:
+              if int(parts[2]) not in node_ids:
+                continue
+            except ValueError:
+              continue
+          yield line
 
 
 # Vim modeline
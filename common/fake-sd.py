@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2016 - Matt Brown
+#
+# All rights reserved.
+#
+# A fake SD timeSeries endpoint, for testing and benchmarking update-sd.py
+# without talking to Google. Enforces the same per request limits as SD.
+import BaseHTTPServer
+import json
+import optparse
+import random
+import SocketServer
+import sys
+import threading
+import time
+
+# SD accepts at most this many time series per request.
+MAX_SERIES = 200
+
+
+def SeriesKey(series):
+  metric = series.get('metric', {})
+  return (metric.get('type'), tuple(sorted(metric.get('labels', {}).items())))
+
+
+class FakeSDServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Accepts timeSeries writes and keeps count of them."""
+
+  daemon_threads = True
+
+  def __init__(self, port, latency=0, error_rate=0, debug=False):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                       FakeSDHandler)
+    self.latency = latency
+    self.error_rate = error_rate
+    self.debug = debug
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.points = 0
+    self.rejected = 0
+    self.errors = 0
+    self.last_end = {}
+
+  def Check(self, data):
+    """Returns an error string if data is not a valid write, else None."""
+    series_list = data.get('timeSeries', [])
+    if not series_list:
+      return 'No timeSeries'
+    if len(series_list) > MAX_SERIES:
+      return '%d timeSeries exceeds limit of %d' % (len(series_list),
+                                                    MAX_SERIES)
+    keys = set()
+    for series in series_list:
+      key = SeriesKey(series)
+      if key in keys:
+        return 'Duplicate timeSeries %s in one request' % (key,)
+      keys.add(key)
+      if len(series.get('points', [])) != 1:
+        return 'Each timeSeries must have exactly one point'
+    with self.lock:
+      ends = {}
+      for series in series_list:
+        key = SeriesKey(series)
+        end = series['points'][0]['interval']['endTime']
+        if key in self.last_end and end <= self.last_end[key]:
+          return 'Point %s for %s is not after %s' % (end, key,
+                                                       self.last_end[key])
+        ends[key] = end
+      self.last_end.update(ends)
+      self.requests += 1
+      self.points += len(series_list)
+    return None
+
+  def PrintStats(self):
+    print 'Accepted %d points in %d requests (%d rejected, %d errors)' % (
+        self.points, self.requests, self.rejected, self.errors)
+
+
+class FakeSDHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Buffer each response so it goes out in one packet.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_POST(self):
+    server = self.server
+    body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    if server.latency:
+      time.sleep(server.latency / 1000.0)
+    if not self.path.endswith('/timeSeries'):
+      self.Reply(404, {'error': 'Unknown path %s' % self.path})
+      return
+    if server.error_rate and random.random() < server.error_rate:
+      with server.lock:
+        server.errors += 1
+      self.Reply(503, {'error': 'Injected error'})
+      return
+    try:
+      error = server.Check(json.loads(body))
+    except (ValueError, KeyError, AttributeError, TypeError), e:
+      error = 'Malformed request: %s' % e
+    if error:
+      with server.lock:
+        server.rejected += 1
+      if server.debug:
+        print error
+      self.Reply(400, {'error': error})
+      return
+    self.Reply(200, {})
+
+  def Reply(self, code, data):
+    body = json.dumps(data)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if self.server.debug:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--debug', action='store_true', dest='debug')
+  parser.add_option('--port', action='store', dest='port', type='int',
+      default=8086)
+  parser.add_option('--latency', action='store', dest='latency', type='int',
+      default=0, help='Milliseconds to delay each response by')
+  parser.add_option('--error_rate', action='store', dest='error_rate',
+      type='float', default=0,
+      help='Fraction of requests to fail with a retryable error')
+  options, args = parser.parse_args()
+  if args:
+    sys.stderr.write('Usage: %s [--port n] [--latency ms] [--error_rate f]\n' %
+        sys.argv[0])
+    sys.exit(1)
+
+  server = FakeSDServer(options.port, options.latency, options.error_rate,
+                        options.debug)
+  print 'Listening on http://127.0.0.1:%d/' % options.port
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.PrintStats()
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Keeps the history of what an Updater has processed, in SQLite.
+import common
+import cPickle as pickle
+import sqlite3
+
+
+class HistoryStore(object):
+  """Persists an UpdaterHistory in SQLite, only writing what has changed.
+
+  Node states are pickled into a row each, and latest_update entries (which
+  never change once recorded) into a row per rrd. The remaining history
+  attributes are pickled into a row each in the history table.
+  """
+
+  SCHEMA = """
+    CREATE TABLE IF NOT EXISTS history (name TEXT PRIMARY KEY, value BLOB);
+    CREATE TABLE IF NOT EXISTS node_state (
+        node_id INTEGER PRIMARY KEY, state BLOB);
+    CREATE TABLE IF NOT EXISTS latest_update (rrd TEXT PRIMARY KEY, ts REAL);
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    # An updater used as a Sink target saves from the sink's thread, though
+    # never from two threads at once.
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.executescript(self.SCHEMA)
+    self.saved_rrds = set()
+
+  def Load(self):
+    history = common.UpdaterHistory()
+    for name, value in self.db.execute('SELECT name, value FROM history'):
+      setattr(history, name, pickle.loads(str(value)))
+    for node_id, state in self.db.execute(
+        'SELECT node_id, state FROM node_state'):
+      history.node_state[node_id] = pickle.loads(str(state))
+    for rrd, ts in self.db.execute('SELECT rrd, ts FROM latest_update'):
+      history.latest_update[rrd] = ts
+      self.saved_rrds.add(rrd)
+    return history
+
+  def Save(self, history, node_ids):
+    """Saves history in a single transaction, with the given node states."""
+    attrs = [(name, Blob(value)) for name, value in history.__dict__.iteritems()
+             if name not in ('node_state', 'latest_update')]
+    states = [(node_id, Blob(history.node_state[node_id]))
+              for node_id in node_ids if node_id in history.node_state]
+    rrds = [(rrd, ts) for rrd, ts in history.latest_update.iteritems()
+            if rrd not in self.saved_rrds]
+    with self.db:
+      self.db.executemany('INSERT OR REPLACE INTO history VALUES (?, ?)',
+                          attrs)
+      self.db.executemany('INSERT OR REPLACE INTO node_state VALUES (?, ?)',
+                          states)
+      self.db.executemany('INSERT OR REPLACE INTO latest_update VALUES (?, ?)',
+                          rrds)
+    self.saved_rrds.update(rrd for rrd, ts in rrds)
+
+  def Close(self):
+    """Closes the database, leaving no write-ahead log beside it."""
+    self.db.close()
+
+
+def Blob(value):
+  return buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def LoadPickleHistory(pickle_file):
+  history = pickle.load(file(pickle_file, 'rb'))
+  # Default any attributes added since the history was saved.
+  for name, value in common.UpdaterHistory().__dict__.iteritems():
+    if not hasattr(history, name):
+      setattr(history, name, value)
+  return history
+
+
+def ImportPickleHistory(pickle_file, history_file):
+  """One-time import of a history pickle into a new HistoryStore."""
+  history = LoadPickleHistory(pickle_file)
+  store = HistoryStore(history_file)
+  store.Save(history, history.node_state.keys())
+  print 'Imported history from %s into %s' % (pickle_file, history_file)
+  return store
+
+
+def SelfTest():
+  """Checks a checkpointed history resumes as saved, and a pickle imports."""
+  import os
+  import shutil
+  import tempfile
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, 'history.db')
+    history = common.UpdaterHistory()
+    for node_id in (1, 2, 3):
+      state = history.node_state[node_id] = common.NodeState()
+      state.last_ts = 1500000000 + node_id
+      state.gaps.Add(60.0 * node_id)
+    history.latest_update['1-bat.rrd'] = 1500000001
+    history.current_file = 'log.2017071400'
+    history.current_file_offset = 1234
+    store = HistoryStore(filename)
+    store.Save(history, history.node_state.keys())
+    # Later checkpoints only write the nodes which have changed.
+    history.node_state[2].last_ts += 60
+    history.node_state[3].last_ts += 60
+    history.latest_update['2-bat.rrd'] = 1500000062
+    history.current_file_offset = 5678
+    store.Save(history, [2])
+    store.Close()
+
+    store = HistoryStore(filename)
+    resumed = store.Load()
+    assert resumed.current_file == 'log.2017071400'
+    assert resumed.current_file_offset == 5678
+    assert resumed.latest_update == history.latest_update
+    assert [resumed.node_state[n].last_ts for n in (1, 2, 3)] == [
+        1500000001, 1500000062, 1500000003]
+    gaps = resumed.node_state[2].gaps
+    assert gaps.buckets == history.node_state[2].gaps.buckets
+    assert store.saved_rrds == set(history.latest_update)
+    store.Close()
+
+    pickle_file = os.path.join(directory, 'history.pickle')
+    del history.current_file_tail
+    pickle.dump(history, file(pickle_file, 'wb'))
+    store = ImportPickleHistory(pickle_file, os.path.join(directory, 'new.db'))
+    imported = store.Load()
+    assert imported.current_file_tail is None
+    assert imported.node_state[3].last_ts == 1500000063
+    store.Close()
+  finally:
+    shutil.rmtree(directory)
+  print 'OK'
+
+
+if __name__ == "__main__":
+  SelfTest()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Times, and optionally profiles, the stages of an Updater run (--stats).
+import cProfile
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+
+
+# Number of entries of profiles to print.
+PROFILE_ENTRIES = 25
+
+
+class Instrumentation(object):
+  """Times the stages of an Updater run, and optionally profiles it.
+
+  Each stage is a wrapped method or function. Stages nest, so the time of a
+  stage is also reported less that of the stages called from it (self).
+  """
+
+  def __init__(self, state_dir, profile=False):
+    self.state_dir = state_dir
+    self.profiler = profile and cProfile.Profile() or None
+    self.wrapped = []
+    self.calls = {}
+    self.items = {}
+    self.total = {}
+    self.own = {}
+    # Time spent in the stages called from each stage currently running.
+    self.stack = []
+    self.start = None
+
+  def Wrap(self, obj, name, stage, items=None):
+    """Replaces obj.name with a version which times itself as stage.
+
+    items, if given, returns the number of reports handled by a call from
+    its arguments, otherwise each call is one.
+    """
+    original = getattr(obj, name)
+    for table in (self.calls, self.items, self.total, self.own):
+      table.setdefault(stage, 0)
+    def Timed(*args, **kwargs):
+      self.stack.append(0.0)
+      start = time.time()
+      try:
+        return original(*args, **kwargs)
+      finally:
+        elapsed = time.time() - start
+        children = self.stack.pop()
+        self.calls[stage] += 1
+        self.items[stage] += items(*args, **kwargs) if items else 1
+        self.total[stage] += elapsed
+        self.own[stage] += elapsed - children
+        if self.stack:
+          self.stack[-1] += elapsed
+    self.wrapped.append((obj, name, original, name in vars(obj)))
+    setattr(obj, name, Timed)
+
+  def Start(self):
+    self.start = time.time()
+    # Long runs can be checked on with kill -USR1.
+    signal.signal(signal.SIGUSR1, self.DumpStacks)
+    if self.profiler:
+      self.profiler.enable()
+
+  def Stop(self, reports_stage='dispatch'):
+    """Unwraps the stages, and prints their times and any profiles."""
+    if self.profiler:
+      self.profiler.disable()
+    for obj, name, original, own in reversed(self.wrapped):
+      if own:
+        setattr(obj, name, original)
+      else:
+        # A method, which the class provides again once this is gone.
+        delattr(obj, name)
+    self.wrapped = []
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    self.PrintStages(sys.stdout, reports_stage)
+    stamp = time.strftime('%Y%m%d%H%M%S')
+    if self.profiler:
+      filename = os.path.join(self.state_dir, 'profile-%s.pstats' % stamp)
+      self.profiler.dump_stats(filename)
+      print 'Profile saved to %s' % filename
+      stats = pstats.Stats(self.profiler, stream=sys.stdout)
+      stats.sort_stats('cumulative').print_stats(PROFILE_ENTRIES)
+
+  def PrintStages(self, out, reports_stage='dispatch'):
+    wall = time.time() - self.start
+    out.write('%-16s %9s %10s %10s %7s %9s\n' % (
+        'stage', 'calls', 'total s', 'self s', 'self %', 'us/call'))
+    for stage in sorted(self.calls, key=lambda s: -self.own[s]):
+      calls = self.calls[stage]
+      if not calls:
+        continue
+      out.write('%-16s %9d %10.3f %10.3f %6.1f%% %9.1f\n' % (
+          stage, calls, self.total[stage], self.own[stage],
+          100.0 * self.own[stage] / max(wall, 1e-9),
+          1e6 * self.total[stage] / calls))
+    reports = self.items.get(reports_stage, 0)
+    out.write('%d reports in %.2fs wall, %.0f reports/s\n' % (
+        reports, wall, reports / max(wall, 1e-9)))
+
+  def DumpStacks(self, signum, frame):
+    """Prints the stack of every thread, and the stage times so far."""
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    for ident, stack in sys._current_frames().items():
+      sys.stderr.write('Thread %s (%s):\n' % (names.get(ident, '?'), ident))
+      sys.stderr.write(''.join(traceback.format_stack(stack)))
+    self.PrintStages(sys.stderr)
+    sys.stderr.flush()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -6,37 +6,286 @@
 #
 # Requires pySerial (apt-get install python-serial).
 #
-# Logs packets written to the serial port by the Jeelink receiving packets from
-# the Jeenode running MeterReader.ino. Assumes the Jeelink is running something
-# like the RF12demo sketch from Jeelib.
-import fcntl
+# Logs packets written to serial ports, by the Jeelink receiving packets from
+# the Jeenodes running MeterReader.ino (which is assumed to be running
+# something like the RF12demo sketch from Jeelib), and by other Arduinos such
+# as the one controlling the water level sensor.
+#
+# Each port is given as [raw:]device[=logdir]. Lines are written with a
+# timestamp prefix to hourly files in logdir, or to stdout if there is no
+# logdir. Ports are Jeelinks, which are put into quiet mode, unless prefixed
+# with raw:. Devices outside /dev (eg a FIFO) are read as is, for testing.
+#
+# With --compress, each hourly log is compressed once it is closed. The
+# updaters and stats.py read compressed logs as if they were not.
+import errno
+import optparse
 import os
 import select
 import serial
+import signal
+import stream_stats
+import subprocess
 import sys
+import syslog
 import time
-  
+
+BAUD = 57600
+# Lines longer than this are bogus, and dropped.
+MAX_LINE = 1024
+# Display the help (to assist with verifying config settings), then enter
+# quiet mode (don't report corrupted packets).
+JEELINK_INIT = 'h\n1 q\n'
+# Seconds between reports of capture latency to syslog.
+REPORT_INTERVAL = 3600
+# Resolution of the latency sketch (relative, ie 5%).
+LATENCY_RESOLUTION = 0.05
+# Commands to compress a closed log in place with, by --compress format.
+COMPRESSORS = {
+    'gz': ['nice', 'gzip', '-q'],
+    'zst': ['nice', 'zstd', '-q', '--rm'],
+}
+
+
+class Port(object):
+  """A serial device, and the hourly logs of the lines read from it.
+
+  Records the latency from each line being read until it has been flushed
+  (and if requested, synced) to its log.
+  """
+
+  def __init__(self, spec):
+    self.jeelink = True
+    if spec.startswith('raw:'):
+      self.jeelink = False
+      spec = spec[len('raw:'):]
+    self.device, _, self.logdir = spec.partition('=')
+    self.serial = None
+    self.fd = None
+    self.buf = ''
+    self.valid = True
+    self.out = None
+    self.hour = None
+    # Read times of the lines written to out, but not yet flushed.
+    self.pending = []
+    self.fsync = False
+    self.compress = None
+    self.compressing = []
+    self.latency = stream_stats.StreamStats(LATENCY_RESOLUTION, True)
+
+  def Open(self):
+    if self.device.startswith('/dev/'):
+      self.serial = serial.Serial(self.device, BAUD, timeout=0)
+      self.fd = self.serial.fileno()
+      if self.jeelink:
+        time.sleep(2)
+        self.serial.write(JEELINK_INIT)
+    else:
+      self.fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+    if not self.logdir:
+      self.out = sys.stdout
+    syslog.syslog('Reading %s' % self.device)
+
+  def Close(self):
+    if self.serial:
+      self.serial.close()
+    elif self.fd is not None:
+      os.close(self.fd)
+    if self.out and self.out is not sys.stdout:
+      self.out.close()
+
+  def Read(self, now):
+    """Logs the complete lines available, returns False at end of file."""
+    try:
+      data = os.read(self.fd, 4096)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EINTR):
+        return True
+      raise
+    if not data:
+      return False
+    self.buf += data
+    while True:
+      nl = self.buf.find('\n')
+      if nl == -1:
+        break
+      if self.valid and nl < MAX_LINE:
+        self.Write(now, self.buf[:nl])
+      self.buf = self.buf[nl+1:]
+      # The start of a new (maybe valid) line.
+      self.valid = True
+    if len(self.buf) >= MAX_LINE:
+      # Drop the buffer, and keep dropping until the next newline is seen.
+      self.buf = ''
+      self.valid = False
+    return True
+
+  def Write(self, now, line):
+    if self.logdir:
+      hour = time.strftime('%Y%m%d%H', time.gmtime(now))
+      if hour != self.hour:
+        self.Rotate(hour)
+    self.out.write('%d %s\n' % (now, line))
+    self.pending.append(now)
+
+  def Rotate(self, hour):
+    if self.out:
+      self.Flush()
+      self.out.close()
+      self.Compress(self.out.name)
+    path = os.path.join(self.logdir, '%s.log' % hour)
+    syslog.syslog('Creating new logfile for %s at %s' % (self.device, path))
+    self.out = open(path, 'a')
+    self.hour = hour
+
+  def Compress(self, path):
+    """Compresses a closed log in the background."""
+    # Reap those started in earlier hours.
+    self.compressing = [proc for proc in self.compressing
+                        if proc.poll() is None]
+    if not self.compress:
+      return
+    try:
+      self.compressing.append(
+          subprocess.Popen(COMPRESSORS[self.compress] + [path]))
+    except OSError, e:
+      syslog.syslog('Failed to compress %s: %s' % (path, e))
+
+  def Flush(self):
+    if not self.pending:
+      return
+    self.out.flush()
+    if self.fsync and self.out is not sys.stdout:
+      os.fsync(self.out.fileno())
+    done = time.time()
+    for read_at in self.pending:
+      self.latency.Add((done - read_at) * 1000)
+    self.pending = []
+
+  def Report(self):
+    if not len(self.latency):
+      return '%s: no lines' % self.device
+    report = ('%s: %d lines, latency avg %.1fms p50 %.1fms p99 %.1fms '
+              'max %.1fms' % (self.device, len(self.latency),
+                              self.latency.Average(),
+                              self.latency.Quantile(0.5),
+                              self.latency.Quantile(0.99), self.latency.max))
+    self.latency = stream_stats.StreamStats(LATENCY_RESOLUTION, True)
+    return report
+
+
+class Logger(object):
+  """Waits on all the ports at once, logging lines as they arrive.
+
+  Lines are flushed in groups, once flush_lines lines are waiting or the
+  oldest has waited flush_interval seconds, and synced to disk if fsync.
+  """
+
+  def __init__(self, ports, flush_lines=1, flush_interval=1.0, fsync=False,
+               report_interval=REPORT_INTERVAL, debug=False, compress=None):
+    self.ports = ports
+    self.flush_lines = flush_lines
+    self.flush_interval = flush_interval
+    for port in ports:
+      port.fsync = fsync
+      port.compress = compress
+    self.report_interval = report_interval
+    self.debug = debug
+    self.running = True
+    self.next_report = time.time() + report_interval
+
+  def Stop(self, signum, frame):
+    self.running = False
+
+  def Timeout(self, now):
+    """Returns how long to wait for input before there is something to do."""
+    deadline = self.next_report
+    for port in self.ports:
+      if port.pending:
+        deadline = min(deadline, port.pending[0] + self.flush_interval)
+    return max(0, deadline - now)
+
+  def Run(self):
+    by_fd = {}
+    poller = select.poll()
+    for port in self.ports:
+      port.Open()
+      by_fd[port.fd] = port
+      poller.register(port.fd, select.POLLIN)
+    syslog.syslog('Entering main read loop')
+    while self.running and by_fd:
+      try:
+        events = poller.poll(self.Timeout(time.time()) * 1000)
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      now = time.time()
+      for fd, _ in events:
+        port = by_fd[fd]
+        if not port.Read(now):
+          syslog.syslog('End of input from %s' % port.device)
+          poller.unregister(fd)
+          del by_fd[fd]
+      now = time.time()
+      for port in self.ports:
+        if port.pending and (len(port.pending) >= self.flush_lines or
+                             now - port.pending[0] >= self.flush_interval):
+          port.Flush()
+      if now >= self.next_report:
+        self.Report()
+        self.next_report = now + self.report_interval
+    for port in self.ports:
+      port.Flush()
+    self.Report()
+    for port in self.ports:
+      port.Close()
+
+  def Report(self):
+    for port in self.ports:
+      report = port.Report()
+      syslog.syslog(report)
+      if self.debug:
+        sys.stderr.write('%s\n' % report)
+
+
 def main():
-  if len(sys.argv) != 2:
-    sys.stderr.write('Usage: %s /path/to/serial/port\n' % sys.argv[0])
+  parser = optparse.OptionParser(
+      usage='%prog [options] [raw:]port[=logdir] [...]')
+  parser.add_option('--debug', action='store_true', dest='debug')
+  parser.add_option('--flush_lines', action='store', dest='flush_lines',
+      type='int', default=1,
+      help='Flush the log once this many lines are waiting')
+  parser.add_option('--flush_interval', action='store',
+      dest='flush_interval', type='float', default=1.0,
+      help='Flush the log once a line has waited this many seconds')
+  parser.add_option('--fsync', action='store_true', dest='fsync',
+      help='Sync the log to disk each time it is flushed')
+  parser.add_option('--report_interval', action='store',
+      dest='report_interval', type='int', default=REPORT_INTERVAL,
+      help='Seconds between reports of capture latency to syslog')
+  parser.add_option('--compress', action='store', dest='compress',
+      type='choice', choices=sorted(COMPRESSORS.keys()), default=None,
+      help='Compress each hourly log once closed, with gz or zst')
+  parser.add_option('--ident', action='store', dest='ident', default='logger',
+      help='Name to log to syslog as')
+  options, args = parser.parse_args()
+  if len(args) < 1:
+    sys.stderr.write('Usage: %s [raw:]/path/to/serial/port[=logdir] [...]\n' %
+        sys.argv[0])
     sys.exit(1)
 
-  ser = serial.Serial(sys.argv[1], 57600, timeout=0)
-  time.sleep(2)
-  print 'Ready for action!'
-  ser.write('h\n')
-  ser.write('1 q\n')  # Set quiet mode (ignore bad packets)
-  buf = ''
-  while 1:
-    new = ser.readline()
-    buf += new
-    nl = buf.find('\n')
-    if nl != -1:
-      print time.time(), buf[:nl]
-      buf = buf[nl+1:]
+  syslog.openlog(options.ident, syslog.LOG_CONS | syslog.LOG_PID, syslog.LOG_DAEMON)
+  logger = Logger([Port(spec) for spec in args], options.flush_lines,
+                  options.flush_interval, options.fsync,
+                  options.report_interval, options.debug, options.compress)
+  signal.signal(signal.SIGTERM, logger.Stop)
+  signal.signal(signal.SIGINT, logger.Stop)
+  logger.Run()
+  syslog.syslog('Exiting')
 
 if __name__ == "__main__":
   main()
 
 # Vim modeline
-# vim: set ts=2 sw=2 sts=2 et: 
+# vim: set ts=2 sw=2 sts=2 et:
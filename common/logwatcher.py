@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Waits for the logs in a directory to change.
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+# inotify(7) constants.
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class LogWatcher(object):
+  """Waits for log files in a directory to change.
+
+  Uses inotify(7) when available, otherwise falls back to polling.
+  """
+
+  def __init__(self, log_dir):
+    self.fd = None
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      fd = libc.inotify_init()
+      if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init failed')
+      if libc.inotify_add_watch(fd, log_dir,
+                                IN_MODIFY | IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+      self.fd = fd
+    except (AttributeError, OSError), e:
+      print 'inotify unavailable, polling %s instead: %s' % (log_dir, e)
+
+  def Wait(self, timeout):
+    """Returns the names of the files changed within timeout seconds.
+
+    Returns None when the changes are not known, and everything should be
+    checked.
+    """
+    if self.fd is None:
+      time.sleep(timeout)
+      return None
+    try:
+      readable, _, _ = select.select([self.fd], [], [], timeout)
+    except select.error:
+      # Interrupted by a signal.
+      return set()
+    names = set()
+    if not readable:
+      return names
+    data = os.read(self.fd, 65536)
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+      wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      names.add(data[offset:offset+length].rstrip('\0'))
+      offset += length
+    return names
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
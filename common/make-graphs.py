@@ -7,12 +7,20 @@
 #
 # Generates graphs
 from mako.template import Template
+import BaseHTTPServer
+import collections
 import common
+import hashlib
+import multiprocessing
+import numpy
 import optparse
 import os
 import rrdtool
+import SocketServer
 import sys
+import threading
 import time
+import urlparse
 
 HOURS = [4, 12, 24, 48, 168, 336, 672]
 GRAPH_W = 500
@@ -20,6 +28,32 @@ GRAPH_H = 300
 COLORS = ['#4d4d4d', '#f15854', '#5da5da',
           '#faa43a', '#60bd68', '#b276b2',
           '#f71cb0', '#b2912f', '#decf3f']
+# Records what each output in graph_dir was last generated from.
+RENDER_STATE = 'render-state'
+# Limits on graphs rendered by --serve.
+MAX_HOURS = 24 * 365 * 10
+MAX_GRAPH_W = 4000
+MAX_GRAPH_H = 2000
+CACHE_MB = 32
+# Seconds the last report of each node is rounded down to when deciding
+# whether index.html needs rebuilding.
+REPORT_BUCKET = 300
+# Keeps the relative times written by since() in index.html current, with the
+# same wording as timesince.
+SINCE_SCRIPT = '''<script>
+function UpdateSince() {
+  var now = Date.now() / 1000;
+  var spans = document.getElementsByClassName('since');
+  for (var i = 0; i < spans.length; i++) {
+    var delta = now - spans[i].getAttribute('data-ts');
+    spans[i].textContent = delta < 120 ? Math.floor(delta) + ' seconds ago' :
+        delta < 3600 ? Math.floor(delta / 60) + ' minutes ago' :
+        Math.floor(delta / 3600) + ' hours ago';
+  }
+}
+UpdateSince();
+setInterval(UpdateSince, 10000);
+</script>'''
 
 
 def timesince(d):
@@ -32,68 +66,199 @@ def timesince(d):
     return '%d hours ago' % (delta/3600)
 
 
-def DailyValue(rrd_filename, val_name, CF):
-  args = ('x', '-s', 'now-24h', '-e', 'now',
-      'DEF:val=%s:%s:LAST' % (rrd_filename, val_name),
-      'VDEF:min=val,%s' % CF,'PRINT:min:%.2lf')
-  _, _, values = rrdtool.graph(*args)
-  if values: return values[-1]
+def since(ts):
+  """Returns the time since ts, in an element SINCE_SCRIPT keeps current."""
+  return '<span class="since" data-ts="%d">%s</span>' % (
+      ts, timesince(time.time() - ts))
+
+
+def DailyValues(rrd_filename):
+  """Returns the last, max, average and min of an RRD over the last 24h.
+
+  Values are formatted as rrdtool PRINT would, or None if there is no data.
+  """
+  _, _, rows = rrdtool.fetch(rrd_filename, 'LAST', '-s', 'now-24h',
+                             '-e', 'now')
+  values = numpy.array([row[0] for row in rows], dtype=float)
+  values = values[~numpy.isnan(values)]
+  if not len(values):
+    return dict.fromkeys(('LAST', 'MAXIMUM', 'AVERAGE', 'MINIMUM'))
+  return {
+      'LAST': '%.2f' % values[-1],
+      'MAXIMUM': '%.2f' % values.max(),
+      'AVERAGE': '%.2f' % values.mean(),
+      'MINIMUM': '%.2f' % values.min(),
+  }
+
+
+def LastUpdate(catalog, rrd_file):
+  info = catalog.Get(rrd_file)
+  if info:
+    return info.last
+  return rrdtool.last(rrd_file)
 
 
 def LoadNodes(rrd_dir):
   nodes = common.LoadConfig(os.path.join(rrd_dir, 'config'))
+  catalog = common.RRDCatalog(rrd_dir)
   for node_id, node in nodes.iteritems():
       d= {}
       # Extract battery and other state
       rrd_file = os.path.join(rrd_dir, 'node%s_bat.rrd' % node_id)
-      v = DailyValue(rrd_file, 'node%s_bat' % node_id, 'LAST')
+      v = DailyValues(rrd_file)['LAST']
       if v:
         d['bat'] = (float(v)+50)*20/1000.0
       else:
         d['bat'] = 0.0
-      last_report = rrdtool.last(rrd_file)
+      last_report = LastUpdate(catalog, rrd_file)
       d['last_report'] = last_report
       d['report_delta'] = time.time() - last_report
       if node['type'] == 'TempSensor':
         rrd_file = os.path.join(rrd_dir, 'node%s_temp.rrd' % node_id)
-        val_name = 'node%s_temp' % node_id
-        d['temp'] = DailyValue(rrd_file, val_name, 'LAST')
-        d['temp_24h_max'] = DailyValue(rrd_file, val_name, 'MAXIMUM')
-        d['temp_24h_avg'] = DailyValue(rrd_file, val_name, 'AVERAGE')
-        d['temp_24h_min'] = DailyValue(rrd_file, val_name, 'MINIMUM')
+        values = DailyValues(rrd_file)
+        d['temp'] = values['LAST']
+        d['temp_24h_max'] = values['MAXIMUM']
+        d['temp_24h_avg'] = values['AVERAGE']
+        d['temp_24h_min'] = values['MINIMUM']
       nodes[node_id].update(d)
 
   return nodes
 
 
-def BatteryGraph(hours, nodes, graph_dir, rrd_dir):
-  args = [os.path.join(graph_dir, 'battery-%dh.png' % hours),
-      '--start', 'end-%dh' % hours, '--lower-limit', '0',
+def BatteryGraphArgs(hours, nodes, rrd_dir, end=None, width=GRAPH_W,
+                     height=GRAPH_H):
+  args = ['--start', 'end-%dh' % hours, '--lower-limit', '0',
       '--title', 'Battery voltage']
+  if end:
+    args.extend(['--end', str(end)])
   for n in nodes:
     args.append('DEF:node%d=%s/node%d_bat.rrd:node%d_bat:AVERAGE' %
         (n, rrd_dir, n, n))
-  args.extend(['--vertical-label', 'mV', '--width', str(GRAPH_W),
-               '--height', str(GRAPH_H)])
+  args.extend(['--vertical-label', 'mV', '--width', str(width),
+               '--height', str(height)])
   for n in nodes:
     args.append('CDEF:mv%d=node%d,50,+,20,*' % (n, n))
   for n, d in nodes.iteritems():
     args.append('LINE1:mv%d%s:%s' % (n, COLORS[n-1], d['desc']))
-  rrdtool.graph(*args)
+  return args
 
 
-def TemperatureGraph(hours, nodes, graph_dir, rrd_dir):
-  args = [os.path.join(graph_dir, 'temp-%dh.png' % hours),
-      '--start', 'end-%dh' % hours, '--lower-limit', '0',
+def BatteryGraph(hours, nodes, graph_dir, rrd_dir, end=None):
+  rrdtool.graph(os.path.join(graph_dir, 'battery-%dh.png' % hours),
+                *BatteryGraphArgs(hours, nodes, rrd_dir, end))
+
+
+def TemperatureGraphArgs(hours, nodes, rrd_dir, end=None, width=GRAPH_W,
+                         height=GRAPH_H):
+  args = ['--start', 'end-%dh' % hours, '--lower-limit', '0',
       '--title', 'Temperature']
+  if end:
+    args.extend(['--end', str(end)])
   for n in nodes:
     args.append('DEF:node%d=%s/node%d_temp.rrd:node%d_temp:AVERAGE' %
         (n, rrd_dir, n, n))
-  args.extend(['--vertical-label', 'DegC', '--width', str(GRAPH_W),
-               '--height', str(GRAPH_H)])
+  args.extend(['--vertical-label', 'DegC', '--width', str(width),
+               '--height', str(height)])
   for n, d in nodes.iteritems():
     args.append('LINE1:node%d%s:%s' % (n, COLORS[n-1], d['desc']))
-  rrdtool.graph(*args)
+  return args
+
+
+def TemperatureGraph(hours, nodes, graph_dir, rrd_dir, end=None):
+  rrdtool.graph(os.path.join(graph_dir, 'temp-%dh.png' % hours),
+                *TemperatureGraphArgs(hours, nodes, rrd_dir, end))
+
+
+# (png prefix, function, argument builder, rrd suffix) for each kind of graph.
+GRAPHS = (
+    ('battery', BatteryGraph, BatteryGraphArgs, 'bat'),
+    ('temp', TemperatureGraph, TemperatureGraphArgs, 'temp'),
+)
+
+
+def Signature(*args):
+  return hashlib.md5(repr(args)).hexdigest()
+
+
+def WindowEnd(now, hours, width):
+  """Aligns the end of a window to the width of a pixel."""
+  resolution = max(1, hours * 3600 / width)
+  return now - now % resolution
+
+
+def GraphSignature(catalog, nodes, rrd_dir, suffix, hours, end, width,
+                   height):
+  """Identifies the inputs to a graph.
+
+  Only data up to the end of the window is drawn, so the last update of each
+  RRD only matters until it passes the end.
+  """
+  lasts = [min(LastUpdate(catalog, os.path.join(
+               rrd_dir, 'node%d_%s.rrd' % (n, suffix))), end)
+           for n in sorted(nodes)]
+  descs = [(n, nodes[n]['desc']) for n in sorted(nodes)]
+  return Signature(descs, lasts, hours, end, width, height)
+
+
+def LoadRenderState(graph_dir):
+  state = {}
+  filename = os.path.join(graph_dir, RENDER_STATE)
+  if os.path.exists(filename):
+    with open(filename, 'r') as fp:
+      for line in fp:
+        name, signature = line.split()
+        state[name] = signature
+  return state
+
+
+def SaveRenderState(graph_dir, state):
+  filename = os.path.join(graph_dir, RENDER_STATE)
+  with open('%s.tmp' % filename, 'w') as fp:
+    for name in sorted(state.keys()):
+      fp.write('%s %s\n' % (name, state[name]))
+  os.rename('%s.tmp' % filename, filename)
+
+
+def GraphJobs(nodes, graph_dir, rrd_dir, now):
+  """Returns (png, signature, function, args) for every graph."""
+  catalog = common.RRDCatalog(rrd_dir)
+  jobs = []
+  for prefix, func, _, suffix in GRAPHS:
+    for hours in HOURS:
+      end = WindowEnd(now, hours, GRAPH_W)
+      png = '%s-%dh.png' % (prefix, hours)
+      signature = GraphSignature(catalog, nodes, rrd_dir, suffix, hours, end,
+                                 GRAPH_W, GRAPH_H)
+      jobs.append((png, signature, func,
+                   (hours, nodes, graph_dir, rrd_dir, end)))
+  return jobs
+
+
+def RenderGraph(job):
+  func, args = job
+  func(*args)
+
+
+def RenderGraphs(nodes, graph_dir, rrd_dir, state, processes=1, force=False):
+  """Renders the graphs whose inputs have changed, updating state."""
+  todo = []
+  for png, signature, func, args in GraphJobs(nodes, graph_dir, rrd_dir,
+                                              int(time.time())):
+    if (not force and state.get(png, None) == signature and
+        os.path.exists(os.path.join(graph_dir, png))):
+      continue
+    todo.append((png, signature, (func, args)))
+  if processes > 1 and len(todo) > 1:
+    pool = multiprocessing.Pool(processes)
+    pool.map(RenderGraph, [job for _, _, job in todo])
+    pool.close()
+    pool.join()
+  else:
+    for _, _, job in todo:
+      RenderGraph(job)
+  for png, signature, _ in todo:
+    state[png] = signature
+  return len(todo)
 
 
 def UpdateTemplate(graph_dir, nodes):
@@ -101,25 +266,220 @@ def UpdateTemplate(graph_dir, nodes):
       'now': time.strftime('%Y-%m-%d %H:%M:%S %Z'),
       'nodes': nodes,
       'timesince': timesince,
+      'since': since,
+      'since_script': SINCE_SCRIPT,
   }
   t = Template(filename=os.path.join(graph_dir, 'index.mako'))
   with open(os.path.join(graph_dir, 'index.html'), 'w') as fp:
     fp.write(t.render_unicode(**data).encode('utf-8'))
 
 
+def MaybeUpdateTemplate(graph_dir, nodes, state, force=False):
+  """Rebuilds index.html only if the node summaries shown in it changed."""
+  summaries = []
+  for node_id in sorted(nodes):
+    d = dict(nodes[node_id])
+    # The page works out the time since the last report itself, so only a
+    # (much) later report needs it rebuilt.
+    del d['report_delta']
+    d['last_report'] -= d['last_report'] % REPORT_BUCKET
+    summaries.append((node_id, sorted(d.items())))
+  signature = Signature(summaries)
+  if (not force and state.get('index.html', None) == signature and
+      os.path.exists(os.path.join(graph_dir, 'index.html'))):
+    return False
+  UpdateTemplate(graph_dir, nodes)
+  state['index.html'] = signature
+  return True
+
+
+class PNGCache(object):
+  """A least recently used cache of rendered graphs, bounded in total size."""
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.pngs = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def Get(self, key):
+    with self.lock:
+      png = self.pngs.pop(key, None)
+      if png is None:
+        self.misses += 1
+        return None
+      self.pngs[key] = png
+      self.hits += 1
+      return png
+
+  def Put(self, key, png):
+    with self.lock:
+      old = self.pngs.pop(key, None)
+      if old is not None:
+        self.size -= len(old)
+      if len(png) > self.max_bytes:
+        return
+      self.pngs[key] = png
+      self.size += len(png)
+      while self.size > self.max_bytes:
+        _, old = self.pngs.popitem(last=False)
+        self.size -= len(old)
+
+
+class GraphServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Renders graphs for any window, size or set of nodes on request.
+
+  Rendered graphs are cached under the signature of their inputs, so a graph
+  is only rendered again once one of its RRDs has new data to show, or the
+  window has moved by a pixel.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, port, rrd_dir, cache_bytes, verbose=False,
+               bind='127.0.0.1'):
+    BaseHTTPServer.HTTPServer.__init__(self, (bind, port), GraphHandler)
+    self.rrd_dir = rrd_dir
+    self.verbose = verbose
+    self.nodes = common.LoadConfig(os.path.join(rrd_dir, 'config'))
+    self.cache = PNGCache(cache_bytes)
+    self.lock = threading.Lock()
+    self.catalog = None
+    self.catalog_mtime = None
+    self.builders = dict((prefix, (builder, suffix))
+                         for prefix, _, builder, suffix in GRAPHS)
+
+  def Catalog(self):
+    """Returns the RRD catalog, reloading it whenever it has been saved."""
+    try:
+      mtime = os.stat(os.path.join(self.rrd_dir, common.RRD_CATALOG)).st_mtime
+    except OSError:
+      mtime = None
+    with self.lock:
+      if self.catalog is None or mtime != self.catalog_mtime:
+        self.catalog = common.RRDCatalog(self.rrd_dir)
+        self.catalog_mtime = mtime
+      return self.catalog
+
+  def Render(self, prefix, hours, nodes, end, width, height):
+    builder, suffix = self.builders[prefix]
+    if not end:
+      end = WindowEnd(int(time.time()), hours, width)
+    key = (prefix, GraphSignature(self.Catalog(), nodes, self.rrd_dir, suffix,
+                                  hours, end, width, height))
+    png = self.cache.Get(key)
+    if png is None:
+      args = builder(hours, nodes, self.rrd_dir, end, width, height)
+      png = rrdtool.graphv('-', *args)['image']
+      self.cache.Put(key, png)
+    return png
+
+
+class GraphHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves /<battery|temp>.png?hours=&width=&height=&nodes=1,2&end="""
+
+  protocol_version = 'HTTP/1.1'
+  # Buffer each response so it goes out in one packet.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    server = self.server
+    url = urlparse.urlparse(self.path)
+    prefix, ext = os.path.splitext(url.path.lstrip('/'))
+    if ext != '.png' or prefix not in server.builders:
+      self.send_error(404)
+      return
+    query = urlparse.parse_qs(url.query)
+    try:
+      hours = self.IntParam(query, 'hours', 24, 1, MAX_HOURS)
+      width = self.IntParam(query, 'width', GRAPH_W, 10, MAX_GRAPH_W)
+      height = self.IntParam(query, 'height', GRAPH_H, 10, MAX_GRAPH_H)
+      end = self.IntParam(query, 'end', 0, 0, None)
+      nodes = server.nodes
+      if 'nodes' in query:
+        node_ids = [int(n) for n in query['nodes'][-1].split(',')]
+        nodes = dict((n, server.nodes[n]) for n in node_ids)
+    except (ValueError, KeyError), e:
+      self.send_error(400, 'Bad parameter: %s' % e)
+      return
+    try:
+      png = server.Render(prefix, hours, nodes, end, width, height)
+    except rrdtool.error, e:
+      self.send_error(500, str(e))
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'image/png')
+    self.send_header('Content-Length', str(len(png)))
+    self.end_headers()
+    self.wfile.write(png)
+
+  def IntParam(self, query, name, default, minimum, maximum):
+    if name not in query:
+      return default
+    value = int(query[name][-1])
+    if value < minimum or (maximum is not None and value > maximum):
+      raise ValueError('%s must be between %s and %s' % (name, minimum,
+                                                         maximum))
+    return value
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def Serve(port, rrd_dir, cache_bytes, verbose=False, bind='127.0.0.1'):
+  server = GraphServer(port, rrd_dir, cache_bytes, verbose, bind)
+  print 'Serving graphs from %s on http://%s:%d/' % (rrd_dir, bind, port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  print '%d cache hits, %d misses, %d graphs (%d bytes) cached' % (
+      server.cache.hits, server.cache.misses, len(server.cache.pngs),
+      server.cache.size)
+
+
 def main():
   parser = optparse.OptionParser()
+  parser.add_option('--jobs', action='store', dest='jobs', type='int',
+      default=multiprocessing.cpu_count(),
+      help='Number of graphs to render in parallel')
+  parser.add_option('--force', action='store_true', dest='force',
+      help='Render everything, even if the inputs have not changed')
+  parser.add_option('--verbose', action='store_true', dest='verbose')
+  parser.add_option('--serve', action='store', dest='serve', type='int',
+      default=None, metavar='PORT',
+      help='Render graphs on request over HTTP rather than to graph_dir')
+  parser.add_option('--cache_mb', action='store', dest='cache_mb',
+      type='int', default=CACHE_MB,
+      help='Memory to cache graphs rendered by --serve in')
+  parser.add_option('--bind', action='store', dest='bind',
+      default='127.0.0.1',
+      help='Address for --serve to listen on, eg 0.0.0.0 for every interface')
   options, args = parser.parse_args()
+  if options.serve and len(args) == 1:
+    Serve(options.serve, args[0], options.cache_mb * 1024 * 1024,
+          options.verbose, options.bind)
+    return
   if len(args) < 2:
-    sys.stderr.write('Usage: %s rrd_dir graph_dir\n' % sys.argv[0])
+    sys.stderr.write('Usage: %s [--jobs n] [--force] rrd_dir graph_dir\n'
+        '       %s --serve port [--bind addr] [--cache_mb n] rrd_dir\n' %
+        (sys.argv[0], sys.argv[0]))
     sys.exit(1)
 
-  nodes = LoadNodes(args[0])
-  for hour in HOURS:
-    BatteryGraph(hour, nodes, args[1], args[0])
-    TemperatureGraph(hour, nodes, args[1], args[0])
-  UpdateTemplate(args[1], nodes)
-
+  rrd_dir, graph_dir = args[:2]
+  nodes = LoadNodes(rrd_dir)
+  state = LoadRenderState(graph_dir)
+  rendered = RenderGraphs(nodes, graph_dir, rrd_dir, state, options.jobs,
+                          options.force)
+  updated = MaybeUpdateTemplate(graph_dir, nodes, state, options.force)
+  SaveRenderState(graph_dir, state)
+  if options.verbose:
+    print 'Rendered %d of %d graphs%s' % (rendered, len(HOURS) * len(GRAPHS),
+        updated and ', updated index.html' or '')
 
 if __name__ == "__main__":
   main()
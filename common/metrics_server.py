@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Serves the node state of an Updater for Prometheus (--metrics_port).
+import BaseHTTPServer
+
+
+# (name, type, help, function of NodeState) for each metric exported to
+# Prometheus by --metrics_port. Names follow jeelogger's metrics file.
+NODE_METRICS = (
+    ('last_report_timestamp_seconds', 'gauge',
+     'Time of the last report from the node.',
+     lambda state: state.last_ts or None),
+    ('ping_seq', 'gauge', 'ping_id of the last report from the node.',
+     lambda state: state.last_ping_id if state.last_ts else None),
+    ('degrees_c', 'gauge', 'Last temperature reported by the node.',
+     lambda state: state.last_temp),
+    ('battery', 'gauge', 'Last raw battery level reported by the node.',
+     lambda state: state.last_bat),
+    ('reports_received', 'gauge', 'Reports received from the node this hour.',
+     lambda state: state.received_reports),
+    ('reports_expected', 'gauge',
+     'Reports the node sent this hour, judging by their ping_ids.',
+     lambda state: state.num_reports),
+    ('meter_revs', 'counter', 'Revolutions counted by the meter reader.',
+     lambda state: state.realcounter if state.lastline else None),
+)
+
+
+def FormatMetrics(nodes, node_state):
+  """Returns the state of each node in the Prometheus text format."""
+  states = sorted(node_state.items())
+  lines = []
+  for name, metric_type, help_text, value in NODE_METRICS:
+    lines.append('# HELP smarthouse_%s %s' % (name, help_text))
+    lines.append('# TYPE smarthouse_%s %s' % (name, metric_type))
+    for node_id, state in states:
+      v = value(state)
+      if v is not None:
+        lines.append('smarthouse_%s{node_id="%d"} %r' % (name, node_id,
+                                                         float(v)))
+  lines.append('# HELP smarthouse_node_info The configuration of each node.')
+  lines.append('# TYPE smarthouse_node_info gauge')
+  for node_id, node in sorted(nodes.items()):
+    lines.append('smarthouse_node_info{node_id="%d",type="%s",desc="%s"} 1' %
+                 (node_id, node['type'], node['desc']))
+  return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+  """Serves the node state of an Updater on /metrics for Prometheus."""
+
+  def __init__(self, port, updater, bind='127.0.0.1'):
+    BaseHTTPServer.HTTPServer.__init__(self, (bind, port), MetricsHandler)
+    self.updater = updater
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    updater = self.server.updater
+    # A copy, as the updater may add nodes while this is formatted.
+    body = FormatMetrics(updater.nodes, dict(updater.node_state))
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if self.server.updater.debug:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Prints the hourly (or daily) rollups of the hourly reports, kept in the
+# state_dir by the updaters as they process logs. For example:
+#   query-rollups.py --daily --start 2017-01-01 --end 2018-01-01 state kwh
+#   query-rollups.py --node 3 --days 30 state reliability
+import calendar
+import optparse
+import os
+import rollup_store
+import sys
+import time
+
+# Column (or function of a row) for each metric which may be printed.
+METRICS = {
+    'hours': 'hours',
+    'received': 'received',
+    'expected': 'expected',
+    'reliability': lambda row: (100.0 * row['received'] / row['expected']
+                                if row['expected'] else None),
+    'gap': 'gap_mean',
+    'gap_p50': 'gap_p50',
+    'gap_p95': 'gap_p95',
+    'kwh': 'kwh',
+    'temp': 'temp_mean',
+    'temp_min': 'temp_min',
+    'temp_max': 'temp_max',
+}
+DEFAULT_METRICS = ('reliability', 'gap', 'kwh', 'temp')
+
+
+def ParseTime(text):
+  """Returns the time of YYYY-MM-DD[ HH:MM] in UTC, or seconds since epoch."""
+  for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M'):
+    try:
+      return calendar.timegm(time.strptime(text, fmt))
+    except ValueError:
+      pass
+  return float(text)
+
+
+def Value(row, metric):
+  column = METRICS[metric]
+  if callable(column):
+    return column(row)
+  return row.get(column, None)
+
+
+def FormatValue(value):
+  if value is None:
+    return '-'
+  if isinstance(value, float):
+    return '%.2f' % value
+  return str(value)
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options] state_dir [metric ...]')
+  parser.add_option('--daily', action='store_true', dest='daily',
+      help='Print the rollups of each day, rather than of each hour')
+  parser.add_option('--node', action='append', dest='nodes', type='int',
+      default=[], help='Only print this node, may be repeated')
+  parser.add_option('--start', action='store', dest='start', default=None,
+      help='Only print from this time (YYYY-MM-DD[ HH:MM] UTC, or seconds)')
+  parser.add_option('--end', action='store', dest='end', default=None,
+      help='Only print before this time')
+  parser.add_option('--days', action='store', dest='days', type='float',
+      default=None, help='Only print the past n days')
+  options, args = parser.parse_args()
+  if len(args) < 1:
+    sys.stderr.write('Usage: %s [options] state_dir [metric ...]\n'
+        '  metrics: %s\n' % (sys.argv[0], ', '.join(sorted(METRICS))))
+    sys.exit(1)
+  metrics = args[1:] or DEFAULT_METRICS
+  for metric in metrics:
+    if metric not in METRICS:
+      parser.error('Unknown metric %s, expected one of %s' % (
+          metric, ', '.join(sorted(METRICS))))
+  if options.daily and ('gap_p50' in metrics or 'gap_p95' in metrics):
+    parser.error('Gap quantiles are only kept hourly')
+  try:
+    start = options.start and ParseTime(options.start)
+    end = options.end and ParseTime(options.end)
+  except ValueError, e:
+    parser.error(str(e))
+  if options.days is not None:
+    start = time.time() - options.days * 86400
+
+  filename = os.path.join(args[0], rollup_store.ROLLUP_DB)
+  if not os.path.exists(filename):
+    parser.error('No rollups in %s' % args[0])
+  store = rollup_store.RollupStore(filename)
+  if options.daily:
+    table, key, fmt = 'daily', 'day', '%Y-%m-%d'
+  else:
+    table, key, fmt = 'hourly', 'hour', '%Y-%m-%d %H:00'
+  columns, rows = store.Query(table, start, end, options.nodes)
+  store.Close()
+  print '# %s node %s' % (key, ' '.join(metrics))
+  for row in rows:
+    row = dict(zip(columns, row))
+    values = [Value(row, metric) for metric in metrics]
+    if all(value is None for value in values):
+      continue
+    print '%s %d %s' % (time.strftime(fmt, time.gmtime(row[key])),
+        row['node_id'], ' '.join(FormatValue(value) for value in values))
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
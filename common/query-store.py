@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Requires numpy (apt-get install python-numpy).
+#
+# Prints the points (or rollups) in a range of the series written by
+# update-store.py, or lists the series when none are given.
+import optparse
+import os
+import series_store
+import sys
+import time
+
+STORE_DIR = 'store'
+
+
+def PrintSeries(store, name, start, end, resolution):
+  print '# %s' % name
+  for view in store.Range(name, start, end, resolution):
+    if resolution is None:
+      for ts, value in view.tolist():
+        print '%d %g' % (ts, value)
+    else:
+      for ts, low, high, total, count in view.tolist():
+        print '%d %g %g %g %d' % (ts, low, high, total / count, count)
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options] state_dir [series ...]')
+  parser.add_option('--start', action='store', dest='start', type='float',
+      default=None, help='Only print points at or after this time')
+  parser.add_option('--end', action='store', dest='end', type='float',
+      default=None, help='Only print points before this time')
+  parser.add_option('--hours', action='store', dest='hours', type='float',
+      default=None, help='Only print points from the past n hours')
+  parser.add_option('--resolution', action='store', dest='resolution',
+      type='choice', choices=[str(r) for r in series_store.ROLLUPS],
+      default=None,
+      help='Print min, max, avg and count of each period of this many seconds')
+  options, args = parser.parse_args()
+  if len(args) < 1:
+    sys.stderr.write('Usage: %s [options] state_dir [series ...]\n' %
+        sys.argv[0])
+    sys.exit(1)
+
+  store = series_store.SeriesStore(os.path.join(args[0], STORE_DIR),
+                                   rollup_interval=0)
+  if len(args) == 1:
+    for name in store.Names():
+      series = store.Get(name)
+      print '%s %d points, last at %s' % (name, len(series.points),
+          time.ctime(series.points.Last() or 0))
+    return
+  start = options.start
+  if options.hours is not None:
+    start = time.time() - options.hours * 3600
+  resolution = options.resolution and int(options.resolution)
+  names = store.Names()
+  for name in args[1:]:
+    if name not in names:
+      parser.error('No series %s in %s' % (name, args[0]))
+  for name in args[1:]:
+    PrintSeries(store, name, start, options.end, resolution)
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
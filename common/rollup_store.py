@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Keeps the hourly and daily rollups of the hourly reports, in SQLite.
+import sqlite3
+
+
+# Name of the file in a state_dir keeping the hourly and daily rollups of the
+# hourly reports (see RollupStore).
+ROLLUP_DB = 'rollups.db'
+
+
+class RollupStore(object):
+  """Keeps the stats of each node's hourly reports, and of each day, in SQLite.
+
+  Rows are keyed by the start of their hour or (UTC) day, and replaced when
+  an hour is reported again (eg the partial hour reported at the end of a
+  run). Each day is rebuilt from its hours as they are saved.
+  """
+
+  SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hourly (
+        hour INTEGER, node_id INTEGER, received INTEGER, expected INTEGER,
+        gap_mean REAL, gap_p50 REAL, gap_p95 REAL, gap_count INTEGER,
+        kwh REAL, temp_mean REAL, temp_min REAL, temp_max REAL,
+        temp_count INTEGER, PRIMARY KEY (hour, node_id));
+    CREATE INDEX IF NOT EXISTS hourly_node ON hourly (node_id, hour);
+    CREATE TABLE IF NOT EXISTS daily (
+        day INTEGER, node_id INTEGER, hours INTEGER, received INTEGER,
+        expected INTEGER, gap_mean REAL, gap_count INTEGER, kwh REAL,
+        temp_mean REAL, temp_min REAL, temp_max REAL, temp_count INTEGER,
+        PRIMARY KEY (day, node_id));
+    CREATE INDEX IF NOT EXISTS daily_node ON daily (node_id, day);
+  """
+  HOURLY_COLUMNS = ('received', 'expected', 'gap_mean', 'gap_p50', 'gap_p95',
+                    'gap_count', 'kwh', 'temp_mean', 'temp_min', 'temp_max',
+                    'temp_count')
+  DAILY = """
+    INSERT OR REPLACE INTO daily SELECT
+        ?, node_id, COUNT(*), SUM(received), SUM(expected),
+        SUM(gap_mean * gap_count) / SUM(gap_count), SUM(gap_count), SUM(kwh),
+        SUM(temp_mean * temp_count) / SUM(temp_count), MIN(temp_min),
+        MAX(temp_max), SUM(temp_count)
+      FROM hourly WHERE hour >= ? AND hour < ? GROUP BY node_id
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.executescript(self.SCHEMA)
+
+  def SaveHour(self, hour, rows):
+    """Saves (node_id, {column: value}) rows for the hour starting at hour."""
+    day = hour - hour % 86400
+    sql = 'INSERT OR REPLACE INTO hourly VALUES (?, ?, %s)' % ', '.join(
+        '?' * len(self.HOURLY_COLUMNS))
+    with self.db:
+      self.db.executemany(sql, [
+          [hour, node_id] + [row.get(column) for column in self.HOURLY_COLUMNS]
+          for node_id, row in rows])
+      self.db.execute(self.DAILY, (day, day, day + 86400))
+
+  def Query(self, table, start=None, end=None, node_ids=None):
+    """Returns the column names, and rows in [start, end) of table."""
+    if table not in ('hourly', 'daily'):
+      raise ValueError('Unknown table %s' % table)
+    key = table == 'hourly' and 'hour' or 'day'
+    where = ['1']
+    args = []
+    if start is not None:
+      where.append('%s >= ?' % key)
+      args.append(start)
+    if end is not None:
+      where.append('%s < ?' % key)
+      args.append(end)
+    if node_ids:
+      where.append('node_id IN (%s)' % ', '.join('?' * len(node_ids)))
+      args.extend(node_ids)
+    cursor = self.db.execute('SELECT * FROM %s WHERE %s ORDER BY %s, node_id'
+                             % (table, ' AND '.join(where), key), args)
+    return [column[0] for column in cursor.description], cursor.fetchall()
+
+  def Close(self):
+    self.db.close()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
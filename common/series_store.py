@@ -0,0 +1,405 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Series of (ts, value) points in memory-mapped chunks, an alternative to RRDs.
+import bisect
+import collections
+import math
+import os
+import threading
+
+# numpy is only needed to open a SeriesStore (apt-get install python-numpy).
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Layouts of the points, and of the rollups of them, kept by a SeriesStore.
+# Rollups are of the points in [ts, ts + resolution), averaging sum / count.
+POINT_DTYPE = [('ts', '<f8'), ('value', '<f8')]
+ROLLUP_DTYPE = [('ts', '<f8'), ('min', '<f8'), ('max', '<f8'), ('sum', '<f8'),
+                ('count', '<u4')]
+# Resolutions (in seconds) of the rollups kept, each built from the last.
+ROLLUPS = (300, 3600)
+# Records per chunk file of a SeriesStore, and how far (in seconds) behind
+# the latest point of a series a point may still be inserted.
+STORE_CHUNK = 65536
+REORDER_WINDOW = 3600
+# Seconds between building rollups in the background.
+ROLLUP_INTERVAL = 60
+
+
+class ChunkedArray(object):
+  """Records sorted by ts, in memory-mapped .npy files of chunk_len each.
+
+  Each chunk is named by the ts of its first record. Records are appended,
+  though may also be inserted into the last chunk, keeping it sorted. Unused
+  records at the end of the last chunk have a ts of 0.
+  """
+
+  def __init__(self, directory, prefix, dtype, chunk_len=STORE_CHUNK):
+    self.directory = directory
+    self.prefix = prefix
+    self.dtype = numpy.dtype(dtype)
+    self.chunk_len = chunk_len
+    self.starts = []
+    self.names = []
+    self.chunks = {}
+    self.dirty = set()
+    names = [name for name in os.listdir(directory)
+             if name.startswith(prefix + '-') and name.endswith('.npy')]
+    for first, name in sorted((float(name[len(prefix)+1:-4]), name)
+                              for name in names):
+      self.starts.append(first)
+      self.names.append(name)
+    self.tail_len = 0
+    if self.names:
+      self.tail_len = int(numpy.count_nonzero(self.Chunk(-1)['ts']))
+
+  def __len__(self):
+    if not self.names:
+      return 0
+    return (len(self.names) - 1) * self.chunk_len + self.tail_len
+
+  def Chunk(self, i):
+    i %= len(self.names)
+    if i not in self.chunks:
+      self.chunks[i] = numpy.lib.format.open_memmap(
+          os.path.join(self.directory, self.names[i]), mode='r+')
+    return self.chunks[i]
+
+  def Last(self):
+    """Returns the ts of the last record, or None if there are none."""
+    if not self.tail_len:
+      return None
+    return float(self.Chunk(-1)['ts'][self.tail_len - 1])
+
+  def NewChunk(self, first):
+    name = '%s-%.6f.npy' % (self.prefix, first)
+    self.chunks[len(self.names)] = numpy.lib.format.open_memmap(
+        os.path.join(self.directory, name), mode='w+', dtype=self.dtype,
+        shape=(self.chunk_len,))
+    self.starts.append(first)
+    self.names.append(name)
+    self.tail_len = 0
+
+  def Append(self, records):
+    """Appends records, sorted by and after any existing ts."""
+    done = 0
+    while done < len(records):
+      if not self.names or self.tail_len == self.chunk_len:
+        self.NewChunk(float(records['ts'][done]))
+      n = min(len(records) - done, self.chunk_len - self.tail_len)
+      self.Chunk(-1)[self.tail_len:self.tail_len+n] = records[done:done+n]
+      self.tail_len += n
+      done += n
+      self.dirty.add(len(self.names) - 1)
+
+  def Insert(self, record):
+    """Inserts a record in ts order, returning False if there are none.
+
+    A record with the same ts as an existing one replaces it. Each full chunk
+    from where it goes pushes its last record on into the next, so inserts
+    should be close to the end.
+    """
+    ts = record['ts']
+    if not self.tail_len:
+      return False
+    first = max(0, bisect.bisect_right(self.starts, ts) - 1)
+    last = len(self.names) - 1
+    for k in xrange(first, last + 1):
+      chunk = self.Chunk(k)
+      n = k == last and self.tail_len or self.chunk_len
+      i = 0
+      if k == first:
+        i = int(numpy.searchsorted(chunk['ts'][:n], ts))
+        if i < n and chunk['ts'][i] == ts:
+          chunk[i] = record
+          self.dirty.add(k)
+          return True
+      if i == self.chunk_len:
+        # After everything in this full chunk, so first in the next.
+        continue
+      if n < self.chunk_len:
+        chunk[i+1:n+1] = chunk[i:n].copy()
+        chunk[i] = record
+        self.tail_len += 1
+      else:
+        pushed = chunk[n-1].copy()
+        chunk[i+1:n] = chunk[i:n-1].copy()
+        chunk[i] = record
+        record = pushed
+      self.dirty.add(k)
+      if i == 0:
+        self.Rename(k, float(chunk['ts'][0]))
+      if n < self.chunk_len:
+        return True
+    # The last chunk was full too.
+    self.NewChunk(float(record['ts']))
+    self.Append(numpy.array([record], dtype=self.dtype))
+    return True
+
+  def Rename(self, i, first):
+    """Renames chunk i after a new first record."""
+    name = '%s-%.6f.npy' % (self.prefix, first)
+    if name != self.names[i]:
+      os.rename(os.path.join(self.directory, self.names[i]),
+                os.path.join(self.directory, name))
+      self.names[i] = name
+      self.starts[i] = first
+
+  def Range(self, start=None, end=None):
+    """Returns views of the records in [start, end), one per chunk."""
+    if not self.names:
+      return []
+    first = 0
+    if start is not None:
+      first = max(0, bisect.bisect_right(self.starts, start) - 1)
+    views = []
+    for i in xrange(first, len(self.names)):
+      if end is not None and self.starts[i] >= end:
+        break
+      chunk = self.Chunk(i)
+      if i == len(self.names) - 1:
+        chunk = chunk[:self.tail_len]
+      ts = chunk['ts']
+      lo = 0
+      if start is not None:
+        lo = int(numpy.searchsorted(ts, start))
+      hi = len(chunk)
+      if end is not None:
+        hi = int(numpy.searchsorted(ts, end))
+      if hi > lo:
+        views.append(chunk[lo:hi])
+    return views
+
+  def Flush(self):
+    for i in self.dirty:
+      self.Chunk(i).flush()
+    self.dirty = set()
+
+
+class Series(object):
+  """The points of one series, and their rollups, in a directory."""
+
+  def __init__(self, directory, window=REORDER_WINDOW):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.window = window
+    self.points = ChunkedArray(directory, 'points', POINT_DTYPE)
+    self.rollups = collections.OrderedDict(
+        (resolution, ChunkedArray(directory, 'rollup%d' % resolution,
+                                  ROLLUP_DTYPE))
+        for resolution in ROLLUPS)
+    self.rejected = 0
+    self.point = numpy.zeros(1, dtype=POINT_DTYPE)
+
+  def Add(self, ts, value):
+    """Adds a point, returning False if it is too far out of order.
+
+    A point with the same ts as an existing one replaces it.
+    """
+    self.point['ts'] = ts
+    self.point['value'] = value
+    last = self.points.Last()
+    if last is None or ts > last:
+      self.points.Append(self.point)
+      return True
+    # Rollups are only built of points older than the window, so are never
+    # changed by an insert.
+    if ts >= last - self.window:
+      return self.points.Insert(self.point[0])
+    self.rejected += 1
+    return False
+
+  def Rollup(self):
+    """Builds the rollups of the points no longer open to inserts."""
+    last = self.points.Last()
+    if last is None:
+      return
+    until = last - self.window
+    source = self.points
+    for resolution, rollup in self.rollups.iteritems():
+      until = math.floor(until / resolution) * resolution
+      since = rollup.Last()
+      since = since is not None and since + resolution or None
+      views = source.Range(since, until)
+      if views:
+        rollup.Append(Rollup(numpy.concatenate(views), resolution))
+      source = rollup
+
+  def Range(self, start=None, end=None, resolution=None):
+    """Returns views of the points, or rollups, in [start, end)."""
+    if resolution is None:
+      return self.points.Range(start, end)
+    return self.rollups[resolution].Range(start, end)
+
+  def Flush(self):
+    self.points.Flush()
+    for rollup in self.rollups.itervalues():
+      rollup.Flush()
+
+
+def Rollup(records, resolution):
+  """Reduces points or finer rollups into rollups at resolution."""
+  buckets = numpy.floor(records['ts'] / resolution) * resolution
+  starts = numpy.flatnonzero(numpy.concatenate(
+      ([True], buckets[1:] != buckets[:-1])))
+  rollup = numpy.zeros(len(starts), dtype=ROLLUP_DTYPE)
+  rollup['ts'] = buckets[starts]
+  if 'value' in records.dtype.names:
+    values = records['value']
+    rollup['min'] = numpy.minimum.reduceat(values, starts)
+    rollup['max'] = numpy.maximum.reduceat(values, starts)
+    rollup['sum'] = numpy.add.reduceat(values, starts)
+    rollup['count'] = numpy.diff(numpy.append(starts, len(records)))
+  else:
+    rollup['min'] = numpy.minimum.reduceat(records['min'], starts)
+    rollup['max'] = numpy.maximum.reduceat(records['max'], starts)
+    rollup['sum'] = numpy.add.reduceat(records['sum'], starts)
+    rollup['count'] = numpy.add.reduceat(records['count'], starts)
+  return rollup
+
+
+class SeriesStore(object):
+  """Series of (ts, value) points, in memory-mapped chunks under a directory.
+
+  Unlike an RRD, points may arrive out of order (by up to window seconds),
+  and reads of any range return views of the chunks rather than copies.
+  Rollups at each of ROLLUPS are built by a background thread.
+  """
+
+  def __init__(self, directory, window=REORDER_WINDOW,
+               rollup_interval=ROLLUP_INTERVAL):
+    if numpy is None:
+      raise ImportError('The SeriesStore needs numpy')
+    self.directory = directory
+    self.window = window
+    self.series = {}
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.closing = False
+    self.thread = None
+    if rollup_interval:
+      self.rollup_interval = rollup_interval
+      self.thread = threading.Thread(target=self.BuildRollups,
+                                     name='rollups')
+      self.thread.daemon = True
+      self.thread.start()
+
+  def Names(self):
+    if not os.path.isdir(self.directory):
+      return []
+    return sorted(os.listdir(self.directory))
+
+  def Get(self, name):
+    if name not in self.series:
+      self.series[name] = Series(os.path.join(self.directory, name),
+                                 self.window)
+    return self.series[name]
+
+  def Add(self, name, ts, value):
+    with self.lock:
+      return self.Get(name).Add(ts, value)
+
+  def Range(self, name, start=None, end=None, resolution=None):
+    with self.lock:
+      return self.Get(name).Range(start, end, resolution)
+
+  def Rejected(self):
+    return sum(series.rejected for series in self.series.itervalues())
+
+  def Flush(self):
+    """Writes the points added so far to disk, and wakes the rollups."""
+    with self.lock:
+      for series in self.series.itervalues():
+        series.Flush()
+    self.wake.set()
+
+  def BuildRollups(self):
+    while not self.closing:
+      self.wake.wait(self.rollup_interval)
+      self.wake.clear()
+      self.Rollup()
+
+  def Rollup(self):
+    for name in self.series.keys():
+      with self.lock:
+        series = self.series[name]
+        series.Rollup()
+        series.Flush()
+
+  def Close(self):
+    if self.thread:
+      self.closing = True
+      self.wake.set()
+      self.thread.join()
+    self.Rollup()
+
+
+def SelfTest():
+  """Checks out of order points read back in order, after reopening."""
+  import random
+  import shutil
+  import tempfile
+  directory = tempfile.mkdtemp()
+  try:
+    # Small chunks, so that inserts push records on across several of them.
+    chunks = ChunkedArray(directory, 'points', POINT_DTYPE, chunk_len=4)
+    chunks.Append(numpy.array([(ts, ts) for ts in xrange(0, 40, 2)],
+                              dtype=POINT_DTYPE))
+    expected = dict((ts, ts) for ts in xrange(0, 40, 2))
+    inserts = range(1, 40, 2) + [6, 40, 41]
+    random.Random(1).shuffle(inserts)
+    for ts in inserts:
+      chunks.Insert(numpy.array((ts, -ts), dtype=POINT_DTYPE))
+      expected[ts] = -ts
+    chunks.Flush()
+    chunks = ChunkedArray(directory, 'points', POINT_DTYPE, chunk_len=4)
+    points = numpy.concatenate(chunks.Range())
+    assert points.tolist() == sorted(expected.items()), points
+    assert chunks.starts == sorted(chunks.starts)
+    assert numpy.concatenate(chunks.Range(10.5, 20)).tolist() == [
+        (ts, expected[ts]) for ts in xrange(11, 20)]
+
+    store = SeriesStore(os.path.join(directory, 'store'), window=600,
+                        rollup_interval=None)
+    rand = random.Random(2)
+    expected = {}
+    for i in xrange(10000):
+      ts = 1500000000 + i * 10 - rand.randint(0, 590)
+      store.Add('temp', ts, i)
+      expected[ts] = i
+    assert not store.Add('temp', max(expected) - 601, 0)
+    assert store.Rejected() == 1
+    store.Flush()
+    store.Close()
+    store = SeriesStore(os.path.join(directory, 'store'), rollup_interval=None)
+    assert store.Names() == ['temp']
+    points = numpy.concatenate(store.Range('temp'))
+    assert points.tolist() == sorted(expected.items())
+    # Rollups cover the points up to the window before the last.
+    for resolution in ROLLUPS:
+      rollups = numpy.concatenate(store.Range('temp', resolution=resolution))
+      until = rollups['ts'][-1] + resolution
+      points = [value for when, value in expected.iteritems() if when < until]
+      assert rollups['count'].sum() == len(points)
+      assert rollups['sum'].sum() == sum(points)
+      assert rollups['max'].max() == max(points)
+    store.Close()
+  finally:
+    shutil.rmtree(directory)
+  print 'OK'
+
+
+if __name__ == "__main__":
+  SelfTest()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Delivers the metrics parsed once from the logs to several targets.
+import base_updater
+import os
+import threading
+
+
+# Metrics buffered for each sink before appending them to its spool, and the
+# most spooled bytes a sink hands its target between watermarks.
+SINK_BUFFER = 10000
+SINK_CHUNK_BYTES = 1 << 20
+# Seconds before a sink retries a target which failed.
+SINK_RETRY = 10
+
+
+def ParseSpoolValue(text):
+  """Reverses the repr() of a metric value written to a sink spool."""
+  if text[0] in '\'"':
+    return text[1:-1]
+  try:
+    return int(text.rstrip('L'))
+  except ValueError:
+    return float(text)
+
+
+class Sink(object):
+  """Delivers metrics to a target (eg an RRDUpdater) from its own thread.
+
+  Metrics are appended to a spool file in the state_dir, which the thread
+  hands to target.ReportMetric. Once target.SaveHistory has made them durable
+  the spool offset reached is saved as the watermark, which is where the sink
+  carries on from after a restart. So a slow or failing target only falls
+  behind in its spool, without holding up parsing or any other sink.
+  """
+
+  def __init__(self, name, target, state_dir):
+    self.name = name
+    self.target = target
+    self.spool_file = os.path.join(state_dir, 'sink-%s.spool' % name)
+    self.watermark_file = os.path.join(state_dir, 'sink-%s.watermark' % name)
+    self.buffer = []
+    self.lock = threading.Condition()
+    self.closing = False
+    self.delivered = 0
+    self.failures = 0
+    self.spool = open(self.spool_file, 'a')
+    self.size = os.path.getsize(self.spool_file)
+    self.watermark = 0
+    if os.path.exists(self.watermark_file):
+      with open(self.watermark_file, 'r') as fp:
+        self.watermark = int(fp.read().strip() or 0)
+    if self.watermark > self.size:
+      # The spool was emptied, but the watermark not yet reset.
+      self.watermark = 0
+    self.thread = threading.Thread(target=self.Run, name='sink-%s' % name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Add(self, line):
+    self.buffer.append(line)
+    if len(self.buffer) >= SINK_BUFFER:
+      self.Flush()
+
+  def Flush(self):
+    """Appends the buffered metrics to the spool, for the thread to send."""
+    if not self.buffer:
+      return
+    data = ''.join(self.buffer)
+    self.buffer = []
+    with self.lock:
+      self.spool.write(data)
+      self.spool.flush()
+      self.size += len(data)
+      self.lock.notify()
+
+  def Sync(self):
+    self.Flush()
+    with self.lock:
+      os.fsync(self.spool.fileno())
+
+  def Pending(self):
+    with self.lock:
+      return self.size - self.watermark
+
+  def Run(self):
+    with open(self.spool_file, 'r') as fp:
+      while True:
+        with self.lock:
+          while self.watermark == self.size and not self.closing:
+            self.lock.wait()
+          if self.watermark == self.size:
+            return
+          start, end = self.watermark, self.size
+        fp.seek(start)
+        data = fp.read(min(end - start, SINK_CHUNK_BYTES))
+        data = data[:data.rfind('\n') + 1]
+        try:
+          self.Deliver(data)
+        except Exception, e:
+          self.failures += 1
+          print 'Sink %s failed, retrying in %ds:' % (self.name, SINK_RETRY), e
+          with self.lock:
+            if not self.closing:
+              self.lock.wait(SINK_RETRY)
+            if self.closing:
+              return
+          continue
+        self.Advance(len(data))
+
+  def Deliver(self, data):
+    for line in data.splitlines():
+      node_id, metric, ts, value = line.split(' ', 3)
+      self.target.ReportMetric(int(node_id), metric, float(ts),
+                               ParseSpoolValue(value))
+      self.delivered += 1
+    self.target.SaveHistory(False)
+
+  def Advance(self, length):
+    """Moves the watermark past metrics the target has made durable."""
+    with self.lock:
+      self.watermark += length
+      if self.watermark == self.size:
+        # All sent, so start the spool afresh rather than let it grow.
+        self.spool.truncate(0)
+        self.watermark = self.size = 0
+      with open('%s.tmp' % self.watermark_file, 'w') as fp:
+        fp.write('%d\n' % self.watermark)
+      os.rename('%s.tmp' % self.watermark_file, self.watermark_file)
+
+  def Close(self):
+    """Waits for the thread to send everything spooled."""
+    self.Flush()
+    with self.lock:
+      self.closing = True
+      self.lock.notify()
+    self.thread.join()
+    self.spool.close()
+    self.target.CloseOutput()
+    pending = self.Pending()
+    print 'Sink %s: delivered %d metrics%s' % (self.name, self.delivered,
+        pending and ', %d bytes left spooled' % pending or '')
+
+
+class FanOutUpdater(base_updater.Updater):
+  """Parses the logs once, delivering each metric to several sinks.
+
+  The sinks have their own spools and watermarks (see Sink), so the history
+  of this updater only records how far the logs have been parsed.
+  """
+
+  def __init__(self, state_dir, dry_run, debug=False):
+    # self.history must be defined first to avoid infinite loop in setattr.
+    self.sinks = []
+    super(FanOutUpdater, self).__init__(state_dir, 'fanout-history.db',
+                                        dry_run, debug)
+
+  def AddSink(self, name, target):
+    """Registers an Updater as a sink, sending it metrics via ReportMetric.
+
+    The target need only have ReportMetric, SaveHistory and CloseOutput.
+    """
+    if self.dry_run:
+      # Nothing is spooled, the targets report what they would write.
+      self.sinks.append(target)
+    else:
+      self.sinks.append(Sink(name, target, self.state_dir))
+
+  def ReportMetric(self, node_id, metric, ts, value):
+    if self.dry_run:
+      for target in self.sinks:
+        target.ReportMetric(node_id, metric, ts, value)
+      return
+    line = '%d %s %r %r\n' % (node_id, metric, ts, value)
+    for sink in self.sinks:
+      sink.Add(line)
+
+  def FlushOutput(self):
+    if not self.dry_run:
+      for sink in self.sinks:
+        sink.Flush()
+
+  def SaveHistory(self, announce=True):
+    # The parse position saved must not be ahead of what has been spooled.
+    if not self.dry_run:
+      for sink in self.sinks:
+        sink.Sync()
+    super(FanOutUpdater, self).SaveHistory(announce)
+
+  def InstrumentedCalls(self):
+    calls = super(FanOutUpdater, self).InstrumentedCalls()
+    if not self.dry_run:
+      calls += [(sink, 'Flush', 'spool write', None) for sink in self.sinks]
+    return calls
+
+  def FinishedProcessing(self):
+    super(FanOutUpdater, self).FinishedProcessing()
+    for sink in self.sinks:
+      if self.dry_run:
+        sink.CloseOutput()
+      else:
+        sink.Close()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
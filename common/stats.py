@@ -7,51 +7,261 @@
 # Requires numpy (apt-get install python-numpy).
 #
 # Calculates basic statistics about the logs generated by logger.py
-from numpy import array
+import common
+import itertools
+import math
+import numpy
+import optparse
+import os
+import stream_stats
 import sys
 import time
 
+# Stop binary searching a log once the range left is this small, and scan it.
+SEEK_BYTES = 4096
+
+
+def LineTs(line):
+  try:
+    return float(line.split(' ', 1)[0])
+  except ValueError:
+    return None
+
+
+def FirstTs(filename):
+  """Returns the timestamp of the first report in filename, or None."""
+  with common.OpenLog(filename) as fp:
+    for line in fp:
+      ts = LineTs(line)
+      if ts is not None:
+        return ts
+  return None
+
+
+def FilesAfter(files, threshold):
+  """Returns the files which may hold reports at or after threshold.
+
+  files must be in time order. The last file starting before threshold is
+  kept, as its later reports may be after it.
+  """
+  lo, hi = 0, len(files)
+  while lo < hi:
+    mid = (lo + hi) // 2
+    ts = FirstTs(files[mid])
+    if ts is not None and ts < threshold:
+      lo = mid + 1
+    else:
+      hi = mid
+  return files[max(0, lo - 1):]
+
+
+def SeekToTime(fp, threshold):
+  """Positions fp at the first line at or after threshold, returning offset.
+
+  Lines must be in time order, which lets the search skip straight over the
+  start of the file.
+  """
+  fp.seek(0, os.SEEK_END)
+  lo, hi = 0, fp.tell()
+  while hi - lo > SEEK_BYTES:
+    mid = (lo + hi) // 2
+    fp.seek(mid)
+    fp.readline()
+    ts = None
+    while ts is None and fp.tell() < hi:
+      line = fp.readline()
+      if not line:
+        break
+      ts = LineTs(line)
+    if ts is not None and ts < threshold:
+      lo = mid
+    else:
+      hi = mid
+  fp.seek(lo)
+  if lo:
+    fp.readline()
+  while True:
+    offset = fp.tell()
+    line = fp.readline()
+    if not line:
+      break
+    ts = LineTs(line)
+    if ts is not None and ts >= threshold:
+      break
+  fp.seek(offset)
+  return offset
+
+
+class NodeStats(object):
+  """Intervals between, and reports lost from, a single node's reports."""
+
+  def __init__(self):
+    self.intervals = stream_stats.GapStats()
+    self.received = 0
+    self.expected = 0
+    self.restarts = 0
+    self.last_ts = None
+    self.last_ping_id = None
+
+  def AddReports(self, ts, ping_ids):
+    ping_ids = ping_ids.astype(numpy.int64)
+    if self.last_ts is not None:
+      ts = numpy.concatenate(([self.last_ts], ts))
+      ping_ids = numpy.concatenate(([self.last_ping_id], ping_ids))
+    else:
+      self.expected += 1
+    self.intervals.AddArray(numpy.diff(ts))
+    steps = numpy.diff(ping_ids)
+    # A ping_id which doesn't go up means the node restarted.
+    forward = steps > 0
+    self.expected += int(steps[forward].sum()) + int((~forward).sum())
+    self.restarts += int((~forward).sum())
+    self.received += len(ts) - (self.last_ts is not None)
+    self.last_ts = ts[-1]
+    self.last_ping_id = ping_ids[-1]
+
+  def Loss(self):
+    if not self.expected:
+      return 0.0
+    return 100.0 * (self.expected - self.received) / self.expected
+
+
+class LogStats(object):
+  """Streams reports from logs into constant memory statistics."""
+
+  def __init__(self, threshold=None, node_ids=None, debug=False,
+               save_index=False):
+    self.threshold = threshold
+    self.node_ids = node_ids
+    self.debug = debug
+    self.save_index = save_index
+    self.intervals = stream_stats.GapStats()
+    self.earliest = None
+    self.latest = None
+    self.last_ts = None
+    self.nodes = {}
+
+  def ProcessPaths(self, paths):
+    """Processes log files, and directories of logs via their LogIndex."""
+    files = [path for path in paths if not os.path.isdir(path)]
+    self.ProcessFiles(files)
+    for path in paths:
+      if os.path.isdir(path):
+        self.ProcessIndex(common.LogIndex(path).Update())
+
+  def ProcessIndex(self, index):
+    if self.save_index:
+      try:
+        index.Save()
+      except (IOError, OSError), e:
+        print 'Could not save %s:' % index.filename, e
+    lines = index.Lines(self.threshold, None, self.node_ids)
+    while True:
+      chunk = list(itertools.islice(lines, common.BATCH_LINES))
+      if not chunk:
+        break
+      self.AddRecords(common.DecodeLines(chunk, 0, self.debug))
+
+  def ProcessFiles(self, files):
+    files = common.UniqueLogs(files)
+    if not files:
+      return
+    if self.threshold is not None:
+      files = FilesAfter(files, self.threshold)
+    for filename in files:
+      with common.OpenLog(filename) as fp:
+        offset = 0
+        # Compressed logs can't be searched, but are still filtered by time.
+        if self.threshold is not None and not common.IsCompressed(filename):
+          offset = SeekToTime(fp, self.threshold)
+        for records, _, _ in common.DecodeFile(fp, 0, self.debug, offset):
+          self.AddRecords(records)
+
+  def AddRecords(self, records):
+    if self.threshold is not None:
+      records = records[records['ts'] >= self.threshold]
+    if self.node_ids is not None:
+      records = records[numpy.in1d(records['node_id'], list(self.node_ids))]
+    if not len(records):
+      return
+    ts = records['ts']
+    if self.last_ts is None:
+      self.earliest = self.latest = ts[0]
+    else:
+      ts = numpy.concatenate(([self.last_ts], ts))
+    self.intervals.AddArray(numpy.diff(ts))
+    self.earliest = min(self.earliest, ts.min())
+    self.latest = max(self.latest, ts.max())
+    self.last_ts = ts[-1]
+    node_ids = records['node_id']
+    for node_id in numpy.unique(node_ids).tolist():
+      mine = node_ids == node_id
+      if node_id not in self.nodes:
+        self.nodes[node_id] = NodeStats()
+      self.nodes[node_id].AddReports(records['ts'][mine],
+                                     records['ping_id'][mine])
+
+  def PrintSummary(self):
+    d = self.intervals
+    print '%d intervals from %s till %s' % (len(d),
+        time.ctime(self.earliest), time.ctime(self.latest))
+    if not len(d):
+      return
+    print 'average interval %.02f seconds' % (d.Average())
+    print 'interval stddev %.02f seconds' % (math.sqrt(d.Variance()))
+    print 'minimum interval %.02f seconds' % d.min
+    print 'maximum interval %.02f seconds' % d.max
+    print
+    print '%4s %9s %9s %6s %8s %8s %8s %8s %8s' % ('node', 'reports',
+        'expected', 'loss', 'restarts', 'avg', 'p50', 'p95', 'max')
+    for node_id in sorted(self.nodes.keys()):
+      node = self.nodes[node_id]
+      gaps = node.intervals
+      if len(gaps):
+        intervals = '%8.1f %8.1f %8.1f %8.1f' % (gaps.Average(),
+            gaps.Quantile(0.5), gaps.Quantile(0.95), gaps.max)
+      else:
+        intervals = '%8s %8s %8s %8s' % ('-', '-', '-', '-')
+      print '%4d %9d %9d %5.1f%% %8d %s' % (node_id, node.received,
+          node.expected, node.Loss(), node.restarts, intervals)
+
+
 def main():
-  if len(sys.argv) < 2:
-    sys.stderr.write('Usage: %s /path/to/log [past hours]\n' % sys.argv[0])
+  parser = optparse.OptionParser(
+      usage='%prog [--hours n] log_file_or_dir [...]')
+  parser.add_option('--hours', action='store', dest='hours', type='int',
+      default=None, help='Only look at reports from the past n hours')
+  parser.add_option('--nodes', action='store', dest='nodes', default=None,
+      help='Comma separated node_ids to only look at reports from')
+  parser.add_option('--save_index', action='store_true', dest='save_index',
+      help='Save the index built of each log directory into it, to be '
+          'updated rather than rebuilt by later runs')
+  parser.add_option('--debug', action='store_true', dest='debug')
+  options, args = parser.parse_args()
+  # Also accept the old "/path/to/log [past hours]" form.
+  if (len(args) == 2 and args[1].isdigit() and not os.path.exists(args[1])
+      and options.hours is None):
+    options.hours = int(args.pop())
+  if len(args) < 1:
+    sys.stderr.write('Usage: %s [--hours n] /path/to/log_or_dir [...]\n' %
+        sys.argv[0])
     sys.exit(1)
 
-  now = time.time()
-  if len(sys.argv) > 2:
-    threshold = now - (int(sys.argv[2])*3600)
-  else:
-    threshold = -1
-  earliest = -1
-  latest = -1
-  intervals = []
-  last = -1
-  for line in open(sys.argv[1], 'r'):
-    if ' OK ' not in line:
-      continue
-    parts = line.strip().split(' ')
-    ts = float(parts[0])
-    if threshold != -1 and ts < threshold:
-      continue
-    if last != -1:
-      interval = ts - last
-      intervals.append(interval)
-    else:
-      earliest = ts
-      latest = ts
-    earliest = min(ts, earliest)
-    latest = max(ts, latest)
-    last = ts
-
-  print '%d intervals from %s till %s' % (len(intervals),
-      time.ctime(earliest), time.ctime(latest))
-  d = array(intervals)
-  print 'average interval %.02f seconds' % (d.mean())
-  print 'interval stddev %.02f seconds' % (d.std())
-  print 'minimum interval %.02f seconds' % d.min()
-  print 'maximum interval %.02f seconds' % d.max()
+  threshold = None
+  if options.hours is not None:
+    threshold = time.time() - (options.hours * 3600)
+  node_ids = None
+  if options.nodes:
+    node_ids = set(int(node_id) for node_id in options.nodes.split(','))
+  stats = LogStats(threshold, node_ids, options.debug, options.save_index)
+  stats.ProcessPaths(args)
+  if stats.last_ts is None:
+    print 'No reports found'
+    return
+  stats.PrintSummary()
 
 if __name__ == "__main__":
   main()
 
 # Vim modeline
-# vim: set ts=2 sw=2 sts=2 et: 
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Constant memory summaries of streams of values, eg the gaps between reports.
+import copy
+import math
+
+
+# Resolution of the quantile sketches kept for report gaps (relative, ie 5%)
+# and temperatures (absolute, in degrees).
+GAP_RESOLUTION = 0.05
+TEMP_RESOLUTION = 0.1
+
+
+def IsFinite(value):
+  return not (math.isnan(value) or math.isinf(value))
+
+
+class StreamStats(object):
+  """Constant memory summary statistics over a stream of values.
+
+  Keeps the count, sum, min and max, the variance (via Welford's method) and
+  a sketch for approximate quantiles. The sketch counts values into buckets
+  of a fixed width, or for relative sketches buckets a fixed fraction wide,
+  so only as many buckets as there are distinct ranges of values are kept.
+  Two StreamStats with the same resolution can be merged. NaN and infinite
+  values are ignored, as they have no bucket.
+  """
+
+  def __init__(self, resolution, relative=False):
+    self.resolution = resolution
+    self.relative = relative
+    self.count = 0
+    self.total = 0.0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.min = None
+    self.max = None
+    self.buckets = {}
+
+  @classmethod
+  def FromValues(cls, values, resolution, relative=False):
+    stats = cls(resolution, relative)
+    for value in values:
+      stats.Add(value)
+    return stats
+
+  def __len__(self):
+    return self.count
+
+  def Bucket(self, value):
+    if not self.relative:
+      return int(math.floor(value / self.resolution))
+    if value <= 0:
+      return None
+    return int(math.floor(math.log(value) / math.log1p(self.resolution)))
+
+  def BucketBounds(self, bucket):
+    if bucket is None:
+      return self.min, 0
+    if not self.relative:
+      return bucket * self.resolution, (bucket + 1) * self.resolution
+    return ((1 + self.resolution) ** bucket,
+            (1 + self.resolution) ** (bucket + 1))
+
+  def Add(self, value):
+    if not IsFinite(value):
+      return
+    self.count += 1
+    self.total += value
+    delta = value - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (value - self.mean)
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    bucket = self.Bucket(value)
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+  def AddArray(self, values):
+    """Adds each value in a numpy array, in a single vectorized pass.
+
+    The total is summed in order, so comes out exactly as from Add.
+    """
+    # Only the batch decoder has arrays, so numpy is not loaded until then.
+    import numpy
+    values = values[numpy.isfinite(values)]
+    if not len(values):
+      return
+    total = numpy.cumsum(numpy.concatenate(([self.total], values)))[-1]
+    other = StreamStats(self.resolution, self.relative)
+    other.count = len(values)
+    other.total = float(values.sum())
+    other.mean = other.total / other.count
+    other.m2 = float(((values - other.mean) ** 2).sum())
+    other.min = float(values.min())
+    other.max = float(values.max())
+    if self.relative:
+      positive = values > 0
+      if not positive.all():
+        other.buckets[None] = int((~positive).sum())
+      buckets = numpy.floor(numpy.log(values[positive]) /
+                            math.log1p(self.resolution))
+    else:
+      buckets = numpy.floor(values / self.resolution)
+    keys, counts = numpy.unique(buckets.astype(numpy.int64),
+                                return_counts=True)
+    other.buckets.update(zip(keys.tolist(), counts.tolist()))
+    self.Merge(other)
+    self.total = float(total)
+
+  def Merge(self, other):
+    if not other.count:
+      return
+    if not self.count:
+      self.__dict__.update(copy.deepcopy(other.__dict__))
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.m2 += other.m2 + delta * delta * self.count * other.count / count
+    self.mean += delta * other.count / count
+    self.count = count
+    self.total += other.total
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    for bucket, n in other.buckets.iteritems():
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+
+  def Average(self):
+    """The mean, as the plain sum divided by the count."""
+    return self.total / self.count
+
+  def Variance(self):
+    if self.count < 2:
+      return 0.0
+    return self.m2 / self.count
+
+  def Quantile(self, q):
+    """Returns the approximate q (0 <= q <= 1) quantile, or None if empty."""
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    # None (values <= 0 in a relative sketch) sorts first.
+    for bucket in sorted(self.buckets.keys()):
+      n = self.buckets[bucket]
+      if seen + n >= rank:
+        lo, hi = self.BucketBounds(bucket)
+        value = lo + (hi - lo) * (rank - seen) / n
+        return min(max(value, self.min), self.max)
+      seen += n
+    return self.max
+
+
+def GapStats(values=()):
+  return StreamStats.FromValues(values, GAP_RESOLUTION, True)
+
+
+def TempStats(values=()):
+  return StreamStats.FromValues(values, TEMP_RESOLUTION)
+
+
+def SelfTest():
+  """Checks the quantiles are within a bucket of the exact ones."""
+  import random
+  rand = random.Random(1)
+  gaps = [rand.lognormvariate(4, 1) for _ in xrange(5000)]
+  temps = [rand.gauss(18, 3) for _ in xrange(5000)]
+  for stats, values, Error in (
+      (GapStats(gaps), gaps, lambda exact: exact * GAP_RESOLUTION),
+      (TempStats(temps), temps, lambda exact: TEMP_RESOLUTION)):
+    ordered = sorted(values)
+    for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1):
+      exact = ordered[int(math.ceil(q * len(ordered))) - 1]
+      error = abs(stats.Quantile(q) - exact)
+      assert error <= Error(exact), (q, stats.Quantile(q), exact)
+    assert (stats.min, stats.max) == (ordered[0], ordered[-1])
+    assert abs(stats.Average() - sum(values) / len(values)) < 1e-9
+    # Halves merged, and NaNs skipped, give the same sketch.
+    half = len(values) // 2
+    merged = StreamStats.FromValues(values[:half] + [float('nan')],
+                                    stats.resolution, stats.relative)
+    merged.Merge(StreamStats.FromValues(values[half:], stats.resolution,
+                                        stats.relative))
+    assert merged.count == stats.count and merged.buckets == stats.buckets
+    assert abs(merged.Variance() - stats.Variance()) < 1e-6 * stats.Variance()
+    try:
+      import numpy
+    except ImportError:
+      continue
+    batch = StreamStats(stats.resolution, stats.relative)
+    batch.AddArray(numpy.array(values))
+    assert batch.total == stats.total and batch.buckets == stats.buckets
+  print 'OK'
+
+
+if __name__ == "__main__":
+  SelfTest()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
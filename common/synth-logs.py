@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Writes synthetic hourly logs, in the format written by logger.py and
+# jeelogger, from MeterReader and TempSensor nodes, along with a config for
+# them. For benchmarking the updaters (see benchmark.py) without a copy of
+# real logs.
+#
+# Reports are lost, nodes reboot (restarting their ping_id and counter), meter
+# counters can be started close to wrapping, and corrupt packets are logged
+# as the Jeelink reports them. Some corrupt packets have a good header from a
+# real node, with a truncated or random payload (or a NaN or infinite
+# temperature), which only the decoders can reject.
+import heapq
+import math
+import optparse
+import os
+import random
+import struct
+import sys
+import time
+
+# Seconds between reports from each node, which varies by +/- JITTER.
+INTERVAL = 60
+JITTER = 0.2
+# Fraction of reports lost, and of lines which are garbage.
+LOSS = 0.05
+GARBAGE = 0.005
+# Reboots per node per day.
+REBOOTS = 0.2
+# VCC reported by nodes, 1.0V = 0 .. 6.0V = 250, ie 3.3V.
+VCC = 115
+
+
+def LongBytes(value):
+  return list(struct.unpack('4B', struct.pack('<I', value & 0xffffffff)))
+
+
+def FloatBytes(value):
+  return list(struct.unpack('4B', struct.pack('<f', value)))
+
+
+class Node(object):
+  """A node, whose subclasses define Payload(ts) for each of its reports."""
+
+  def __init__(self, node_id, rand):
+    self.node_id = node_id
+    self.rand = rand
+    self.ping_id = 0
+    self.vcc = VCC
+
+  def Reboot(self):
+    self.ping_id = 0
+
+  def Line(self, ts):
+    self.ping_id += 1
+    # Batteries slowly run down, with the odd noisy reading.
+    if self.rand.random() < 0.001:
+      self.vcc = max(self.vcc - 1, 0)
+    vcc = self.vcc + self.rand.choice((-1, 0, 0, 0, 0, 1))
+    return self.Format(ts, [vcc] + self.Payload(ts))
+
+  def Format(self, ts, payload):
+    parts = LongBytes(self.ping_id) + [self.node_id] + payload
+    return '%d OK %d %s\n' % (ts, self.node_id, ' '.join(map(str, parts)))
+
+  def Corrupt(self, ts):
+    """Returns a report with a good header, but a corrupt payload."""
+    payload = [self.vcc] + self.Payload(ts)
+    if self.rand.random() < 0.5:
+      return self.Format(ts, payload[:self.rand.randint(0, len(payload) - 1)])
+    return self.Format(ts, [self.rand.randint(0, 255)
+                            for _ in xrange(self.rand.randint(1, 8))])
+
+
+class MeterReader(Node):
+
+  def __init__(self, node_id, rand, wrap=False):
+    super(MeterReader, self).__init__(node_id, rand)
+    self.counter = 0
+    if wrap:
+      self.counter = 2**32 - rand.randint(1000, 100000)
+
+  def Reboot(self):
+    super(MeterReader, self).Reboot()
+    self.counter = 0
+
+  def Payload(self, ts):
+    # Revolutions since the last report, busier in the evening.
+    hour = (ts % 86400) / 3600.0
+    load = 1.5 + math.sin((hour - 12) * math.pi / 12)
+    self.counter = (self.counter + int(self.rand.expovariate(1 / (4 * load)))
+                    ) % 2**32
+    return LongBytes(self.counter)
+
+
+class TempSensor(Node):
+
+  def __init__(self, node_id, rand):
+    super(TempSensor, self).__init__(node_id, rand)
+    self.base = rand.uniform(14, 22)
+
+  def Payload(self, ts):
+    # Warmest mid afternoon.
+    hour = (ts % 86400) / 3600.0
+    temp = (self.base + 3 * math.sin((hour - 9) * math.pi / 12) +
+            self.rand.gauss(0, 0.2))
+    return FloatBytes(round(temp * 16) / 16)
+
+  def Corrupt(self, ts):
+    if self.rand.random() < 0.5:
+      value = self.rand.choice((float('nan'), float('inf'), float('-inf')))
+      return self.Format(ts, [self.vcc] + FloatBytes(value))
+    return super(TempSensor, self).Corrupt(ts)
+
+
+def Garbage(ts, rand, nodes):
+  """Returns a line as the Jeelink logs a corrupt or truncated packet."""
+  if rand.random() < 0.5:
+    return rand.choice(nodes).Corrupt(ts)
+  if rand.random() < 0.5:
+    return '%d  ? %s\n' % (ts, ' '.join(str(rand.randint(0, 255))
+                                         for _ in xrange(rand.randint(1, 20))))
+  return '%d OK %d %s\n' % (ts, rand.randint(1, 30), ' '.join(
+      str(rand.randint(0, 255)) for _ in xrange(rand.randint(0, 4))))
+
+
+class LogSynthesizer(object):
+  """Writes the reports of a set of nodes to hourly logs in log_dir."""
+
+  def __init__(self, log_dir, meters=1, temps=3, interval=INTERVAL,
+               loss=LOSS, garbage=GARBAGE, reboots=REBOOTS, wrap=False,
+               seed=None):
+    self.log_dir = log_dir
+    self.interval = interval
+    self.loss = loss
+    self.garbage = garbage
+    self.reboots = reboots
+    self.rand = random.Random(seed)
+    self.nodes = []
+    for i in xrange(meters):
+      self.nodes.append(MeterReader(len(self.nodes) + 1, self.rand, wrap))
+    for i in xrange(temps):
+      self.nodes.append(TempSensor(len(self.nodes) + 1, self.rand))
+    self.lines = 0
+    self.reports = 0
+
+  def WriteConfig(self):
+    with open(os.path.join(self.log_dir, 'config'), 'w') as fp:
+      for node in self.nodes:
+        fp.write('%d %s %s%d\n' % (node.node_id, node.__class__.__name__,
+                                   node.__class__.__name__, node.node_id))
+
+  def Write(self, start, end):
+    """Writes the reports from start till end (in seconds since the epoch)."""
+    queue = [(start + self.rand.uniform(0, self.interval), node.node_id, node)
+             for node in self.nodes]
+    heapq.heapify(queue)
+    reboot_chance = self.reboots * self.interval / 86400.0
+    fp = None
+    hour = None
+    while queue[0][0] < end:
+      ts, node_id, node = heapq.heappop(queue)
+      name = time.strftime('%Y%m%d%H.log', time.gmtime(ts))
+      if name != hour:
+        if fp:
+          fp.close()
+        fp = open(os.path.join(self.log_dir, name), 'w')
+        hour = name
+      if self.rand.random() < reboot_chance:
+        node.Reboot()
+      # Lost reports still use up a ping_id.
+      line = node.Line(ts)
+      self.reports += 1
+      if self.rand.random() >= self.loss:
+        fp.write(line)
+        self.lines += 1
+      if self.rand.random() < self.garbage:
+        fp.write(Garbage(ts, self.rand, self.nodes))
+        self.lines += 1
+      next_ts = ts + self.interval * self.rand.uniform(1 - JITTER, 1 + JITTER)
+      heapq.heappush(queue, (next_ts, node_id, node))
+    if fp:
+      fp.close()
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] log_dir')
+  parser.add_option('--meters', action='store', dest='meters', type='int',
+      default=1, help='Number of MeterReader nodes')
+  parser.add_option('--temps', action='store', dest='temps', type='int',
+      default=3, help='Number of TempSensor nodes')
+  parser.add_option('--days', action='store', dest='days', type='float',
+      default=1, help='Days of logs to write')
+  parser.add_option('--end', action='store', dest='end', type='int',
+      default=None, help='Time of the end of the logs, defaulting to now')
+  parser.add_option('--interval', action='store', dest='interval',
+      type='float', default=INTERVAL,
+      help='Average seconds between reports from each node')
+  parser.add_option('--loss', action='store', dest='loss', type='float',
+      default=LOSS, help='Fraction of reports lost')
+  parser.add_option('--garbage', action='store', dest='garbage',
+      type='float', default=GARBAGE,
+      help='Fraction of reports followed by a corrupt packet')
+  parser.add_option('--reboots', action='store', dest='reboots',
+      type='float', default=REBOOTS, help='Reboots per node per day')
+  parser.add_option('--wrap', action='store_true', dest='wrap',
+      help='Start meter counters close to wrapping')
+  parser.add_option('--seed', action='store', dest='seed', type='int',
+      default=None, help='Seed for repeatable logs')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    sys.stderr.write('Usage: %s [options] log_dir\n' % sys.argv[0])
+    sys.exit(1)
+
+  log_dir = args[0]
+  if not os.path.isdir(log_dir):
+    os.makedirs(log_dir)
+  end = options.end or int(time.time())
+  synth = LogSynthesizer(log_dir, options.meters, options.temps,
+                         options.interval, options.loss, options.garbage,
+                         options.reboots, options.wrap, options.seed)
+  synth.WriteConfig()
+  synth.Write(end - int(options.days * 86400), end)
+  print 'Wrote %d lines (%d reports) from %d nodes to %s' % (
+      synth.lines, synth.reports, len(synth.nodes), log_dir)
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -16,11 +16,18 @@
 #    LINE1:mv#ff0000:Voltage && eog /tmp/test.png
 #
 # Reads logger.py output and generates rrd updates.
+import array
+import base_updater
 import common
+import multiprocessing
 import optparse
 import os
+import rollup_store
 import rrdtool
+import shutil
 import sys
+import tempfile
+import time
 
 START_TS = 1351378113
 # Assuming 60s step size.
@@ -28,51 +35,116 @@ RRA_LAST = 'RRA:LAST:0.9:1:2628000'    # 5 years of exact measurements.
 RRA_5 = 'RRA:AVERAGE:0.9:5:1051200'    # 10 years of 5min averages.
 RRA_60 = 'RRA:AVERAGE:0.9:60:87600'    # 10 years of 1hr averages.
 RRAS = (RRA_LAST, RRA_5, RRA_60)
+# Default maximum age (in seconds) of batched updates before they are written.
+UPDATE_BATCH_AGE = 60
+# Directory in the state_dir which --rebuild builds RRDs in, and the file in
+# it marking them ready to be moved into the state_dir.
+REBUILD_DIR = 'rebuild.tmp'
+REBUILD_DONE = 'complete'
+# Values per rrdtool update call when rebuilding, and per DS held in memory
+# before being spilled to the rebuild directory.
+REBUILD_BATCH = 4096
+REBUILD_SPILL = 65536
+# Layout of the (ts, value) pairs spilled per DS when rebuilding.
+SERIES_DTYPE = [('ts', '<f8'), ('value', '<f8')]
 
 
-class RRDUpdater(common.Updater):
+def CreateRRDFile(rrdfile, ds, ds_type):
+  rrdtool.create(rrdfile,
+      '--start', str(START_TS), '--step', '60',
+      ['DS:%s:%s' % (ds, ds_type)],
+      *RRAS)
+
+
+def FormatLimit(value):
+  """Formats a value from rrdtool.info as rrdtool create would take it."""
+  if value is None or value != value:
+    return 'U'
+  if isinstance(value, float) and value == int(value):
+    return '%d' % value
+  return str(value)
+
+
+class RRDUpdater(base_updater.Updater):
   """Updates RRDs based on a directory of logfiles."""
 
   def __init__(self, state_dir, dry_run, debug=False):
     # self.history must be defined first to avoid infinite loop in setattr.
-    self.rrds = []
+    self.catalog = common.RRDCatalog(state_dir)
+    # RRDs known to exist this run.
+    self.checked = set()
     self.update_ts = None
     self.update_queue = {}
-    super(RRDUpdater, self).__init__(state_dir, 'rrd-history.pickle', dry_run, debug)
+    # Updates batched per rrd when update_batch is set: rrd -> [template,
+    # time first queued, last queued ts, values].
+    self.update_batch = 0
+    self.update_batch_age = UPDATE_BATCH_AGE
+    self.pending = {}
+    self.last_age_check = 0
+    self.update_calls = 0
+    self.update_values = 0
+    super(RRDUpdater, self).__init__(state_dir, 'rrd-history.db', dry_run, debug)
 
   def CheckOrCreateRRD(self, ds):
     rrd = self.RRDForDs(ds)
-    if rrd in self.rrds:
+    if rrd in self.checked:
+      return
+    # An RRD deleted since it was cataloged is created again.
+    if self.catalog.Get(rrd) and (self.dry_run or os.path.exists(rrd)):
+      self.checked.add(rrd)
       return
-    if not os.path.exists(self.RRDForDs(ds)):
+    if not os.path.exists(rrd):
       self.CreateRRD(ds)
     else:
-      self.rrds.append(rrd)
-    
+      self.catalog.Add(rrd, self.InfoForRRD(rrd))
+    self.checked.add(rrd)
+
+  def InfoForRRD(self, rrd):
+    """Reads the catalog entry for an RRD created before the catalog."""
+    info = rrdtool.info(rrd)
+    ds = os.path.basename(rrd)[:-len('.rrd')]
+    ds_type = '%s:%s:%s:%s' % tuple(
+        FormatLimit(info['ds[%s].%s' % (ds, k)])
+        for k in ('type', 'minimal_heartbeat', 'min', 'max'))
+    rras = []
+    i = 0
+    while 'rra[%d].cf' % i in info:
+      rras.append('RRA:%s:%s:%s:%s' % tuple(
+          FormatLimit(info['rra[%d].%s' % (i, k)])
+          for k in ('cf', 'xff', 'pdp_per_row', 'rows')))
+      i += 1
+    return common.RRDInfo(ds, ds_type, info['step'], rras,
+                          info['last_update'])
+
+  def DSType(self, ds):
+    node, metric = ds.split('_', 1)
+    if self.MetricKind(int(node[len('node'):]), metric) == 'counter':
+      return 'COUNTER:300:U:U'
+    # Gauges other than bat and temp are declared in schemas, so unbounded.
+    if metric.split('_')[0] in (common.BATTERY, common.TEMPERATURE):
+      return 'GAUGE:3600:-50:255'
+    return 'GAUGE:3600:U:U'
+
   def CreateRRD(self, ds):
-    if ds.endswith('bat') or ds.endswith('temp'):
-      ds_type = 'GAUGE:3600:-50:255'
-    else:
-      ds_type = 'COUNTER:300:U:U'
+    ds_type = self.DSType(ds)
     rrdfile = self.RRDForDs(ds)
     if not self.dry_run:
       try:
-        rrdtool.create(rrdfile,
-            '--start', str(START_TS), '--step', '60',
-            ['DS:%s:%s' % (ds, ds_type)],
-            *RRAS)
+        CreateRRDFile(rrdfile, ds, ds_type)
       except rrdtool.error, e:
         sys.stderr.write('ERROR: Could not create rrd %s for %s: %s\n' %
             (rrdfile, ds, e))
         sys.exit(1)
-    self.rrds.append(rrdfile)
+    self.catalog.Add(rrdfile, common.RRDInfo(ds, ds_type, 60, RRAS, START_TS))
     print 'Created new RRD %s' % rrdfile
 
   def RRDForDs(self, ds):
     return os.path.join(self.state_dir, '%s.rrd' % ds)
 
   def UpdateRRD(self, ts, updates):
-    if self.update_ts and self.update_ts != ts:
+    # rrdtool takes one value per second, so updates within the same (whole)
+    # second are queued together, the last for each DS winning.
+    if self.update_ts and int(self.update_ts) != int(ts):
       self.FlushUpdateQueue()
     # Queue requested updates for insertion.
     self.update_queue.update(updates)
@@ -92,27 +164,102 @@ class RRDUpdater(common.Updater):
         continue
       keys = data.keys()
       datastr = ':'.join(['%s' % data[k] for k in keys])
-      try:
-        if not self.dry_run:
-          rrdtool.update(rrd, '-t', ':'.join(keys),
-              '%s:%s' % (int(self.update_ts), datastr))
-        elif self.debug:
-          print ('rrdtool update -t', ':'.join(keys),
-              '%s:%s' % (int(self.update_ts), datastr))
-      except rrdtool.error, e:
-        print e, 'from', self.update_queue, 'at', self.current_line
+      if self.update_batch:
+        self.QueueUpdate(rrd, ':'.join(keys), int(self.update_ts), datastr)
+      else:
+        self.WriteUpdates(rrd, ':'.join(keys),
+            ['%s:%s' % (int(self.update_ts), datastr)])
     self.update_queue = {}
+    if self.update_batch and time.time() - self.last_age_check >= 1:
+      self.FlushPending()
+
+  def QueueUpdate(self, rrd, template, ts, datastr):
+    """Batches an update to be written with others for the same rrd."""
+    pending = self.pending.get(rrd, None)
+    if pending and pending[0] != template:
+      self.FlushPending(rrd, force=True)
+      pending = None
+    if not pending:
+      pending = self.pending[rrd] = [template, time.time(), 0, []]
+    if ts <= pending[2]:
+      # rrdtool would reject it, failing the rest of the batch.
+      if self.debug:
+        print 'ignoring update for %s, duplicate time' % rrd, ts, datastr
+      return
+    pending[2] = ts
+    pending[3].append('%s:%s' % (ts, datastr))
+    if len(pending[3]) >= self.update_batch:
+      self.FlushPending(rrd)
+
+  def FlushPending(self, rrd=None, force=False):
+    """Writes batched updates for rrd (or all rrds) once over a limit."""
+    now = time.time()
+    self.last_age_check = now
+    for rrd in rrd and [rrd] or self.pending.keys():
+      template, queued_at, last_ts, values = self.pending[rrd]
+      if (force or len(values) >= self.update_batch or
+          now - queued_at >= self.update_batch_age):
+        del self.pending[rrd]
+        self.WriteUpdates(rrd, template, values)
+
+  def WriteUpdates(self, rrd, template, values):
+    try:
+      if not self.dry_run:
+        self.update_calls += 1
+        self.update_values += len(values)
+        rrdtool.update(rrd, '-t', template, *values)
+        self.catalog.SetLast(rrd, int(values[-1].split(':', 1)[0]))
+      elif self.debug:
+        print ('rrdtool update -t', template, ' '.join(values))
+    except rrdtool.error, e:
+      print e, 'from', rrd, values[:1], 'at', self.current_line
+      if len(values) > 1:
+        # Values before the failing one were written, retry those after it.
+        last = rrdtool.last(rrd)
+        for value in values:
+          if int(value.split(':', 1)[0]) > last:
+            self.WriteUpdates(rrd, template, [value])
+        self.catalog.SetLast(rrd, last)
 
   def LastUpdateFor(self, rrd):
     if self.dry_run and not os.path.exists(rrd):
       return 0
     if rrd not in self.latest_update:
-      self.latest_update[rrd] = rrdtool.last(rrd)
+      info = self.catalog.Get(rrd)
+      if info:
+        self.latest_update[rrd] = info.last
+      else:
+        self.latest_update[rrd] = rrdtool.last(rrd)
     return self.latest_update[rrd]
 
+  def FlushOutput(self):
+    self.FlushUpdateQueue()
+    if self.update_batch:
+      self.FlushPending(force=True)
+
+  def SaveHistory(self, announce=True):
+    # Updates are not in the history, so must be written before it is saved.
+    self.FlushOutput()
+    super(RRDUpdater, self).SaveHistory(announce)
+    if not self.dry_run:
+      self.catalog.Save()
+
+  def InstrumentedCalls(self):
+    return super(RRDUpdater, self).InstrumentedCalls() + [
+        (rrdtool, 'update', 'rrdtool update', None),
+        (rrdtool, 'last', 'rrdtool last', None),
+        (rrdtool, 'create', 'rrdtool create', None),
+        (rrdtool, 'info', 'rrdtool info', None),
+        (self.catalog, 'Save', 'catalog save', None),
+    ]
+
   def FinishedProcessing(self):
     # Make sure the last report gets flushed.
-    self.FlushUpdateQueue()
+    self.FlushOutput()
+    if self.update_batch:
+      print 'Wrote %d updates in %d rrdtool calls (%d calls saved)' % (
+          self.update_values, self.update_calls,
+          self.update_values - self.update_calls)
     # and whatever else our parent does.
     super(RRDUpdater, self).FinishedProcessing()
 
@@ -121,20 +268,267 @@ class RRDUpdater(common.Updater):
     self.UpdateRRD(ts, data)
 
 
+class RRDRebuilder(RRDUpdater):
+  """Rebuilds every RRD from the logs, in REBUILD_DIR of the state_dir.
+
+  The metrics of each DS are spilled to a file as the logs are processed,
+  then each RRD is created and filled with a sorted series of them, in
+  parallel. Finally the RRDs, catalog and history are moved into the
+  state_dir (see FinishRebuild).
+  """
+
+  def __init__(self, state_dir, debug=False):
+    # self.history must be defined first to avoid infinite loop in setattr.
+    self.final_dir = state_dir
+    self.series = {}
+    self.spilled = {}
+    scratch = os.path.join(state_dir, REBUILD_DIR)
+    # Whatever an earlier, unfinished, rebuild left.
+    shutil.rmtree(scratch, True)
+    os.mkdir(scratch)
+    for name in ('config', common.SCHEMAS):
+      if os.path.exists(os.path.join(state_dir, name)):
+        shutil.copy(os.path.join(state_dir, name), scratch)
+    super(RRDRebuilder, self).__init__(scratch, False, debug)
+
+  def ReportMetric(self, node_id, metric, ts, value):
+    ds = 'node%d_%s' % (node_id, metric)
+    series = self.series.get(ds, None)
+    if series is None:
+      series = self.series[ds] = array.array('d')
+    series.append(ts)
+    series.append(float(value))
+    if len(series) >= 2 * REBUILD_SPILL:
+      self.Spill(ds)
+
+  def Spill(self, ds):
+    with open(self.SeriesFile(ds), 'ab') as fp:
+      self.series[ds].tofile(fp)
+    self.series[ds] = array.array('d')
+
+  def SeriesFile(self, ds):
+    return os.path.join(self.state_dir, '%s.series' % ds)
+
+  def FlushOutput(self):
+    for ds in self.series.keys():
+      self.Spill(ds)
+
+  def Build(self, workers):
+    """Creates and fills the RRDs, workers at a time."""
+    self.FlushOutput()
+    jobs = [(self.RRDForDs(ds), ds, self.DSType(ds), self.SeriesFile(ds))
+            for ds in sorted(self.series.keys())]
+    pool = multiprocessing.Pool(workers)
+    try:
+      for rrd, ds, ds_type, last, written, dropped in pool.imap_unordered(
+          _RebuildRRD, jobs):
+        print 'Rebuilt %s with %d updates (%d dropped)' % (rrd, written,
+                                                          dropped)
+        self.catalog.Add(rrd, common.RRDInfo(ds, ds_type, 60, RRAS, last))
+        self.latest_update[os.path.join(self.final_dir,
+                                        os.path.basename(rrd))] = last
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    self.SaveHistory(False)
+    self.store.Close()
+    if self.rollup_store:
+      self.rollup_store.Close()
+    open(os.path.join(self.state_dir, REBUILD_DONE), 'w').close()
+
+
+def _RebuildRRD(args):
+  """Creates rrd from the metrics spilled for ds, in time order.
+
+  Only the last value for each (whole) second is kept, as rrdtool only
+  takes one, matching RRDUpdater.UpdateRRD.
+  """
+  rrd, ds, ds_type, series_file = args
+  series = common.numpy.fromfile(series_file, dtype=SERIES_DTYPE)
+  ts = series['ts'].astype(common.numpy.int64)
+  # A stable sort, so the last of several values in a second stays last.
+  order = common.numpy.argsort(ts, kind='mergesort')
+  ts = ts[order]
+  values = series['value'][order]
+  keep = common.numpy.concatenate((ts[1:] != ts[:-1], [True]))
+  keep &= ts > START_TS
+  ts = ts[keep]
+  values = values[keep]
+  CreateRRDFile(rrd, ds, ds_type)
+  # %.12g keeps the precision of str(), which RRDUpdater writes values with.
+  for i in xrange(0, len(ts), REBUILD_BATCH):
+    rrdtool.update(rrd, '-t', ds, *['%d:%.12g' % (t, v) for t, v in zip(
+        ts[i:i+REBUILD_BATCH].tolist(), values[i:i+REBUILD_BATCH].tolist())])
+  os.remove(series_file)
+  last = len(ts) and int(ts[-1]) or START_TS
+  return rrd, ds, ds_type, last, len(ts), len(series) - len(ts)
+
+
+def FinishRebuild(state_dir):
+  """Moves rebuilt RRDs, catalog, rollups and history into state_dir.
+
+  Called again at the start of each run, it finishes moving them should a
+  run have been interrupted part way through.
+  """
+  scratch = os.path.join(state_dir, REBUILD_DIR)
+  if not os.path.exists(os.path.join(scratch, REBUILD_DONE)):
+    return
+  history = 'rrd-history.db'
+  names = sorted(name for name in os.listdir(scratch)
+                 if name.endswith('.rrd'))
+  # The history last, so an interrupted move is carried on by the next run
+  # rather than the logs being processed into a mix of old and new RRDs.
+  names += [common.RRD_CATALOG, rollup_store.ROLLUP_DB, history]
+  for name in names:
+    if not os.path.exists(os.path.join(scratch, name)):
+      continue
+    if name in (rollup_store.ROLLUP_DB, history):
+      for suffix in ('-wal', '-shm'):
+        if os.path.exists(os.path.join(state_dir, name + suffix)):
+          os.remove(os.path.join(state_dir, name + suffix))
+    os.rename(os.path.join(scratch, name), os.path.join(state_dir, name))
+  shutil.rmtree(scratch)
+  print 'Moved rebuilt RRDs into %s' % state_dir
+
+
+def FetchRRD(rrd):
+  """Returns the contents of the LAST archive of rrd."""
+  return rrdtool.fetch(rrd, 'LAST', '-r', '60', '-s', str(START_TS),
+                       '-e', str(rrdtool.last(rrd)))
+
+
+def CheckRebuild(state_dir, logs, workers):
+  """Checks rebuilding the RRDs gives the same RRDs as updating them.
+
+  The logs are processed both ways, into temporary directories holding the
+  config (and schemas) of state_dir, and the name of each RRD which differs
+  returned.
+  """
+  dirs = []
+  try:
+    for i in xrange(2):
+      dirs.append(tempfile.mkdtemp(prefix='check-rebuild-'))
+      for name in ('config', common.SCHEMAS):
+        if os.path.exists(os.path.join(state_dir, name)):
+          shutil.copy(os.path.join(state_dir, name), dirs[-1])
+    updater = RRDUpdater(dirs[0], False)
+    updater.ProcessFiles(logs)
+    rebuilder = RRDRebuilder(dirs[1])
+    rebuilder.ProcessFiles(logs)
+    rebuilder.Build(workers)
+    FinishRebuild(dirs[1])
+    names = set()
+    for directory in dirs:
+      names.update(name for name in os.listdir(directory)
+                   if name.endswith('.rrd'))
+    differ = []
+    for name in sorted(names):
+      rrds = [os.path.join(directory, name) for directory in dirs]
+      if (not all(os.path.exists(rrd) for rrd in rrds) or
+          FetchRRD(rrds[0]) != FetchRRD(rrds[1])):
+        differ.append(name)
+    return differ
+  finally:
+    for directory in dirs:
+      shutil.rmtree(directory, True)
+
+
 def main():
   parser = optparse.OptionParser()
   parser.add_option('--dry_run', action='store_true', dest='dry_run')
   parser.add_option('--debug', action='store_true', dest='debug')
+  parser.add_option('--batch', action='store_true', dest='batch',
+      help='Decode logs with the vectorized batch decoder (needs numpy)')
+  parser.add_option('--update_batch', action='store', dest='update_batch',
+      type='int', default=0,
+      help='Write up to this many timestamps per rrdtool update call')
+  parser.add_option('--update_batch_age', action='store',
+      dest='update_batch_age', type='int', default=UPDATE_BATCH_AGE,
+      help='Write batched updates after at most this many seconds')
+  parser.add_option('--follow', action='store_true', dest='follow',
+      help='Keep running, processing logs in log_dir as they are written')
+  parser.add_option('--rebuild', action='store_true', dest='rebuild',
+      help='Rebuild all the RRDs (and history) from the logs given, '
+          'with --workers (default one per CPU) RRDs written at once')
+  parser.add_option('--workers', action='store', dest='workers', type='int',
+      default=0,
+      help='Number of processes writing RRDs for --rebuild and '
+          '--check_rebuild, defaulting to one per CPU')
+  parser.add_option('--check_rebuild', action='store_true',
+      dest='check_rebuild',
+      help='Check --rebuild of the logs given writes the same RRDs as '
+          'updating them, without touching those in state_dir')
+  parser.add_option('--checkpoint_interval', action='store',
+      dest='checkpoint_interval', type='int',
+      default=base_updater.CHECKPOINT_INTERVAL,
+      help='Seconds between saving history while processing')
+  parser.add_option('--checkpoint_reports', action='store',
+      dest='checkpoint_reports', type='int',
+      default=base_updater.CHECKPOINT_REPORTS,
+      help='Reports between saving history while processing')
+  parser.add_option('--metrics_port', action='store', dest='metrics_port',
+      type='int', default=None,
+      help='Serve the state of each node for Prometheus on this port')
+  parser.add_option('--metrics_bind', action='store', dest='metrics_bind',
+      default='127.0.0.1',
+      help='Address for --metrics_port to listen on, eg 0.0.0.0 for any')
+  parser.add_option('--stats', action='store_true', dest='stats',
+      help='Print the time spent in each stage of processing')
+  parser.add_option('--profile', action='store_true', dest='profile',
+      help='Also save a cProfile of the run to state_dir')
   parser.add_option('--state_dir', action='store', dest='state_dir')
   options, args = parser.parse_args()
-  if len(args) < 2:
-    sys.stderr.write('Usage: %s [--dry_run] [--debug] [--state_dir foo] '
-        'logfile1 [logfile2, ...]\n' % sys.argv[0])
+  if options.follow and len(args) > 1:
+    parser.error('--follow takes a single log_dir, defaulting to state_dir')
+  if not options.follow and len(args) < 2:
+    sys.stderr.write('Usage: %s [--dry_run] [--debug] [--batch] '
+        '[--update_batch n] [--state_dir foo] logfile1 [logfile2, ...]\n'
+        '       %s [options] --follow [log_dir]\n' % (sys.argv[0], sys.argv[0]))
     sys.exit(1)
+  rebuild = options.rebuild or options.check_rebuild
+  if rebuild and (options.follow or options.dry_run):
+    parser.error('--rebuild can not be used with --follow or --dry_run')
+  if rebuild and not common.numpy:
+    parser.error('--rebuild needs numpy')
+  workers = options.workers or multiprocessing.cpu_count()
+
+  if options.check_rebuild:
+    differ = CheckRebuild(options.state_dir, args, workers)
+    for name in differ:
+      print 'Rebuilt %s differs from the updated one' % name
+    if differ:
+      sys.exit(1)
+    print 'Rebuilt RRDs match the updated ones'
+    return
+
+  FinishRebuild(options.state_dir)
+  if options.rebuild:
+    rebuilder = RRDRebuilder(options.state_dir, options.debug)
+    rebuilder.batch = options.batch
+    rebuilder.ProcessFiles(args)
+    rebuilder.Build(workers)
+    FinishRebuild(options.state_dir)
+    return
 
   updater = RRDUpdater(options.state_dir, options.dry_run, options.debug)
-  updater.ProcessFiles(args)
-  updater.PrintMeterSummary()
+  updater.batch = options.batch
+  updater.update_batch = options.update_batch
+  updater.update_batch_age = options.update_batch_age
+  updater.checkpoint_interval = options.checkpoint_interval
+  updater.checkpoint_reports = options.checkpoint_reports
+  if options.metrics_port:
+    updater.ServeMetrics(options.metrics_port, options.metrics_bind)
+  if options.stats or options.profile:
+    updater.Instrument(options.profile)
+  if options.follow:
+    updater.Follow(args and args[0] or options.state_dir)
+  else:
+    updater.ProcessFiles(args)
+    updater.PrintMeterSummary()
+  updater.FinishInstrumentation()
 
 if __name__ == "__main__":
   main()
@@ -6,31 +6,213 @@
 # All rights reserved.
 #
 # Reads logger.py output and pushes to SD
+import base_updater
 import common
-import gcloud
-from gcloud import monitoring
+import httplib
+import json
 import optparse
 import os
+import Queue
+import socket
 import sys
+import threading
 import time
+import urlparse
 
 METRIC_MAP = {
     common.TEMPERATURE: 'custom.googleapis.com/smarthouse/temperature',
     common.BATTERY: 'custom.googleapis.com/smarthouse/battery',
 }
+# Type of the other gauges declared in schemas, by metric name. Counters
+# (like revs) are not sent, as SD only takes points of a single kind here.
+SCHEMA_METRIC = 'custom.googleapis.com/smarthouse/%s'
 
-class SDUpdater(common.Updater):
+# SD accepts at most 200 time series per request, each with a single point.
+MAX_SERIES = 200
+# Number of requests to have in flight at once.
+CONCURRENCY = 4
+# Number of times to retry a failed request, and the initial backoff (which
+# doubles with each retry) in seconds.
+RETRIES = 4
+BACKOFF = 0.5
+# HTTP status codes worth retrying a request for.
+RETRYABLE = (429, 500, 502, 503, 504)
+
+
+class WriteError(Exception):
+  """A failed write, which may be worth retrying."""
+
+  def __init__(self, msg, retryable):
+    super(WriteError, self).__init__(msg)
+    self.retryable = retryable
+
+
+class GCloudPoster(object):
+  """Posts to SD via the gcloud client."""
+
+  def __init__(self, project):
+    # Only needed to post to SD itself, not to an --endpoint.
+    import gcloud.exceptions
+    from gcloud import monitoring
+    self.error = gcloud.exceptions.GCloudError
+    self.client = monitoring.Client(project=project)
+
+  def __call__(self, path, data):
+    try:
+      self.client.connection.api_request(method='POST', path=path, data=data)
+    except self.error, e:
+      raise WriteError(str(e), getattr(e, 'code', None) in RETRYABLE)
+    except socket.error, e:
+      raise WriteError(str(e), True)
+
+
+class HTTPPoster(object):
+  """Posts to an SD compatible endpoint (eg fake-sd.py) over plain HTTP."""
+
+  def __init__(self, endpoint):
+    url = urlparse.urlparse(endpoint)
+    self.host = url.netloc
+    self.prefix = url.path.rstrip('/')
+    self.conn = None
+
+  def __call__(self, path, data):
+    try:
+      if not self.conn:
+        self.conn = httplib.HTTPConnection(self.host, timeout=30)
+      self.conn.request('POST', self.prefix + path, json.dumps(data),
+                        {'Content-Type': 'application/json'})
+      response = self.conn.getresponse()
+      body = response.read()
+    except (httplib.HTTPException, socket.error), e:
+      self.conn = None
+      raise WriteError(str(e), True)
+    if response.status != 200:
+      raise WriteError('%d %s' % (response.status, body),
+                       response.status in RETRYABLE)
+
+
+class BatchWriter(object):
+  """Writes time series points to SD in batches, with requests in parallel.
+
+  Each series is assigned to one of concurrency lanes, and each lane sends
+  its requests in order on its own connection, so points for a series still
+  arrive in time order. A request holds at most one point per series, so at
+  most as many points as there are series in its lane: with few series
+  there are few points per request (eg 7 series over 4 lanes average 1.75),
+  and more lanes only help while each still has several series, or when
+  the latency of each request dominates.
+  """
+
+  def __init__(self, path, poster_factory, concurrency=CONCURRENCY,
+               retries=RETRIES, backoff=BACKOFF):
+    self.path = path
+    self.retries = retries
+    self.backoff = backoff
+    self.lock = threading.Lock()
+    self.points = 0
+    self.requests = 0
+    self.retried = 0
+    self.failed = 0
+    self.batches = []
+    self.queues = []
+    self.threads = []
+    for i in xrange(concurrency):
+      self.batches.append(([], set()))
+      self.queues.append(Queue.Queue(maxsize=4))
+      thread = threading.Thread(target=self.Send,
+                                args=(self.queues[i], poster_factory()))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def Add(self, key, series):
+    lane = hash(key) % len(self.queues)
+    series_list, keys = self.batches[lane]
+    if key in keys or len(series_list) >= MAX_SERIES:
+      self.Seal(lane)
+      series_list, keys = self.batches[lane]
+    series_list.append(series)
+    keys.add(key)
+
+  def Seal(self, lane):
+    series_list, keys = self.batches[lane]
+    if series_list:
+      self.queues[lane].put(series_list)
+      self.batches[lane] = ([], set())
+
+  def Flush(self):
+    """Sends all batched points and waits for them to be written."""
+    for lane in xrange(len(self.queues)):
+      self.Seal(lane)
+    for queue in self.queues:
+      queue.join()
+
+  def Close(self):
+    self.Flush()
+    for queue in self.queues:
+      queue.put(None)
+    for thread in self.threads:
+      thread.join()
+
+  def Send(self, queue, poster):
+    while True:
+      series_list = queue.get()
+      if series_list is None:
+        queue.task_done()
+        return
+      try:
+        self.Write(poster, series_list)
+      finally:
+        queue.task_done()
+
+  def Write(self, poster, series_list):
+    for attempt in xrange(self.retries + 1):
+      try:
+        poster(self.path, {'timeSeries': series_list})
+        with self.lock:
+          self.requests += 1
+          self.points += len(series_list)
+        return
+      except WriteError, e:
+        if not e.retryable or attempt == self.retries:
+          print 'Failed to write %d points: ' % len(series_list), e
+          with self.lock:
+            self.failed += len(series_list)
+          return
+        with self.lock:
+          self.retried += 1
+        time.sleep(self.backoff * (2 ** attempt))
+      except Exception, e:
+        # Anything else the poster raises (eg from httplib) must not kill the
+        # lane, or Flush would wait forever for its queue.
+        print 'Failed to write %d points: ' % len(series_list), e
+        with self.lock:
+          self.failed += len(series_list)
+        return
+
+
+class SDUpdater(base_updater.Updater):
   """Updates SD based on a directory of logfiles."""
 
-  def __init__(self, project, house, state_dir, dry_run, debug=False):
+  def __init__(self, project, house, state_dir, dry_run, debug=False,
+               endpoint=None, concurrency=CONCURRENCY):
     # self.history must be defined first to avoid infinite loop in setattr.
     self.project = project
     self.house = house
-    self.client = monitoring.Client(project=project)
-    super(SDUpdater, self).__init__(state_dir, 'sd-history.pickle', dry_run, debug)
+    self.writer = None
+    if not dry_run:
+      if endpoint:
+        poster_factory = lambda: HTTPPoster(endpoint)
+      else:
+        poster_factory = lambda: GCloudPoster(project)
+      self.writer = BatchWriter('/projects/%s/timeSeries' % project,
+                                poster_factory, concurrency)
+    super(SDUpdater, self).__init__(state_dir, 'sd-history.db', dry_run, debug)
 
   def ReportMetric(self, node_id, metric, ts, value):
     sd_metric = METRIC_MAP.get(metric, None)
+    if not sd_metric and self.DeclaredGauge(node_id, metric):
+      sd_metric = SCHEMA_METRIC % metric
     if not sd_metric:
       return
 
@@ -40,66 +222,125 @@ class SDUpdater(common.Updater):
           node_id, metric, ts)
       return
 
-    write_data = {
-        "timeSeries": [
+    series = {
+        "metric": {
+          "type": sd_metric,
+          "labels": {
+            "node_id": str(node_id),
+            "house": self.house
+          }
+        },
+        "resource": {
+          "type": "global",
+          "labels": {
+            "project_id": self.project
+          }
+        },
+        "points": [
           {
-            "metric": {
-              "type": sd_metric,
-              "labels": {
-                "node_id": str(node_id),
-                "house": self.house
-              }
-            },
-            "resource": {
-              "type": "global",
-              "labels": {
-                "project_id": self.project
-              }
+            "interval": {
+              "endTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts)),
             },
-            "points": [
-              {
-                "interval": {
-                  "endTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts)),
-                },
-                "value": {
-                  "doubleValue": value
-                }
-              }
-            ]
+            "value": {
+              "doubleValue": value
+            }
           }
-      ]
+        ]
     }
-    WRITE_PATH = '/projects/%s/timeSeries' % self.project
     if self.dry_run:
-      print 'POST %s' % WRITE_PATH
-      print write_data
+      print 'POST /projects/%s/timeSeries' % self.project
+      print {"timeSeries": [series]}
     else:
-      try:
-        response = self.client.connection.api_request(
-            method='POST', path=WRITE_PATH, data=write_data)
-      except gcloud.exceptions.GCloudError, e:
-        print 'Failed to write (%s:%s@%s): ' % (node_id, metric, ts), e
+      self.writer.Add((node_id, metric), series)
+
+  def DeclaredGauge(self, node_id, metric):
+    schema = self.schemas.get(self.nodes.get(node_id, {}).get('type', None))
+    return (schema is not None and metric in schema.kinds and
+            self.MetricKind(node_id, metric) == 'gauge')
+
+  def FlushOutput(self):
+    if self.writer:
+      self.writer.Flush()
+
+  def SaveHistory(self, announce=True):
+    # Points are not in the history, so must be written before it is saved.
+    self.FlushOutput()
+    super(SDUpdater, self).SaveHistory(announce)
+
+  def InstrumentedCalls(self):
+    calls = super(SDUpdater, self).InstrumentedCalls()
+    if self.writer:
+      calls.append((self.writer, 'Close', 'flush', None))
+    return calls
+
+  def FinishedProcessing(self):
+    super(SDUpdater, self).FinishedProcessing()
+    self.CloseOutput()
+
+  def CloseOutput(self):
+    if self.writer:
+      self.writer.Close()
+      print 'Wrote %d points in %d requests (%d retries, %d points failed)' % (
+          self.writer.points, self.writer.requests, self.writer.retried,
+          self.writer.failed)
 
 
 def main():
   parser = optparse.OptionParser()
   parser.add_option('--dry_run', action='store_true', dest='dry_run')
   parser.add_option('--debug', action='store_true', dest='debug')
+  parser.add_option('--batch', action='store_true', dest='batch',
+      help='Decode logs with the vectorized batch decoder (needs numpy)')
+  parser.add_option('--checkpoint_interval', action='store',
+      dest='checkpoint_interval', type='int',
+      default=base_updater.CHECKPOINT_INTERVAL,
+      help='Seconds between saving history while processing')
+  parser.add_option('--checkpoint_reports', action='store',
+      dest='checkpoint_reports', type='int',
+      default=base_updater.CHECKPOINT_REPORTS,
+      help='Reports between saving history while processing')
+  parser.add_option('--concurrency', action='store', dest='concurrency',
+      type='int', default=CONCURRENCY,
+      help='Number of requests to SD to have in flight at once, each '
+          'holding points for a share of the series (and one per series)')
+  parser.add_option('--endpoint', action='store', dest='endpoint',
+      default=None,
+      help='Post to this URL (eg a fake-sd.py server) rather than SD')
   parser.add_option('--project', action='store', dest='project', default=None)
   parser.add_option('--house', action='store', dest='house', default=None)
+  parser.add_option('--metrics_port', action='store', dest='metrics_port',
+      type='int', default=None,
+      help='Serve the state of each node for Prometheus on this port')
+  parser.add_option('--metrics_bind', action='store', dest='metrics_bind',
+      default='127.0.0.1',
+      help='Address for --metrics_port to listen on, eg 0.0.0.0 for any')
+  parser.add_option('--stats', action='store_true', dest='stats',
+      help='Print the time spent in each stage of processing')
+  parser.add_option('--profile', action='store_true', dest='profile',
+      help='Also save a cProfile of the run to state_dir')
   parser.add_option('--state_dir', action='store', dest='state_dir')
   options, args = parser.parse_args()
   if len(args) < 1:
-    sys.stderr.write('Usage: %s [--dry_run] [--debug] [--state_dir foo] '
-        '--project p --house h logfile1 [logfile2, ...]\n' % sys.argv[0])
+    sys.stderr.write('Usage: %s [--dry_run] [--debug] [--batch] '
+        '[--state_dir foo] --project p --house h logfile1 [logfile2, ...]\n' %
+        sys.argv[0])
     sys.exit(1)
 
   if not options.project or not options.house:
     parser.error('Project and House must be specified')
 
   updater = SDUpdater(options.project, options.house,
-      options.state_dir, options.dry_run, options.debug)
+      options.state_dir, options.dry_run, options.debug,
+      options.endpoint, options.concurrency)
+  updater.batch = options.batch
+  updater.checkpoint_interval = options.checkpoint_interval
+  updater.checkpoint_reports = options.checkpoint_reports
+  if options.metrics_port:
+    updater.ServeMetrics(options.metrics_port, options.metrics_bind)
+  if options.stats or options.profile:
+    updater.Instrument(options.profile)
   updater.ProcessFiles(args)
+  updater.FinishInstrumentation()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Reads logger.py output once, and delivers the metrics to several sinks (as
+# update-rrd.py and update-sd.py would each write them). Each sink spools the
+# metrics it has still to write in the state_dir, so one which is slow (eg SD
+# responding slowly) catches up later without the logs being parsed again,
+# and without holding up the others.
+import base_updater
+import common
+import optparse
+import series_store
+import sinks
+import sys
+
+
+def RRDSink(options):
+  update_rrd = common.LoadScript('update-rrd.py')
+  updater = update_rrd.RRDUpdater(options.state_dir, options.dry_run,
+                                  options.debug)
+  updater.update_batch = options.update_batch
+  return updater
+
+
+def SDSink(options):
+  if not options.project or not options.house:
+    raise ValueError('Project and House must be specified for the sd sink')
+  update_sd = common.LoadScript('update-sd.py')
+  return update_sd.SDUpdater(options.project, options.house,
+                             options.state_dir, options.dry_run, options.debug,
+                             options.endpoint, options.concurrency)
+
+
+def StoreSink(options):
+  update_store = common.LoadScript('update-store.py')
+  return update_store.StoreUpdater(options.state_dir, options.dry_run,
+                                   options.debug, options.window)
+
+SINKS = {
+    'rrd': RRDSink,
+    'sd': SDSink,
+    'store': StoreSink,
+}
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--dry_run', action='store_true', dest='dry_run')
+  parser.add_option('--debug', action='store_true', dest='debug')
+  parser.add_option('--sink', action='append', dest='sinks', type='choice',
+      choices=sorted(SINKS.keys()), default=[],
+      help='Deliver metrics to this sink (%s), may be repeated' %
+          ', '.join(sorted(SINKS.keys())))
+  parser.add_option('--batch', action='store_true', dest='batch',
+      help='Decode logs with the vectorized batch decoder (needs numpy)')
+  parser.add_option('--follow', action='store_true', dest='follow',
+      help='Keep running, processing logs in log_dir as they are written')
+  parser.add_option('--checkpoint_interval', action='store',
+      dest='checkpoint_interval', type='int',
+      default=base_updater.CHECKPOINT_INTERVAL,
+      help='Seconds between saving history while processing')
+  parser.add_option('--checkpoint_reports', action='store',
+      dest='checkpoint_reports', type='int',
+      default=base_updater.CHECKPOINT_REPORTS,
+      help='Reports between saving history while processing')
+  parser.add_option('--update_batch', action='store', dest='update_batch',
+      type='int', default=0,
+      help='rrd: Write up to this many timestamps per rrdtool update call')
+  parser.add_option('--project', action='store', dest='project', default=None)
+  parser.add_option('--house', action='store', dest='house', default=None)
+  parser.add_option('--endpoint', action='store', dest='endpoint',
+      default=None,
+      help='sd: Post to this URL (eg a fake-sd.py server) rather than SD')
+  parser.add_option('--concurrency', action='store', dest='concurrency',
+      type='int', default=4,
+      help='sd: Number of requests to SD to have in flight at once')
+  parser.add_option('--window', action='store', dest='window', type='int',
+      default=series_store.REORDER_WINDOW,
+      help='store: Seconds behind the latest point of a series to accept')
+  parser.add_option('--metrics_port', action='store', dest='metrics_port',
+      type='int', default=None,
+      help='Serve the state of each node for Prometheus on this port')
+  parser.add_option('--metrics_bind', action='store', dest='metrics_bind',
+      default='127.0.0.1',
+      help='Address for --metrics_port to listen on, eg 0.0.0.0 for any')
+  parser.add_option('--stats', action='store_true', dest='stats',
+      help='Print the time spent in each stage of processing')
+  parser.add_option('--state_dir', action='store', dest='state_dir')
+  options, args = parser.parse_args()
+  if options.follow and len(args) > 1:
+    parser.error('--follow takes a single log_dir, defaulting to state_dir')
+  if not options.follow and len(args) < 1:
+    sys.stderr.write('Usage: %s --sink rrd [--sink sd ...] [--state_dir foo] '
+        'logfile1 [logfile2, ...]\n'
+        '       %s [options] --follow [log_dir]\n' % (sys.argv[0], sys.argv[0]))
+    sys.exit(1)
+  if not options.sinks:
+    parser.error('At least one --sink is needed')
+  if len(set(options.sinks)) != len(options.sinks):
+    parser.error('Each --sink may only be given once')
+
+  updater = sinks.FanOutUpdater(options.state_dir, options.dry_run,
+                                options.debug)
+  for name in options.sinks:
+    try:
+      updater.AddSink(name, SINKS[name](options))
+    except ValueError, e:
+      parser.error(str(e))
+  updater.batch = options.batch
+  updater.checkpoint_interval = options.checkpoint_interval
+  updater.checkpoint_reports = options.checkpoint_reports
+  if options.metrics_port:
+    updater.ServeMetrics(options.metrics_port, options.metrics_bind)
+  if options.stats:
+    updater.Instrument()
+  if options.follow:
+    updater.Follow(args and args[0] or options.state_dir)
+  else:
+    updater.ProcessFiles(args)
+  updater.FinishInstrumentation()
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
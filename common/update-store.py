@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Requires numpy (apt-get install python-numpy).
+#
+# Reads logger.py output into a SeriesStore under state_dir/store, an
+# alternative to the RRDs of update-rrd.py which takes points arriving out of
+# order, and is quick to read any range of back (see query-store.py).
+import base_updater
+import optparse
+import os
+import series_store
+import sys
+
+STORE_DIR = 'store'
+
+
+class StoreUpdater(base_updater.Updater):
+  """Updates a SeriesStore based on a directory of logfiles."""
+
+  def __init__(self, state_dir, dry_run, debug=False,
+               window=series_store.REORDER_WINDOW):
+    # self.history must be defined first to avoid infinite loop in setattr.
+    self.series_store = series_store.SeriesStore(
+        os.path.join(state_dir, STORE_DIR), window)
+    super(StoreUpdater, self).__init__(state_dir, 'store-history.db',
+                                       dry_run, debug)
+
+  def ReportMetric(self, node_id, metric, ts, value):
+    name = 'node%d_%s' % (node_id, metric)
+    if self.dry_run:
+      if self.debug:
+        print 'store', name, ts, value
+      return
+    if not self.series_store.Add(name, ts, float(value)) and self.debug:
+      print 'ignoring update for %s, too far out of order' % name, ts, value
+
+  def FlushOutput(self):
+    self.series_store.Flush()
+
+  def SaveHistory(self, announce=True):
+    # Points are not in the history, so must be written before it is saved.
+    self.FlushOutput()
+    super(StoreUpdater, self).SaveHistory(announce)
+
+  def CloseOutput(self):
+    self.series_store.Close()
+    rejected = self.series_store.Rejected()
+    if rejected:
+      print 'Ignored %d points too far out of order' % rejected
+
+  def FinishedProcessing(self):
+    super(StoreUpdater, self).FinishedProcessing()
+    self.CloseOutput()
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--dry_run', action='store_true', dest='dry_run')
+  parser.add_option('--debug', action='store_true', dest='debug')
+  parser.add_option('--batch', action='store_true', dest='batch',
+      help='Decode logs with the vectorized batch decoder')
+  parser.add_option('--window', action='store', dest='window', type='int',
+      default=series_store.REORDER_WINDOW,
+      help='Seconds behind the latest point of a series to accept points')
+  parser.add_option('--follow', action='store_true', dest='follow',
+      help='Keep running, processing logs in log_dir as they are written')
+  parser.add_option('--checkpoint_interval', action='store',
+      dest='checkpoint_interval', type='int',
+      default=base_updater.CHECKPOINT_INTERVAL,
+      help='Seconds between saving history while processing')
+  parser.add_option('--checkpoint_reports', action='store',
+      dest='checkpoint_reports', type='int',
+      default=base_updater.CHECKPOINT_REPORTS,
+      help='Reports between saving history while processing')
+  parser.add_option('--metrics_port', action='store', dest='metrics_port',
+      type='int', default=None,
+      help='Serve the state of each node for Prometheus on this port')
+  parser.add_option('--metrics_bind', action='store', dest='metrics_bind',
+      default='127.0.0.1',
+      help='Address for --metrics_port to listen on, eg 0.0.0.0 for any')
+  parser.add_option('--stats', action='store_true', dest='stats',
+      help='Print the time spent in each stage of processing')
+  parser.add_option('--state_dir', action='store', dest='state_dir')
+  options, args = parser.parse_args()
+  if options.follow and len(args) > 1:
+    parser.error('--follow takes a single log_dir, defaulting to state_dir')
+  if not options.follow and len(args) < 1:
+    sys.stderr.write('Usage: %s [--dry_run] [--debug] [--batch] '
+        '[--state_dir foo] logfile1 [logfile2, ...]\n'
+        '       %s [options] --follow [log_dir]\n' % (sys.argv[0], sys.argv[0]))
+    sys.exit(1)
+
+  updater = StoreUpdater(options.state_dir, options.dry_run, options.debug,
+                         options.window)
+  updater.batch = options.batch
+  updater.checkpoint_interval = options.checkpoint_interval
+  updater.checkpoint_reports = options.checkpoint_reports
+  if options.metrics_port:
+    updater.ServeMetrics(options.metrics_port, options.metrics_bind)
+  if options.stats:
+    updater.Instrument()
+  if options.follow:
+    updater.Follow(args and args[0] or options.state_dir)
+  else:
+    updater.ProcessFiles(args)
+  updater.FinishInstrumentation()
+
+
+if __name__ == "__main__":
+  main()
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et:
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf8
+#
+# Copyright (C) 2017 - Matt Brown
+#
+# All rights reserved.
+#
+# Reads zstd compressed logs, via the zstd command.
+import os
+import subprocess
+
+
+class ZstdLog(object):
+  """Reads a zstd compressed log, via the zstd command, like a plain file.
+
+  Seeking backwards starts decompressing from the beginning again.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.proc = None
+    self.Start()
+
+  def Start(self):
+    try:
+      self.proc = subprocess.Popen(['zstd', '-dcq', self.filename],
+                                   stdout=subprocess.PIPE)
+    except OSError, e:
+      raise RuntimeError('Reading %s requires zstd: %s' % (self.filename, e))
+    self.pos = 0
+
+  def read(self, size=-1):
+    data = self.proc.stdout.read(size)
+    self.pos += len(data)
+    return data
+
+  def readline(self):
+    line = self.proc.stdout.readline()
+    self.pos += len(line)
+    return line
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration
+    return line
+
+  def tell(self):
+    return self.pos
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence != os.SEEK_SET:
+      raise IOError('Can only seek from the start of %s' % self.filename)
+    if offset < self.pos:
+      self.close()
+      self.Start()
+    while self.pos < offset:
+      if not self.read(min(65536, offset - self.pos)):
+        break
+
+  def close(self):
+    if self.proc:
+      self.proc.stdout.close()
+      self.proc.wait()
+      self.proc = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+# Vim modeline
+# vim: set ts=2 sw=2 sts=2 et: